@@ -1,84 +1,196 @@
-from flask import Flask, jsonify, request
+import time
+IMPORT_STARTED = time.perf_counter() # Import-to-ready is measured from here (see startup.py)
+from flask import Blueprint, Flask, current_app, jsonify, request, Response, stream_with_context
 from config import Config
 from flask_cors import CORS
-import openai
-from openai import AzureOpenAI
+import gzip
 import os
+import json
 from datetime import datetime
-from extensions import db, bcrypt, migrate  # <-- Removed duplicate import
-import azure.cognitiveservices.speech as speechsdk
+from extensions import db, history_cache, tts_cache, speech_pool, prompt_cache, pool_monitor, password_hasher, auth_rate_limiter, token_service, phrase_cache, llm_gateway, job_queue, instrumentation, startup, shared_cache, settings_cache, retention, tts_flights  # <-- Removed duplicate import
 import io
 from flask import send_file
-# 1. Create the app and load config FIRST
-app = Flask(__name__)
-app.config.from_object(Config)
-CORS(app)
+from stt_stream import AudioFormatError, InMemoryUploadRequest, RecognitionSession, WavReader
+from password_hasher import HasherBusy
+from auth_tokens import TokenError
+from llm_gateway import UpstreamError
+from llm_providers import create_client
+from instrumentation import span
+from sqlalchemy.exc import IntegrityError
+from models import User, Conversation, Message 
+from chat_turn import ChatTurn
+from tts_cache import audio_key
+from data_transfer import TransferError, data_cli, export_ndjson, import_ndjson
+from retention import retention_cli
+from pagination import CursorError, conversations_page, decode_cursor, encode_cursor, page_from_list, page_from_query, parse_page_size
+
+api = Blueprint('api', __name__)
+client = None # The LLM client, set by create_app()
+
 
-# 2. Initialize extensions ONCE
-db.init_app(app)
-bcrypt.init_app(app)
-migrate.init_app(app, db)
+# 1. Create the app and load config FIRST
+# Nothing here imports an Azure SDK, builds a client or reads the database: workers and
+# `flask db` commands start fast, and the rest happens before the first request (see startup.py).
+def create_app(config_object=Config):
+    global client
+    app = Flask(__name__)
+    app.config.from_object(config_object)
+    app.request_class = InMemoryUploadRequest # Audio uploads stay in memory, no temp files
+    CORS(app)
+
+    # 2. Initialize extensions ONCE
+    db.init_app(app)
+    pool_monitor.init_app(app, db) # SQLite pragmas + pool metrics (see db_engine.py)
+    shared_cache.init_app(app, db) # Shared tier + invalidation when User / Conversation rows change (see shared_cache.py)
+    shared_cache.track(User, "user")
+    shared_cache.track(Conversation, "conversation")
+    shared_cache.track(Message, "conversation", key=lambda msg: msg.conversation_id)
+    password_hasher.init_app(app)
+    auth_rate_limiter.init_app(app)
+    token_service.init_app(app)
+    history_cache.init_app(app)
+    tts_cache.init_app(app)
+    speech_pool.init_app(app)
+    tts_flights.init_app(app)
+    prompt_cache.init_app(app)
+    phrase_cache.init_app(app)
+    llm_gateway.init_app(app)
+    job_queue.init_app(app)
+    retention.init_app(app, db) # Archived conversations come back on first use (see retention.py)
+    instrumentation.init_app(app, db) # Server-Timing, /metrics, profiler (see instrumentation.py)
+    instrumentation.add_collector(stats_metrics)
+    startup.init_app(app, IMPORT_STARTED) # Default user + warm-up before the first request (see startup.py)
+    app.cli.add_command(data_cli) # `flask data export / import` (see data_transfer.py)
+    app.cli.add_command(retention_cli) # `flask retention archive / status / partition` (see retention.py)
+    if os.environ.get('FLASK_RUN_FROM_CLI'):
+        # Set by the `flask` command. Flask-Migrate imports Alembic, which only `flask db` needs
+        from flask_migrate import Migrate
+        Migrate(app, db, directory=app.config['MIGRATIONS_DIR'])
+
+    # --- SCRUM-36: Configure Azure Client (NEW v1.0.0 SYNTAX) ---
+    try:
+        # Azure OpenAI, or the local mock (LLM_PROVIDER, see llm_providers.py), built on first use
+        client = llm_gateway.wrap(create_client(app.config)) # Every call goes through the gateway (see llm_gateway.py)
+        print(f"✅ LLM client configured successfully ({app.config['LLM_PROVIDER']}).")
+    except Exception as e:
+        print(f"❌ FAILED to configure LLM client: {e}")
+    # --- End of SCRUM-36 code ---
 
+    app.register_blueprint(api)
+    print(f"✅ App created {startup.mark('created') * 1000:.0f} ms after import")
+    return app
 
 
-def ensure_default_user():
+@startup.on_first_request
+def ensure_default_user(app):
     """Create default user only when app is actually running (not during CLI import)."""
-    from models import User  # local import to avoid early model use
-    from sqlalchemy import inspect
-
-    with app.app_context():
-        insp = inspect(db.engine)
-        # Only attempt if the 'user' table exists AND has the new 'topic' column
-        if 'user' in insp.get_table_names():
-            cols = {c['name'] for c in insp.get_columns('user')}
-            if 'topic' in cols and User.query.get(1) is None:
-                default_user = User(
-                    id=1,
-                    name="Default User",
-                    email="default@example.com",
-                    password_hash="placeholder",
-                    target_language="Spanish",
-                    fluency_level="Beginner",
-                    topic="General",
-                )
-                db.session.add(default_user)
-                db.session.commit()
-                print("✅ Created default user (ID=1)")   
-# 3. NOW, we can safely import the models.
-from models import User, Conversation, Message 
+    # Only once the database is fully migrated (it has every column User needs)
+    current, revision = startup.schema_status(db)
+    if not current:
+        print(f"❌ Database is at migration {revision}, not the latest: run `flask db upgrade`")
+        return
+    if db.session.get(User, 1) is None:
+        default_user = User(
+            id=1,
+            name="Default User",
+            email="default@example.com",
+            password_hash="placeholder",
+            target_language="Spanish",
+            fluency_level="Beginner",
+            topic="General",
+        )
+        db.session.add(default_user)
+        db.session.commit()
+        print("✅ Created default user (ID=1)")
 
-# --- SCRUM-36: Configure Azure Client (NEW v1.0.0 SYNTAX) ---
-try:
-    # Instantiate the client, passing all credentials
-    client = AzureOpenAI(
-        api_key=app.config['AZURE_OPENAI_KEY'],
-        api_version="2023-05-15", # A common API version
-        azure_endpoint=app.config['AZURE_OPENAI_ENDPOINT']
-    )
-    print("✅ AzureOpenAI client configured successfully (v1.0.0 syntax).")
-except Exception as e:
-    print(f"❌ FAILED to configure AzureOpenAI client: {e}")
-# --- End of SCRUM-36 code ---
 
-@app.route('/')
+# Other workers' writes (see shared_cache.py)
+@shared_cache.subscribe("conversation")
+def drop_cached_history(conversation_id):
+    # Ours are written through on commit (see chat_turn.py); theirs we re-read
+    if conversation_id is None:
+        history_cache.clear()
+    else:
+        history_cache.invalidate(int(conversation_id))
+
+
+@shared_cache.subscribe("tokens")
+def apply_token_revocation(key):
+    # key is "<user id>:<token_version>". Missed ones (None) expire with ACCESS_TOKEN_TTL
+    if key is not None:
+        user_id, version = key.split(":")
+        token_service.revoked(int(user_id), int(version))
+
+
+@startup.warm_up
+def warm_llm_client(app):
+    client.warm() # Imports the SDK and builds the client, so the first chat turn doesn't
+
+
+@startup.warm_up
+def warm_speech_pool(app):
+    # Open speech connections for every voice/language we support
+    if app.config['SPEECH_POOL_PREWARM'] and app.config['AZURE_SPEECH_KEY']:
+        speech_pool.prewarm(list(voice_map.values()), list(azure_langs.values()))
+
+@api.route('/')
 def index():
     return "Hello, Pickle Inc. Backend is running!"
 
 # User account endpoints - For Sign up and Log in
-@app.route('/api/register', methods=['POST'])
+# Both are rate limited per client IP and per email before any bcrypt work is queued.
+def rate_limited(email):
+    retry_after = auth_rate_limiter.hit(ip=request.remote_addr, email=email)
+    if retry_after is None:
+        return None
+    response = jsonify({"error": "Too many attempts, try again later"})
+    response.headers['Retry-After'] = str(max(1, round(retry_after)))
+    return response, 429
+
+
+def request_principal():
+    """(Principal or None, error response or None) for the request's bearer token (see auth_tokens.py)."""
+    try:
+        return token_service.authenticate(request.headers.get('Authorization')), None
+    except TokenError as e:
+        return None, (jsonify({"error": str(e)}), 401)
+
+
+def upstream_error_response(error):
+    # Azure OpenAI is saturated, throttled or down (see llm_gateway.py): tell the client when to retry
+    response = jsonify({"error": str(error)})
+    if error.retry_after is not None:
+        response.headers['Retry-After'] = str(max(1, round(error.retry_after)))
+    return response, error.status
+
+
+def busy_response(error):
+    # The hashing pool's queue is full; the client should retry shortly
+    response = jsonify({"error": str(error)})
+    response.headers['Retry-After'] = "1"
+    return response, 503
+
+@api.route('/api/register', methods=['POST'])
 def register_user():
     try:
         data = request.get_json()
         email = data.get('email')
         password = data.get('password')
 
+        if not email or not password:
+            return jsonify({"error": "Email and password are required"}), 400
+
+        limited = rate_limited(email)
+        if limited:
+            return limited
+
         # Check if user already exists
         existing_user = User.query.filter_by(email=email).first()
         if existing_user:
             return jsonify({"error": "Email already in use"}), 400
 
-        # Hash the password
-        hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+        # Hash the password (in the hashing pool, see password_hasher.py)
+        hashed_password = password_hasher.hash(password)
 
         # Create new user
         new_user = User(
@@ -100,22 +212,37 @@ def register_user():
             "name": new_user.name
         }), 201 # 201 means "Created"
 
+    except HasherBusy as e:
+        return busy_response(e)
     except Exception as e:
         db.session.rollback()
         print(f"Error in /api/register: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/login', methods=['POST'])
+@api.route('/api/login', methods=['POST'])
 def login_user():
     try:
         data = request.get_json()
         email = data.get('email')
         password = data.get('password')
 
+        if not email or not password:
+            return jsonify({"error": "Invalid email or password"}), 401
+
+        limited = rate_limited(email)
+        if limited:
+            return limited
+
         user = User.query.filter_by(email=email).first()
 
         # Check if user exists and password is correct
-        if user and bcrypt.check_password_hash(user.password_hash, password):
+        matches, new_hash = password_hasher.verify(user.password_hash, password) if user else (False, None)
+        if matches:
+            if new_hash:
+                # BCRYPT_LOG_ROUNDS changed since this hash was made
+                user.password_hash = new_hash
+                db.session.commit()
+            auth_rate_limiter.reset(email=email)
             print(f"✅ User login successful: {user.email}")
             return jsonify({
                 "message": "Login successful",
@@ -123,20 +250,98 @@ def login_user():
                     "id": user.id,
                     "name": user.name,
                     "email": user.email
-                }
+                },
+                **token_service.issue(user) # accessToken / refreshToken (see auth_tokens.py)
             }), 200
         else:
             print(f"❌ Login failed for: {email}")
             return jsonify({"error": "Invalid email or password"}), 401 # 401 means "Unauthorized"
 
+    except HasherBusy as e:
+        return busy_response(e)
     except Exception as e:
+        db.session.rollback()
         print(f"Error in /api/login: {e}")
         return jsonify({"error": str(e)}), 500
 
+# Translate a short phrase to English, outside of any conversation (see phrase_cache.py)
+#   POST /api/translate {"text", "language", "proficiency"}
+@api.route('/api/translate', methods=['POST'])
+def translate_phrase():
+    try:
+        data = request.get_json()
+        text = (data.get('text') or "").strip()
+        language = data.get('language')
+        proficiency = data.get('proficiency')
+
+        if not text or not language:
+            return jsonify({"error": "Text and language are required"}), 400
+        if len(text) > current_app.config['PHRASE_MAX_CHARS']:
+            return jsonify({"error": "Text is too long for a phrase lookup"}), 400
+
+        translation = phrase_cache.translate(client, current_app.config['AZURE_OPENAI_DEPLOYMENT_NAME'], text, language, proficiency)
+        return jsonify({"text": text, "translation": translation}), 200
+
+    except UpstreamError as e:
+        return upstream_error_response(e)
+    except Exception as e:
+        print(f"Error in /api/translate: {e}")
+        return jsonify({"error": str(e)}), 500
+
+# Image generation runs as a background job (see jobs.py); poll /api/jobs/<id> for the result
+@api.route('/api/images', methods=['POST'])
+def generate_image():
+    data = request.get_json()
+    text = data.get('text')
+    if not text:
+        return jsonify({"error": "Text is required"}), 400
+
+    job = job_queue.submit("image", lambda prompt: {"url": get_image_for_text(prompt)}, text)
+    if job is None:
+        return jsonify({"error": "Too many background jobs, try again later"}), 503
+    return jsonify(job.to_json()), 202 # 202 means "Accepted"
+
+
+# Status of a background job. ?wait=<seconds> (at most 30) holds the request until it finishes.
+@api.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    wait = min(request.args.get('wait', 0, type=float), 30)
+    if wait > 0:
+        job.finished.wait(wait)
+    return jsonify(job.to_json()), 200
+
+
+@api.route('/api/jobs/stats', methods=['GET'])
+def get_job_stats():
+    return jsonify(job_queue.stats()), 200
+
+
+# Swap a refresh token for a new access + refresh token pair
+@api.route('/api/token/refresh', methods=['POST'])
+def refresh_token():
+    try:
+        data = request.get_json(silent=True) or {}
+        user_id, version = token_service.refresh_claims(data.get('refreshToken') or "")
+
+        user = db.session.get(User, user_id)
+        if not user or user.token_version != version:
+            return jsonify({"error": "Token revoked"}), 401
+        return jsonify(token_service.issue(user)), 200
+
+    except TokenError as e:
+        return jsonify({"error": str(e)}), 401
+    except Exception as e:
+        print(f"Error in /api/token/refresh: {e}")
+        return jsonify({"error": str(e)}), 500
+
 # Function to handle unimplemented image API
 # This function will call DALL-E, but only if it's configured
 def get_image_for_text(text_to_image):
-    dalle_deployment = app.config.get('AZURE_DALLE_DEPLOYMENT_NAME')
+    dalle_deployment = current_app.config.get('AZURE_DALLE_DEPLOYMENT_NAME')
     
     # Check if the DALL-E deployment name is set in our .env
     if not dalle_deployment:
@@ -155,182 +360,281 @@ def get_image_for_text(text_to_image):
         return None
 
 
+def message_to_json(msg):
+    return {
+        "sender": msg.sender,
+        "text": msg.text,
+        "timestamp": msg.timestamp.isoformat()
+    }
+
+
 # Method for processing a message in chat
-@app.route('/api/chat/message', methods=['POST'])
+# One unit of work per turn (see chat_turn.py): one read up front, one commit at the end.
+@api.route('/api/chat/message', methods=['POST'])
 def process_message():
-    data = request.get_json()
-    user_id = data.get('userId')
-    user_text = data.get('text')
-    conversation_id = data.get('conversationId')
+    principal, error = request_principal()
+    if error:
+        return error
+    turn = ChatTurn(request.get_json(), principal) # With a token, the user's settings come from its claims
 
     try:
-        # Step 1: Find the user
-        user = User.query.get(user_id)
-        if not user:
-            return jsonify({"error": "User not found"}), 404
-
-        # Step 2: Find or create the conversation
-        if conversation_id:
-            conversation = Conversation.query.get(conversation_id)
-            if not conversation:
-                return jsonify({"error": "Conversation not found"}), 404
-        else:
-            # Let's use the topic from the frontend, or a default
-            topic = data.get('topic', 'General Conversation') 
-            conversation = Conversation(user_id=user.id, topic=topic)
-            db.session.add(conversation)
-            db.session.commit() # Commit here to get conversation.id
-
-        # Step 3: Save the user's message (You already do this!)
-        user_message = Message(
-            conversation_id=conversation.id,
-            sender='user', 
-            text=user_text
-        )
-        db.session.add(user_message)
-        db.session.commit()
+        # Steps 1-3: find the user + conversation, stage the user's message
+        with span("load"):
+            error = turn.load()
+        if error:
+            body, status = error
+            return jsonify(body), status
 
         # --- START of SCRUM-6 Logic (UPGRADED) ---
-        
-        deployment = app.config['AZURE_OPENAI_DEPLOYMENT_NAME']
-        fluency_level = user.fluency_level.lower()
-
-        if fluency_level == "beginner":
-            fluency_instructions = """
-            Use short, simple sentences and very common vocabulary.
-            Avoid idioms or slang.
-            Correct mistakes explicitly and gently, explaining the rule in English.
-            Keep responses under 3 sentences.
-            Encourage the user often with praise.
-            """
-        elif fluency_level == "intermediate":
-            fluency_instructions = """
-            Use more natural phrasing and intermediate-level vocabulary.
-            Include compound and complex sentences using connectors like 'because', 'although', etc.
-            Correct errors naturally by restating them correctly in context, without full grammar explanations.
-            Encourage longer replies and add small cultural references.
-            """
-        elif fluency_level == "advanced":
-            fluency_instructions = """
-            Use fluent, natural speech and idiomatic expressions.
-            Challenge the user with nuanced questions, abstract topics, and humor.
-            Correct errors subtly by prompting self-correction.
-            Avoid basic grammar explanations unless explicitly asked.
-            """
-        else:
-            fluency_instructions = """
-            Speak clearly and adapt naturally to the user's responses.
-            """
-
-        
-        # --- 1. Define the System Prompt ---
-        system_prompt = f"""
-        You are Kairos, an immersive AI language tutor. Your primary goal is to help me learn {user.target_language} by having a natural, engaging conversation, *not* by quizzing me.
-
-        My Profile:
-        - Language I'm Learning: {user.target_language}
-        - My Fluency: {user.fluency_level}
-        - Conversation Topic: {conversation.topic}
-
-        Behavior Rules:
-        {fluency_instructions}
-
-        Your Rules:
-        1. Immerse Me: Speak *only* in {user.target_language} unless I explicitly ask for help in English.
-        2. Adapt to Me: Adjust your vocabulary and sentence complexity to my {user.fluency_level} level.
-        3. Stay on Topic: Keep the conversation focused on our current topic: {conversation.topic}.
-        4. Gentle Correction: When I make a grammatical or vocabulary mistake, correct it *naturally* as part of your response.
-           - Example (if I'm learning English and say "I eated pizza.")
-           - Your response should be: "Oh, you *ate* pizza? What kind was it?"
-        5. Be Encouraging: Be patient, friendly, and supportive.
-        6. If someone says translate followed by a phrase, translate that phrase to English.
-        """
-        
-        # --- 2. Build the Message History ---
-        message_history = [{"role": "system", "content": system_prompt}]
-
-        # Fetch all messages for this conversation, in order
-        previous_messages = Message.query.filter_by(conversation_id=conversation.id).order_by(Message.timestamp).all()
-        
-        for msg in previous_messages:
-            # Translate your database role ('user' or 'ai') to the API role ('user' or 'assistant')
-            role = "assistant" if msg.sender == "ai" else "user"
-            message_history.append({"role": role, "content": msg.text})
-
-        # --- 3. Call the Azure AI with the FULL history ---
-        response = client.chat.completions.create(
-            model=deployment,
-            messages=message_history, # Pass the entire conversation history
-            temperature=0.7,
-            max_tokens=300
-        )
-        
-        ai_text = response.choices[0].message.content.strip()
+        deployment = current_app.config['AZURE_OPENAI_DEPLOYMENT_NAME']
+        # "translate <phrase>" is answered from the phrase cache, without the history
+        with span("prompt"):
+            ai_text = turn.quick_reply(client, deployment)
+            message_history = turn.context(client, deployment) if ai_text is None else None
+        if ai_text is None:
+            # Call the Azure AI with the bounded history
+            response = client.chat.completions.create(
+                model=deployment,
+                messages=message_history, # System prompt + summary + recent turns
+                temperature=0.7,
+                max_tokens=300
+            )
+
+            ai_text = response.choices[0].message.content.strip()
         # --- END of SCRUM-6 Logic ---
 
-        # Step 5: Save the AI's response (You already do this!)
-        ai_message = Message(
-            conversation_id=conversation.id,
-            sender='ai', 
-            text=ai_text
-        )
-        db.session.add(ai_message)
-        db.session.commit()
+        # Step 5: Save the AI's response, along with everything else, in one commit
+        with span("commit"):
+            ai_message = turn.commit(ai_text)
+        with span("audio"):
+            audio = presynthesize_reply(ai_message.text, turn.target_language) # Ready (or on its way) before "play"
 
         # Step 6: Send the full response back to the frontend
         response_json = {
-            "conversationId": conversation.id,
-            "aiResponse": {
-                "sender": "ai",
-                "text": ai_message.text,
-                "timestamp": ai_message.timestamp.isoformat()
-            },
-            "userMessage": {
-                "sender": "user",
-                "text": user_message.text,
-                "timestamp": user_message.timestamp.isoformat()
-            }
+            "conversationId": turn.conversation_id,
+            "aiResponse": message_to_json(ai_message),
+            "userMessage": message_to_json(turn.user_message),
+            "audio": audio
         }
         
         return jsonify(response_json), 200
 
+    except UpstreamError as e:
+        turn.rollback()
+        return upstream_error_response(e)
     except Exception as e:
         print(f"Error processing message: {e}")
-        db.session.rollback() 
+        turn.rollback()
         return jsonify({"error": str(e)}), 500
 
-# Method for getting chat history 
-# Add this new route to backend/app.py
-@app.route('/api/chat/history/<int:convo_id>', methods=['GET'])
+
+def sse_event(event, payload):
+    # One Server-Sent Event frame: "event: <name>\ndata: <json>\n\n"
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+# Streaming variant of /api/chat/message.
+# Sends the AI reply as Server-Sent Events while Azure is still generating it:
+#   event: start  -> {"conversationId", "userMessage"}   (conversationId is null for a new conversation)
+#   event: token  -> {"text": "<next chunk>"}
+#   event: done   -> {"conversationId", "aiResponse", "audio"}   (sent after the turn is saved)
+#   event: error  -> {"error": "..."}                   (nothing from this turn is saved)
+@api.route('/api/chat/message/stream', methods=['POST'])
+def process_message_stream():
+    principal, error = request_principal()
+    if error:
+        return error
+    turn = ChatTurn(request.get_json(), principal) # With a token, the user's settings come from its claims
+
+    try:
+        with span("load"):
+            error = turn.load()
+        if error:
+            body, status = error
+            return jsonify(body), status
+
+        deployment = current_app.config['AZURE_OPENAI_DEPLOYMENT_NAME']
+        completion = None
+        # "translate <phrase>": the whole answer comes back at once (usually from the cache)
+        with span("prompt"):
+            quick_text = turn.quick_reply(client, deployment)
+            message_history = turn.context(client, deployment) if quick_text is None else None
+        if quick_text is None:
+            # Open the upstream stream before we commit to a 200 response,
+            # so auth/config errors still come back as normal JSON errors.
+            completion = client.chat.completions.create(
+                model=deployment,
+                messages=message_history,
+                temperature=0.7,
+                max_tokens=300,
+                stream=True
+            )
+    except UpstreamError as e:
+        turn.rollback()
+        return upstream_error_response(e)
+    except Exception as e:
+        print(f"Error processing message: {e}")
+        turn.rollback()
+        return jsonify({"error": str(e)}), 500
+
+    @stream_with_context
+    def generate():
+        yield sse_event("start", {"conversationId": turn.conversation.id, "userMessage": message_to_json(turn.user_message)})
+
+        parts = []
+        try:
+            if quick_text is not None:
+                parts.append(quick_text)
+                yield sse_event("token", {"text": quick_text})
+            else:
+                for chunk in completion:
+                    # Azure sends a first chunk with only content-filter results and no choices
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        yield sse_event("token", {"text": delta})
+
+            # The stream is closed: now save the whole turn
+            turn.resume() # The view's session was removed when it returned
+            ai_message = turn.commit("".join(parts).strip())
+            audio = presynthesize_reply(ai_message.text, turn.target_language)
+            yield sse_event("done", {
+                "conversationId": turn.conversation_id,
+                "aiResponse": message_to_json(ai_message),
+                "audio": audio
+            })
+
+        except Exception as e:
+            print(f"Error streaming message: {e}")
+            turn.rollback()
+            yield sse_event("error", {"error": str(e)})
+        finally:
+            if completion is not None:
+                completion.close()
+            turn.rollback() # Client went away mid-stream: drop the staged turn (no-op after commit)
+
+    app = current_app._get_current_object()
+
+    def release():
+        # Also runs when the server closes the response before the body starts (the client
+        # left early): generate() never ran then, and neither did its finally
+        if completion is not None:
+            completion.close() # Gives the upstream concurrency slot back (no-op if already closed)
+        with app.app_context():
+            turn.rollback()
+
+    response = Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no" # Stop nginx-style proxies from buffering the stream
+        }
+    )
+    response.call_on_close(release)
+    return response
+
+# Method for getting chat history, one page at a time (newest page first)
+#   GET /api/chat/history/<id>?limit=50               -> latest 50 messages
+#   GET /api/chat/history/<id>?before=<cursor>&limit=50 -> the 50 messages before that cursor
+#   GET /api/chat/history/<id>?after=<cursor>          -> messages newer than that cursor
+# Messages in a page are always oldest first. Use "prevCursor" as the next `before`
+# to scroll back, and "nextCursor" as `after` to pick up new messages.
+@api.route('/api/chat/history/<int:convo_id>', methods=['GET'])
 def get_chat_history(convo_id):
     try:
+        try:
+            limit = parse_page_size(request.args.get('limit'))
+            before = decode_cursor(request.args['before']) if request.args.get('before') else None
+            after = decode_cursor(request.args['after']) if request.args.get('after') else None
+        except CursorError as e:
+            return jsonify({"error": str(e)}), 400
+        if before and after:
+            return jsonify({"error": "Use either 'before' or 'after', not both"}), 400
+
         # Find the conversation
         conversation = Conversation.query.get(convo_id)
         if not conversation:
             return jsonify({"error": "Conversation not found"}), 404
+        if conversation.archived_at is not None:
+            retention.rehydrate(conversation) # Idle long enough to be archived; back in Message now
 
-        # Get all messages for this conversation, ordered by time
-        messages = Message.query.filter_by(conversation_id=convo_id).order_by(Message.timestamp.asc()).all()
-
-        # Format the messages into a simple list
-        message_list = []
-        for msg in messages:
-            message_list.append({
-                "sender": msg.sender,
-                "text": msg.text,
-                "timestamp": msg.timestamp.isoformat()
-            })
+        # Page from the cache when we hold the whole conversation, otherwise one index range scan
+        cached = history_cache.get(convo_id, complete=True)
+        if cached is not None:
+            messages, has_more = page_from_list(cached, limit, before=before, after=after)
+        else:
+            messages, has_more = page_from_query(convo_id, limit, before=before, after=after)
 
-        return jsonify(message_list), 200
+        return jsonify({
+            "conversationId": convo_id,
+            "messages": [message_to_json(msg) for msg in messages],
+            "prevCursor": encode_cursor(messages[0].timestamp, messages[0].id) if messages else None,
+            "nextCursor": encode_cursor(messages[-1].timestamp, messages[-1].id) if messages else None,
+            # There's always something on the side we came from (at least the cursor's message)
+            "hasOlder": has_more if not after else True,
+            "hasNewer": has_more if after else bool(before)
+        }), 200
     except Exception as e:
         print(f"Error getting history: {e}")
         return jsonify({"error": str(e)}), 500
+
+# List a user's conversations for the history sidebar, most recently active first.
+#   GET /api/users/<id>/conversations?limit=20&before=<nextCursor from the previous page>
+# Reads only the Conversation rows (summary columns are kept up to date on every message).
+@api.route('/api/users/<int:user_id>/conversations', methods=['GET'])
+def list_conversations(user_id):
+    try:
+        try:
+            limit = parse_page_size(request.args.get('limit'))
+            before = decode_cursor(request.args['before']) if request.args.get('before') else None
+        except CursorError as e:
+            return jsonify({"error": str(e)}), 400
+
+        if not User.query.get(user_id):
+            return jsonify({"error": "User not found"}), 404
+
+        conversations, has_more = conversations_page(user_id, limit, before=before)
+        last = conversations[-1] if conversations else None
+
+        return jsonify({
+            "userId": user_id,
+            "conversations": [{
+                "id": convo.id,
+                "topic": convo.topic,
+                "startTime": convo.start_time.isoformat(),
+                "lastMessageAt": convo.last_message_at.isoformat(),
+                "messageCount": convo.message_count,
+                "lastMessagePreview": convo.last_message_preview
+            } for convo in conversations],
+            "nextCursor": encode_cursor(last.last_message_at, last.id) if has_more else None,
+            "hasMore": has_more
+        }), 200
+    except Exception as e:
+        print(f"Error listing conversations: {e}")
+        return jsonify({"error": str(e)}), 500
+
  # Add this new route to app.py
-@app.route('/api/user/settings', methods=['PUT'])
+@api.route('/api/user/settings', methods=['PUT'])
 def update_user_settings():
     try:
+        principal, error = request_principal()
+        if error:
+            return error
+
         data = request.get_json()
         user_id = data.get('userId')
+        if user_id:
+            try:
+                user_id = int(user_id)
+            except (TypeError, ValueError):
+                return jsonify({"error": "userId must be an integer"}), 400
+        if principal:
+            if user_id and user_id != principal.id:
+                return jsonify({"error": "Forbidden"}), 403
+            user_id = principal.id
         new_language = data.get('language')
         new_proficiency = data.get('proficiency')
         new_topic = data.get('topic')
@@ -342,6 +646,7 @@ def update_user_settings():
         user = User.query.get(user_id)
         if not user:
             return jsonify({"error": "User not found"}), 404
+        old_claims = (user.target_language, user.fluency_level, user.topic)
 
         if new_language:
             user.target_language = new_language
@@ -350,38 +655,289 @@ def update_user_settings():
         if new_topic:
             user.topic = new_topic
 
+        # Tokens carry these settings as claims; revoke the old ones
+        claims_changed = (user.target_language, user.fluency_level, user.topic) != old_claims
+        if claims_changed:
+            token_service.revoke(user)
+
         db.session.commit()
+        if claims_changed:
+            token_service.revoked(user.id, user.token_version) # Only once the new version is saved
+            shared_cache.invalidate([("tokens", f"{user.id}:{user.token_version}")]) # Other workers revoke too
         print(f"✅ Updated user {user.id}: Lang={user.target_language}, Prof={user.fluency_level}, Topic={user.topic}")
-        return jsonify({"message": "Settings saved successfully!"}), 200
+        response = {"message": "Settings saved successfully!"}
+        if principal and claims_changed:
+            response.update(token_service.issue(user)) # Replacements carrying the new settings
+        return jsonify(response), 200
 
     except Exception as e:
         db.session.rollback()
         print(f"Error updating settings: {e}")
         return jsonify({"error": str(e)}), 500
     
-@app.route('/api/user/settings/<int:user_id>', methods=['GET'])
+@api.route('/api/user/settings/<int:user_id>', methods=['GET'])
 def get_user_settings(user_id):
     try:
-        user = User.query.get(user_id)
-        if not user:
-            return jsonify({"error": "User not found"}), 404
+        principal, error = request_principal()
+        if error:
+            return error
+        if principal:
+            # Answered from the token's claims, no database read
+            if principal.id != user_id:
+                return jsonify({"error": "Forbidden"}), 403
+            return jsonify({
+                "language": principal.target_language,
+                "proficiency": principal.fluency_level,
+                "topic": principal.topic
+            }), 200
 
-        return jsonify({
-            "language": user.target_language,
-            "proficiency": user.fluency_level,
-            "topic": user.topic
-        }), 200
+        def load():
+            user = User.query.get(user_id)
+            if not user:
+                return None
+            return {
+                "language": user.target_language,
+                "proficiency": user.fluency_level,
+                "topic": user.topic
+            }
+
+        # Shared by every worker; dropped as soon as the User row changes (see shared_cache.py)
+        settings = settings_cache.get_or_load(user_id, load)
+        if settings is None:
+            return jsonify({"error": "User not found"}), 404
+        return jsonify(settings), 200
 
     except Exception as e:
         print(f"Error getting user settings: {e}")
         return jsonify({"error": str(e)}), 500
+
+
+# Connection pool usage, to size DB_POOL_SIZE / DB_MAX_OVERFLOW
+@api.route('/api/db/stats', methods=['GET'])
+def get_db_stats():
+    return jsonify(pool_monitor.stats()), 200
+
+
+# Cache hit/miss counters, for checking how well the in-process caches are doing
+@api.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify({
+        "history": history_cache.stats(),
+        "tts": tts_cache.stats(),
+        "ttsFlights": tts_flights.stats(),
+        "speechPool": speech_pool.stats(),
+        "prompts": prompt_cache.stats(),
+        "phrases": phrase_cache.stats(),
+        "shared": shared_cache.stats()
+    }), 200
+
+
+# Azure OpenAI calls per deployment: in flight, retries, breaker state, latency histograms
+@api.route('/api/upstream/stats', methods=['GET'])
+def get_upstream_stats():
+    return jsonify(llm_gateway.stats()), 200
+
+
+# Hashing pool + auth rate limiter counters
+@api.route('/api/auth/stats', methods=['GET'])
+def get_auth_stats():
+    return jsonify({
+        "passwordHasher": password_hasher.stats(),
+        "rateLimiter": auth_rate_limiter.stats(),
+        "tokens": token_service.stats()
+    }), 200
+
+
+def stats_metrics():
+    """The counters behind the /api/*/stats endpoints, as metric families for /metrics."""
+    caches = {
+        "history": history_cache.stats(),
+        "tts": tts_cache.stats(),
+        "prompts": prompt_cache.stats(),
+        "phrases": phrase_cache.stats(),
+        "settings": settings_cache.stats()
+    }
+    shared = shared_cache.stats()
+    pool = pool_monitor.stats()
+    upstream = llm_gateway.stats()
+    jobs = job_queue.stats()
+    flights = tts_flights.stats()
+    return [
+        ("kairos_cache_hits_total", "counter", "Cache hits.", [({"cache": name}, stats.get("hits")) for name, stats in caches.items()]),
+        ("kairos_cache_misses_total", "counter", "Cache misses.", [({"cache": name}, stats.get("misses")) for name, stats in caches.items()]),
+        ("kairos_cache_shared_hits_total", "counter", "Cache hits served by the shared tier (see shared_cache.py).", [({"cache": "settings"}, caches["settings"]["sharedHits"])]),
+        ("kairos_cache_invalidations_total", "counter", "Cross-worker invalidation messages.", [({"direction": "published"}, shared["published"]), ({"direction": "received"}, shared["received"])]),
+        ("kairos_cache_resets_total", "counter", "Times this worker dropped its caches after missing messages.", [({}, shared["resets"])]),
+        ("kairos_cache_shared_errors_total", "counter", "Failed shared cache operations.", [({}, shared["errors"])]),
+        ("kairos_tts_syntheses_total", "counter", "/api/tts and pre-synthesis calls, by whether they ran a synthesis or shared one in flight.", [({"role": "leader"}, flights["leaders"]), ({"role": "waiter"}, flights["waiters"])]),
+        ("kairos_tts_synthesis_waiters", "gauge", "Calls waiting on an identical synthesis in flight.", [({}, flights["waiting"])]),
+        ("kairos_tts_synthesis_dedup_ratio", "gauge", "Fraction of synthesis calls that shared one in flight.", [({}, flights["dedupRatio"])]),
+        ("kairos_tts_synthesis_wait_timeouts_total", "counter", "Calls that gave up waiting on an identical synthesis (TTS_FLIGHT_TIMEOUT).", [({}, flights["timeouts"])]),
+        ("kairos_db_pool_checked_out", "gauge", "Database connections in use.", [({}, pool["checkedOut"])]),
+        ("kairos_db_pool_checkouts_total", "counter", "Database connection checkouts.", [({}, pool["checkouts"])]),
+        ("kairos_upstream_in_flight", "gauge", "Azure OpenAI calls in flight.", [({"deployment": name}, stats["inFlight"]) for name, stats in upstream.items()]),
+        ("kairos_upstream_retries_total", "counter", "Azure OpenAI retries.", [({"deployment": name}, stats["retries"]) for name, stats in upstream.items()]),
+        ("kairos_upstream_failures_total", "counter", "Failed Azure OpenAI attempts.", [({"deployment": name}, stats["failures"]) for name, stats in upstream.items()]),
+        ("kairos_upstream_breaker_open", "gauge", "1 while the deployment's circuit breaker is open.", [({"deployment": name}, stats["breaker"] == "open") for name, stats in upstream.items()]),
+        ("kairos_retention_rehydrations_total", "counter", "Archived conversations put back into Message on first use.", [({}, retention.stats()["rehydrated"])]),
+        ("kairos_jobs_queued", "gauge", "Background jobs waiting.", [({}, jobs["queued"])]),
+        ("kairos_jobs_failed_total", "counter", "Background jobs that failed.", [({}, jobs["failed"])]),
+        ("kairos_startup_seconds", "gauge", "Seconds from import to each startup phase (see startup.py).", [({"phase": phase}, seconds) for phase, seconds in startup.timings.items()]),
+        ("kairos_password_hashes_rejected_total", "counter", "Password hashes refused because the hashing pool was full.", [({}, password_hasher.stats()["rejected"])]),
+    ]
+
+
+# Prometheus scrape endpoint (this worker's numbers; scrape each worker, or sum them)
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(instrumentation.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+# Sampling profiler for this worker (PROFILER_ENABLED only; see instrumentation.py)
+#   POST /api/debug/profiler/start {"interval": 0.005, "seconds": 30}
+#   POST /api/debug/profiler/stop  -> folded stacks (flamegraph.pl / speedscope)
+#   GET  /api/debug/profiler       -> status
+@api.route('/api/debug/profiler', methods=['GET'])
+def get_profiler_status():
+    if not current_app.config['PROFILER_ENABLED']:
+        return jsonify({"error": "Not found"}), 404
+    return jsonify(dict(instrumentation.profiler.status(), pid=os.getpid())), 200
+
+
+@api.route('/api/debug/profiler/start', methods=['POST'])
+def start_profiler():
+    if not current_app.config['PROFILER_ENABLED']:
+        return jsonify({"error": "Not found"}), 404
+    data = request.get_json(silent=True) or {}
+    try:
+        interval = float(data['interval']) if data.get('interval') else None
+        seconds = float(data['seconds']) if data.get('seconds') else None
+    except (TypeError, ValueError):
+        return jsonify({"error": "interval and seconds must be numbers"}), 400
+    if interval is not None and interval < 0.001:
+        return jsonify({"error": "interval must be at least 0.001"}), 400
+    if not instrumentation.start_profiler(interval, seconds):
+        return jsonify({"error": "Profiler already running"}), 409
+    return jsonify(dict(instrumentation.profiler.status(), pid=os.getpid())), 200
+
+
+@api.route('/api/debug/profiler/stop', methods=['POST'])
+def stop_profiler():
+    if not current_app.config['PROFILER_ENABLED']:
+        return jsonify({"error": "Not found"}), 404
+    return Response(instrumentation.profiler.stop(), mimetype='text/plain')
+
+
+# Bulk export / import as NDJSON (DATA_TRANSFER_ENABLED only; see data_transfer.py). Exports
+# include password hashes, so only turn these on where the API isn't public.
+#   GET  /api/data/export?userId=1&userId=2   -> NDJSON stream (everyone without userId)
+#   POST /api/data/import?newIds=1            <- NDJSON body (gzipped with Content-Encoding: gzip)
+@api.route('/api/data/export', methods=['GET'])
+def export_data():
+    if not current_app.config['DATA_TRANSFER_ENABLED']:
+        return jsonify({"error": "Not found"}), 404
+    try:
+        user_ids = [int(value) for value in request.args.getlist('userId')] or None
+    except ValueError:
+        return jsonify({"error": "userId must be an integer"}), 400
+    # The generator holds its own connection, no app context needed while it streams
+    chunks = export_ndjson(db.engine, user_ids, current_app.config['DATA_TRANSFER_BATCH_SIZE'])
+    return Response(chunks, mimetype='application/x-ndjson', headers={
+        "Content-Disposition": f"attachment; filename=kairos-export-{datetime.utcnow():%Y%m%dT%H%M%S}.ndjson"
+    })
+
+
+@api.route('/api/data/import', methods=['POST'])
+def import_data():
+    if not current_app.config['DATA_TRANSFER_ENABLED']:
+        return jsonify({"error": "Not found"}), 404
+    request.max_content_length = current_app.config['DATA_IMPORT_MAX_BYTES']
+    body = request.stream # Read line by line, never the whole body at once
+    if request.headers.get('Content-Encoding') == 'gzip':
+        body = gzip.GzipFile(fileobj=body)
+    started = time.perf_counter()
+    try:
+        counts = import_ndjson(db.engine, body, request.args.get('newIds') == '1', current_app.config['DATA_TRANSFER_BATCH_SIZE'])
+    except TransferError as e:
+        return jsonify({"error": str(e)}), 400
+    except IntegrityError as e:
+        return jsonify({"error": f"Rows conflict with existing data (import with newIds=1 to add them as new rows): {e.orig}"}), 409
+    print(f"✅ Imported {counts} in {time.perf_counter() - started:.1f}s")
+    return jsonify({"imported": counts, "seconds": round(time.perf_counter() - started, 3)}), 200
         
 #
 # ----------------------------------------------------------------------
 # NEW API ENDPOINT FOR CROSS-BROWSER TEXT-TO-SPEECH
 # ----------------------------------------------------------------------
 #
-@app.route('/api/tts', methods=['POST'])
+# Map's our app's language name to a specific, high-quality Azure voice
+voice_map = {
+    "spanish": "es-ES-ElviraNeural",  # Spain(Female)
+    "french": "fr-FR-DeniseNeural",   # France (Female)
+    "german": "de-DE-KillianNeural",    # Germany (Male)
+    "english": "en-US-JennyNeural",    # US (Female)
+    "hindi": "hi-IN-SwaraNeural", 
+    "chinese": "zh-CN-XiaoxiaoNeural",
+    "japanese": "ja-JP-NanamiNeural",
+    "thai": "th-TH-PremwadeeNeural"
+}
+DEFAULT_VOICE = "en-US-AriaNeural"
+
+
+def voice_for(language):
+    return voice_map.get((language or "").lower(), DEFAULT_VOICE)
+
+
+def synthesize_speech(text, voice):
+    """Run one Azure synthesis. Returns the audio bytes, or None if Azure canceled it."""
+    import azure.cognitiveservices.speech as speechsdk # On first use (see startup.py)
+    # Borrow a warm synthesizer for this voice (see speech_pool.py)
+    with speech_pool.synthesizer(voice) as pooled:
+        result = pooled.synthesizer.speak_text_async(text).get()
+
+        # Check for errors from Azure
+        if result.reason == speechsdk.ResultReason.Canceled:
+            cancellation_details = result.cancellation_details
+            print(f"❌ Azure TTS failed: {cancellation_details.reason}")
+            if cancellation_details.reason == speechsdk.CancellationReason.Error:
+                print(f"Error details: {cancellation_details.error_details}")
+                pooled.healthy = False # Broken connection or auth: replace this synthesizer
+            return None
+
+    return result.audio_data
+
+
+def synthesize_and_store(text, voice, key):
+    audio_data = synthesize_speech(text, voice)
+    if audio_data is None:
+        return None, None
+    return tts_cache.put(key, audio_data), audio_data
+
+
+def synthesize_and_cache(text, voice, key):
+    """Synthesize text into tts_cache under key. Returns (path or None if too large to cache, audio bytes or None if Azure failed).
+
+    Concurrent calls for the same key share one synthesis (see single_flight.py).
+    """
+    return tts_flights.run(key, synthesize_and_store, text, voice, key)
+
+
+def send_cached_audio(key):
+    # Content-addressed, so the bytes behind a key never change: let browsers keep them
+    response = send_file(
+        tts_cache.path(key),
+        mimetype='audio/mpeg',
+        as_attachment=False,
+        conditional=True, # ETag / If-None-Match and Range requests for seeking
+        etag=key,
+        max_age=365 * 24 * 3600
+    )
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.headers['Content-Location'] = f"/api/tts/audio/{key}"
+    return response
+
+
+@api.route('/api/tts', methods=['POST'])
 def text_to_speech():
     try:
         data = request.get_json()
@@ -392,44 +948,22 @@ def text_to_speech():
         if not text or not language:
             return jsonify({"error": "Text and language are required"}), 400
 
-        # 1. Configure the Azure Speech SDK
-        speech_key = app.config['AZURE_SPEECH_KEY']
-        speech_region = app.config['AZURE_SPEECH_REGION']
-        speech_config = speechsdk.SpeechConfig(subscription=speech_key, region=speech_region)
-
-        # Map's our app's language name to a specific, high-quality Azure voice
-        
-        voice_map = {
-            "spanish": "es-ES-ElviraNeural",  # Spain(Female)
-            "french": "fr-FR-DeniseNeural",   # France (Female)
-            "german": "de-DE-KillianNeural",    # Germany (Male)
-            "english": "en-US-JennyNeural",    # US (Female)
-            "hindi": "hi-IN-SwaraNeural", 
-            "chinese": "zh-CN-XiaoxiaoNeural",
-            "japanese": "ja-JP-NanamiNeural",
-            "thai": "th-TH-PremwadeeNeural"
-        }
-
         # Set the voice, defaulting to English if no match is found
-        voice = voice_map.get(language, "en-US-AriaNeural")
-        speech_config.speech_synthesis_voice_name = voice
-
-        # 3. Synthesize the speech
-        # We use 'None' for audio_config to get the audio data in memory
-        speech_synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
-        
-        result = speech_synthesizer.speak_text_async(text).get()
-
-        # 4. Check for errors from Azure
-        if result.reason == speechsdk.ResultReason.Canceled:
-            cancellation_details = result.cancellation_details
-            print(f"❌ Azure TTS failed: {cancellation_details.reason}")
-            if cancellation_details.reason == speechsdk.CancellationReason.Error:
-                print(f"Error details: {cancellation_details.error_details}")
+        voice = voice_for(language)
+
+        # Replays and repeated greetings come straight from the disk cache
+        key = audio_key(text, voice, current_app.config['AZURE_SPEECH_OUTPUT_FORMAT'])
+        if tts_cache.get(key):
+            return send_cached_audio(key)
+
+        with span("synthesis"):
+            path, audio_data = synthesize_and_cache(text, voice, key)
+        if path:
+            return send_cached_audio(key)
+        if audio_data is None:
             return jsonify({"error": "Azure TTS failed"}), 500
 
-        # 5. Send the MP3 audio data back to the frontend
-        audio_data = result.audio_data
+        # Send the MP3 audio data back to the frontend (too large for the cache)
         return send_file(
             io.BytesIO(audio_data),
             mimetype='audio/mpeg',
@@ -440,93 +974,192 @@ def text_to_speech():
         print(f"Error in /api/tts: {e}")
         return jsonify({"error": str(e)}), 500        
 
+
+def synthesize_to_cache(text, voice, key):
+    # Background job (see jobs.py): afterwards /api/tts for this text is a cache hit
+    if not tts_cache.get(key):
+        path, audio_data = synthesize_and_cache(text, voice, key) # Shared with a /api/tts request for the same text
+        if audio_data is None:
+            raise RuntimeError("Azure TTS failed")
+        if not path:
+            raise RuntimeError("Audio too large to cache")
+    return {"url": f"/api/tts/audio/{key}"}
+
+
+def presynthesize_reply(text, language):
+    """Start synthesizing an AI reply in the background, so it's cached by the time the user hits play.
+
+    Returns {"url", "status", "jobId"} for the chat response, or None when there is
+    no background synthesis (turned off, no Speech key, or the job queue is full).
+    """
+    if not current_app.config['TTS_PRESYNTHESIZE'] or not current_app.config['AZURE_SPEECH_KEY'] or not text:
+        return None
+    voice = voice_for(language)
+    key = audio_key(text, voice, current_app.config['AZURE_SPEECH_OUTPUT_FORMAT'])
+    url = f"/api/tts/audio/{key}"
+    if tts_cache.get(key):
+        return {"url": url, "status": "done", "jobId": None}
+
+    job = job_queue.submit("tts", synthesize_to_cache, text, voice, key, key=key)
+    if job is None:
+        return None
+    return {"url": url, "status": job.status, "jobId": job.id}
+
+
+# Cached audio by key (from the Content-Location header of /api/tts).
+# A plain GET, so <audio> elements can seek with Range requests and browsers can revalidate with ETags.
+@api.route('/api/tts/audio/<key>', methods=['GET'])
+def get_tts_audio(key):
+    if len(key) != 64 or any(ch not in "0123456789abcdef" for ch in key):
+        return jsonify({"error": "Invalid audio key"}), 400
+    if not tts_cache.get(key):
+        return jsonify({"error": "Audio not found"}), 404
+    return send_cached_audio(key)
+
 # ----------------------------------------------------------------------
 # NEW API ENDPOINT FOR SPEECH-TO-TEXT (STT) (user to ai)
 # ----------------------------------------------------------------------
-@app.route('/api/stt', methods=['POST'])
-def speech_to_text():
-    # Ensure these are imported
-    import tempfile
-    import os
-    
+azure_langs = {
+    "spanish": "es-ES",
+    "french": "fr-FR",
+    "german": "de-DE",
+    "english": "en-US",
+    "hindi": "hi-IN",
+    "chinese": "zh-CN",
+    "japanese": "ja-JP",
+    "thai": "th-TH"
+}
+
+def stt_audio_stream():
+    """The uploaded audio stream and language for an STT request.
+
+    Accepts the multipart 'audio' field the frontend sends, or a raw audio/wav
+    request body (language in the query string) which is read as it arrives.
+    """
+    if 'audio' in request.files:
+        # Already parsed into memory (InMemoryUploadRequest); wrap the bytes so the stream
+        # stays readable after Flask closes the request's files (streaming responses)
+        upload = request.files['audio'].stream
+        upload.seek(0)
+        return io.BytesIO(upload.getvalue()), request.form.get('language', 'en-US')
+    if request.mimetype in ('audio/wav', 'audio/x-wav', 'audio/wave'):
+        return request.stream, request.args.get('language', 'en-US')
+    return None, None
+
+
+def open_recognition(audio_stream, language_code):
+    # Read the WAV header, then set up a push stream + continuous recognizer for it
+    selected_lang = azure_langs.get(language_code.lower(), language_code)
+    reader = WavReader(audio_stream)
+    reader.read_header()
+
+    session = RecognitionSession(speech_pool.recognition_config(selected_lang), reader.sample_rate)
+    print(f"🎙️ Processing audio in {selected_lang}...")
+    session.start()
+    return reader, session
+
+
+def transcribe(audio_stream, language_code):
+    """Run a full recognition over an uploaded WAV stream. Returns (json body, status)."""
     try:
-        if 'audio' not in request.files:
-            return jsonify({"error": "No audio file provided"}), 400
-        
-        audio_file = request.files['audio']
-        language_code = request.form.get('language', 'en-US') 
-        
-        azure_langs = {
-            "spanish": "es-ES",
-            "french": "fr-FR",
-            "german": "de-DE",
-            "english": "en-US",
-            "hindi": "hi-IN",
-            "chinese": "zh-CN",
-            "japanese": "ja-JP",
-            "thai": "th-TH"
-        }
-        selected_lang = azure_langs.get(language_code.lower(), language_code)
-
-        # # --- WINDOWS FIX START ---
-        # # 1. Create a temp file, but CLOSE the handle immediately
-        # # This releases the Windows file lock so other steps can use it.
-        # temp = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
-        # temp.close() 
-        # temp_filename = temp.name
-
-        # --- DEBUGGING START ---
-        # Save to a real file so we can listen to it!
-        temp_filename = "debug_record.wav" 
-        # --- DEBUGGING END ---
-        
-        try:
-            # 2. Now it is safe to write to the file path
-            audio_file.save(temp_filename)
+        reader, session = open_recognition(audio_stream, language_code)
+    except AudioFormatError as e:
+        return {"error": str(e)}, 400
 
-            # 3. Configure Azure
-            speech_key = app.config['AZURE_SPEECH_KEY']
-            speech_region = app.config['AZURE_SPEECH_REGION']
-            speech_config = speechsdk.SpeechConfig(subscription=speech_key, region=speech_region)
-            speech_config.speech_recognition_language = selected_lang 
+    try:
+        # Feed the audio to Azure as we read it, all in memory
+        for pcm in reader.frames():
+            session.push(pcm)
+        session.finish_audio()
 
-            audio_config = speechsdk.audio.AudioConfig(filename=temp_filename)
-            speech_recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config, audio_config=audio_config)
+        timeout = current_app.config['STT_RECOGNITION_TIMEOUT']
+        errors = [text for kind, text in session.remaining_events(timeout) if kind == "error"]
+    finally:
+        session.close()
 
-            print(f"🎙️ Processing audio in {selected_lang}...")
-            result = speech_recognizer.recognize_once_async().get()
+    if errors:
+        print(f"❌ Azure Canceled: {errors[0]}")
+        return {"error": "Azure configuration error."}, 500
+    if not session.text:
+        print("❌ No speech recognized")
+        return {"error": "Could not recognize speech."}, 400
 
-        finally:
-            # 4. Cleanup: Release Azure objects and delete file
-            # We delete these objects to force them to let go of the file
-            del audio_config
-            del speech_recognizer
-            
-        #     if os.path.exists(temp_filename):
-        #         try:
-        #             os.remove(temp_filename)
-        #         except Exception:
-        #             pass # If Windows still holds it, just ignore. It's a temp file.
-        # # --- WINDOWS FIX END ---
-
-        if result.reason == speechsdk.ResultReason.RecognizedSpeech:
-            print(f"✅ Transcribed: {result.text}")
-            return jsonify({"text": result.text}), 200
-        elif result.reason == speechsdk.ResultReason.NoMatch:
-            print("❌ No speech recognized")
-            return jsonify({"error": "Could not recognize speech."}), 400
-        elif result.reason == speechsdk.ResultReason.Canceled:
-            print("❌ Azure Canceled")
-            return jsonify({"error": "Azure configuration error."}), 500
+    print(f"✅ Transcribed: {session.text}")
+    return {"text": session.text}, 200
+
+
+@api.route('/api/stt', methods=['POST'])
+def speech_to_text():
+    try:
+        audio_stream, language_code = stt_audio_stream()
+        if audio_stream is None:
+            return jsonify({"error": "No audio file provided"}), 400
+
+        with span("recognition"):
+            body, status = transcribe(audio_stream, language_code)
+        return jsonify(body), status
 
     except Exception as e:
         print(f"Error in /api/stt: {e}")
         return jsonify({"error": str(e)}), 500
+
+
+# Streaming variant of /api/stt for long utterances, as Server-Sent Events:
+#   event: partial -> {"text": "<current hypothesis>"}   (changes as more audio is heard)
+#   event: final   -> {"text": "<a finished phrase>"}
+#   event: done    -> {"text": "<full transcript>"}
+#   event: error   -> {"error": "..."}
+@api.route('/api/stt/stream', methods=['POST'])
+def speech_to_text_stream():
+    try:
+        audio_stream, language_code = stt_audio_stream()
+        if audio_stream is None:
+            return jsonify({"error": "No audio file provided"}), 400
+        reader, session = open_recognition(audio_stream, language_code)
+    except AudioFormatError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error in /api/stt/stream: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    def event_frame(kind, text):
+        if kind == "error":
+            return sse_event("error", {"error": text})
+        if kind == "done":
+            return sse_event("done", {"text": session.text})
+        return sse_event(kind, {"text": text})
+
+    @stream_with_context
+    def generate():
+        try:
+            # Push audio and forward whatever Azure has recognized so far
+            for pcm in reader.frames():
+                session.push(pcm)
+                for kind, text in session.pending_events():
+                    yield event_frame(kind, text)
+            session.finish_audio()
+
+            for kind, text in session.remaining_events(current_app.config['STT_RECOGNITION_TIMEOUT']):
+                yield event_frame(kind, text)
+            print(f"✅ Transcribed: {session.text}")
+        except Exception as e:
+            print(f"Error in /api/stt/stream: {e}")
+            yield sse_event("error", {"error": str(e)})
+        finally:
+            session.close()
+
+    return Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
     
 
-with app.app_context():
-    ensure_default_user() 
-     # safe to call now; DB is migrated when you run the server
 
+# No app at import: `flask run` / `flask db` find create_app() themselves (FLASK_APP="app:create_app()"
+# to be explicit), asgi.py builds its own, and processes that only import this module (password
+# hashing workers, see password_hasher.py) don't build one at all.
 if __name__ == "__main__":
+    app = create_app()
+    startup.prepare(app) # Serving for sure: first-request tasks now, warm-up in the background (see startup.py)
     app.run(debug=True, host="127.0.0.1", port=5000)
@@ -0,0 +1,357 @@
+# Async serving mode.
+#
+#   uvicorn asgi:application --workers 2
+#
+# The slow endpoints (chat, TTS, STT) run on an event loop here, so a worker can keep
+# thousands of Azure calls in flight instead of one per thread:
+#   - Azure OpenAI is called with the async client (no thread held while the model generates)
+#   - database work and Azure Speech SDK calls (which only have blocking .get()) run on a
+#     bounded thread pool (ASYNC_BLOCKING_THREADS), never on the loop itself
+#   - a chat turn is still one unit of work with one commit (see chat_turn.py / RequestScope)
+# Every other route is served by the normal Flask app, mounted underneath.
+import asyncio
+import contextvars
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as backend_app
+from app import create_app, message_to_json, presynthesize_reply, sse_event, synthesize_and_store, transcribe, voice_for
+from auth_tokens import TokenError
+from chat_turn import ChatTurn
+from extensions import instrumentation, llm_gateway, shared_cache, startup, token_service, tts_cache, tts_flights
+from instrumentation import span
+from llm_gateway import UpstreamError
+from llm_providers import create_async_client
+from tts_cache import audio_key
+
+flask_app = create_app()
+
+try:
+    # Same provider as the sync client in app.py; shares its per-deployment limits (see llm_gateway.py)
+    async_client = llm_gateway.wrap_async(create_async_client(flask_app.config))
+    print(f"✅ Async LLM client configured successfully ({flask_app.config['LLM_PROVIDER']}).")
+except Exception as e:
+    print(f"❌ FAILED to configure async LLM client: {e}")
+
+
+@startup.warm_up
+def warm_async_client(app):
+    async_client.warm()
+
+blocking_pool = ThreadPoolExecutor(
+    max_workers=flask_app.config['ASYNC_BLOCKING_THREADS'],
+    thread_name_prefix="kairos-blocking"
+)
+
+
+async def run_blocking(func, *args):
+    """Run a blocking function on the bounded pool, inside a Flask app context."""
+    def call():
+        with flask_app.app_context():
+            return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(blocking_pool, call)
+
+
+class RequestScope:
+    """Runs the blocking steps of one request on the pool, all inside one Flask app context.
+
+    Each step may land on a different pool thread, but they all run in the same
+    contextvars Context, so they share the app context and its SQLAlchemy session
+    (one ChatTurn unit of work can span the awaits in between).
+    """
+
+    def __init__(self):
+        self._context = contextvars.copy_context()
+        self._app_context = None
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(blocking_pool, self._context.run, func, *args)
+
+    def _push(self):
+        self._app_context = flask_app.app_context()
+        self._app_context.push()
+
+    def _pop(self):
+        self._app_context.pop()
+
+    async def open(self):
+        await self.run(self._push)
+        return self
+
+    async def close(self):
+        await self.run(self._pop)
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+def timed(handler):
+    """Per-request setup for a route served here (the Flask routes get it from their hooks): timings, cache sync."""
+    async def endpoint(request):
+        if shared_cache.enabled:
+            # Other workers' writes, like the Flask before_request hook (see shared_cache.py).
+            # A file or network read: on the pool, not the loop
+            await run_blocking(shared_cache.sync)
+        if not instrumentation.enabled:
+            return await handler(request)
+        # Set before the RequestScope is made, so its pool threads see the same timings.
+        # No reset afterwards: each request runs in its own task, and a streamed body still needs it
+        timings, _ = instrumentation.start(handler.__name__)
+        response = await handler(request)
+        header = instrumentation.finish(timings, request.method, response.status_code)
+        if header:
+            response.headers['Server-Timing'] = header
+            response.headers['Timing-Allow-Origin'] = '*'
+        return response
+    return endpoint
+
+
+class ReleasingStreamingResponse(StreamingResponse):
+    """A StreamingResponse that calls release() however it ends: sent, failed, or the client
+    gone before the body started (when the generator never runs, nor would its finally, and
+    a BackgroundTask is skipped)."""
+
+    def __init__(self, content, release, **kwargs):
+        super().__init__(content, **kwargs)
+        self.release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.release()
+
+
+# --- Chat ---
+def upstream_error_response(error):
+    headers = {"Retry-After": str(max(1, round(error.retry_after)))} if error.retry_after is not None else None
+    return JSONResponse({"error": str(error)}, error.status, headers=headers)
+
+
+async def start_turn(scope, request):
+    """Load + stage the turn, then either answer it from the phrase cache or build the prompt.
+
+    Returns (turn, quick reply or None, messages, deployment, error response).
+    """
+    try:
+        principal = token_service.authenticate(request.headers.get('authorization'))
+    except TokenError as e:
+        return None, None, None, None, JSONResponse({"error": str(e)}, 401)
+
+    turn = ChatTurn(await request.json(), principal)
+    with span("load"):
+        error = await scope.run(turn.load)
+    if error:
+        return turn, None, None, None, JSONResponse(*error)
+
+    deployment = flask_app.config['AZURE_OPENAI_DEPLOYMENT_NAME']
+    # The sync client is only used here for phrase lookups that miss the cache and the
+    # occasional summary fold (see phrase_cache.py / chat_context.py)
+    with span("prompt"):
+        quick_text = await scope.run(turn.quick_reply, backend_app.client, deployment)
+        if quick_text is not None:
+            return turn, quick_text, None, deployment, None
+        messages = await scope.run(turn.context, backend_app.client, deployment)
+    return turn, None, messages, deployment, None
+
+
+async def process_message(request):
+    async with RequestScope() as scope:
+        turn = None
+        try:
+            turn, ai_text, messages, deployment, error = await start_turn(scope, request)
+            if error:
+                return error
+
+            if ai_text is None:
+                response = await async_client.chat.completions.create(
+                    model=deployment,
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=300
+                )
+                ai_text = response.choices[0].message.content.strip()
+
+            with span("commit"):
+                ai_message = await scope.run(turn.commit, ai_text)
+            with span("audio"):
+                audio = await scope.run(presynthesize_reply, ai_message.text, turn.target_language)
+            return JSONResponse({
+                "conversationId": turn.conversation_id,
+                "aiResponse": message_to_json(ai_message),
+                "userMessage": message_to_json(turn.user_message),
+                "audio": audio
+            })
+
+        except UpstreamError as e:
+            if turn:
+                await scope.run(turn.rollback)
+            return upstream_error_response(e)
+        except Exception as e:
+            print(f"Error processing message: {e}")
+            if turn:
+                await scope.run(turn.rollback)
+            return JSONResponse({"error": str(e)}, 500)
+
+
+async def process_message_stream(request):
+    # Same events as the Flask version of /api/chat/message/stream
+    scope = await RequestScope().open()
+    turn = None
+    try:
+        turn, quick_text, messages, deployment, error = await start_turn(scope, request)
+        if error:
+            await scope.close()
+            return error
+
+        completion = None
+        if quick_text is None:
+            completion = await async_client.chat.completions.create(
+                model=deployment,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=300,
+                stream=True
+            )
+    except Exception as e:
+        print(f"Error processing message: {e}")
+        if turn:
+            await scope.run(turn.rollback)
+        await scope.close()
+        if isinstance(e, UpstreamError):
+            return upstream_error_response(e)
+        return JSONResponse({"error": str(e)}, 500)
+
+    async def generate():
+        # The scope (and the staged turn) lives until the response is done, see release()
+        try:
+            yield sse_event("start", {"conversationId": turn.conversation.id, "userMessage": message_to_json(turn.user_message)})
+
+            parts = []
+            if quick_text is not None:
+                parts.append(quick_text)
+                yield sse_event("token", {"text": quick_text})
+            else:
+                async for chunk in completion:
+                    # Azure sends a first chunk with only content-filter results and no choices
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        yield sse_event("token", {"text": delta})
+
+            with span("commit"): # After the headers: /metrics only
+                ai_message = await scope.run(turn.commit, "".join(parts).strip())
+            with span("audio"):
+                audio = await scope.run(presynthesize_reply, ai_message.text, turn.target_language)
+            yield sse_event("done", {"conversationId": turn.conversation_id, "aiResponse": message_to_json(ai_message), "audio": audio})
+
+        except Exception as e:
+            print(f"Error streaming message: {e}")
+            yield sse_event("error", {"error": str(e)})
+
+    async def release():
+        if completion is not None:
+            await completion.close() # Gives the upstream concurrency slot back
+        await scope.run(turn.rollback) # No-op once committed
+        await scope.close()
+
+    return ReleasingStreamingResponse(
+        generate(),
+        release,
+        media_type='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# --- Speech ---
+def cached_audio_response(key):
+    return FileResponse(
+        tts_cache.path(key),
+        media_type='audio/mpeg',
+        headers={
+            "ETag": f'"{key}"',
+            "Cache-Control": "public, max-age=31536000, immutable",
+            "Content-Location": f"/api/tts/audio/{key}"
+        }
+    )
+
+
+async def text_to_speech(request):
+    try:
+        data = await request.json()
+        text = data.get('text')
+        language = data.get('language')
+
+        if not text or not language:
+            return JSONResponse({"error": "Text and language are required"}, 400)
+
+        voice = voice_for(language)
+        key = audio_key(text, voice, flask_app.config['AZURE_SPEECH_OUTPUT_FORMAT'])
+        if tts_cache.get(key):
+            return cached_audio_response(key)
+
+        with span("synthesis"):
+            # Waiting on an identical synthesis in flight doesn't take a thread (see single_flight.py)
+            path, audio_data = await tts_flights.run_async(key, run_blocking, synthesize_and_store, text, voice, key)
+        if path:
+            return cached_audio_response(key)
+        if audio_data is None:
+            return JSONResponse({"error": "Azure TTS failed"}, 500)
+        return Response(audio_data, media_type='audio/mpeg')
+
+    except Exception as e:
+        print(f"Error in /api/tts: {e}")
+        return JSONResponse({"error": str(e)}, 500)
+
+
+async def speech_to_text(request):
+    try:
+        if request.headers.get('content-type', '').startswith('multipart/form-data'):
+            form = await request.form()
+            upload = form.get('audio')
+            if upload is None or isinstance(upload, str):
+                return JSONResponse({"error": "No audio file provided"}, 400)
+            audio_stream = io.BytesIO(await upload.read())
+            language_code = form.get('language', 'en-US')
+        else:
+            audio_stream = io.BytesIO(await request.body())
+            language_code = request.query_params.get('language', 'en-US')
+
+        with span("recognition"):
+            body, status = await run_blocking(transcribe, audio_stream, language_code)
+        return JSONResponse(body, status)
+
+    except Exception as e:
+        print(f"Error in /api/stt: {e}")
+        return JSONResponse({"error": str(e)}, 500)
+
+
+application = Starlette(
+    routes=[
+        Route('/api/chat/message', timed(process_message), methods=['POST']),
+        Route('/api/chat/message/stream', timed(process_message_stream), methods=['POST']),
+        Route('/api/tts', timed(text_to_speech), methods=['POST']),
+        Route('/api/stt', timed(speech_to_text), methods=['POST']),
+        # Everything else (auth, history, settings, cached audio, ...) is the Flask app
+        Mount('/', app=WSGIMiddleware(flask_app))
+    ],
+    middleware=[
+        # Same policy as CORS(app) on the Flask side
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
+    ]
+)
+
+# A server imports this module: default user now, clients + speech connections in the background (see startup.py)
+startup.prepare(flask_app)
@@ -0,0 +1,135 @@
+# Signed, stateless session tokens.
+#
+# /api/login hands out two tokens, both signed with SECRET_KEY (itsdangerous):
+#   - an access token (ACCESS_TOKEN_TTL, short) carrying the claims the chat path needs:
+#     user id, target language, fluency level and topic. Requests that send it as
+#     "Authorization: Bearer <token>" are authorized, and get their system prompt built,
+#     without reading the user row.
+#   - a refresh token (REFRESH_TOKEN_TTL, long) that only carries the user id; it is
+#     swapped for a new pair at /api/token/refresh, which does read the user.
+# Both carry the user's token_version. Changing a claim (see update_user_settings)
+# bumps it, which revokes every token issued before: refresh checks the database, and
+# access tokens are checked against the versions revoked in this process. Other
+# server processes hear about it through the shared cache's messages (see
+# shared_cache.py); without one (SHARED_CACHE_BACKEND=none) they keep accepting an old
+# access token until it expires, so keep the access TTL short.
+import threading
+from collections import namedtuple
+
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+
+# Stands in for the User row on token-authenticated requests (same attribute names)
+Principal = namedtuple('Principal', ['id', 'target_language', 'fluency_level', 'topic', 'token_version'])
+
+
+class TokenError(Exception):
+    pass
+
+
+class TokenService:
+    def __init__(self):
+        self.access_ttl = 0
+        self.refresh_ttl = 0
+        self.require_token = False
+        self._access = None
+        self._refresh = None
+        self._revoked = {} # user id -> lowest token_version still accepted
+        self._lock = threading.Lock()
+        self.issued = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    def init_app(self, app):
+        self.access_ttl = app.config['ACCESS_TOKEN_TTL']
+        self.refresh_ttl = app.config['REFRESH_TOKEN_TTL']
+        self.require_token = app.config['AUTH_REQUIRE_TOKEN']
+        # Different salts, so one kind of token can't be passed off as the other
+        self._access = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='kairos-access')
+        self._refresh = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='kairos-refresh')
+        app.extensions['token_service'] = self
+
+    # --- Issuing ---
+    def issue(self, user):
+        """New access + refresh tokens for a User (or Principal), as the JSON sent to the client."""
+        access = self._access.dumps({
+            "sub": user.id,
+            "ver": user.token_version or 0,
+            "lang": user.target_language,
+            "lvl": user.fluency_level,
+            "topic": user.topic
+        })
+        refresh = self._refresh.dumps({"sub": user.id, "ver": user.token_version or 0})
+        with self._lock:
+            self.issued += 1
+        return {
+            "accessToken": access,
+            "refreshToken": refresh,
+            "tokenType": "Bearer",
+            "expiresIn": self.access_ttl
+        }
+
+    def revoke(self, user):
+        """Invalidate every token issued to user so far. The caller commits the new token_version,
+        then calls revoked() (so a failed commit doesn't reject tokens that are still valid)."""
+        user.token_version = (user.token_version or 0) + 1
+
+    def revoked(self, user_id, version):
+        """Stop accepting user_id's access tokens older than version (a revoke() here or in another worker)."""
+        with self._lock:
+            self._revoked[user_id] = max(self._revoked.get(user_id, 0), version)
+
+    # --- Checking ---
+    def _load(self, serializer, token, max_age):
+        try:
+            claims = serializer.loads(token, max_age=max_age)
+        except SignatureExpired:
+            raise TokenError("Token expired")
+        except BadSignature:
+            raise TokenError("Invalid token")
+        with self._lock:
+            if claims["ver"] < self._revoked.get(claims["sub"], 0):
+                raise TokenError("Token revoked")
+        return claims
+
+    def _checked(self, serializer, token, max_age):
+        try:
+            claims = self._load(serializer, token, max_age)
+        except TokenError:
+            with self._lock:
+                self.rejected += 1
+            raise
+        with self._lock:
+            self.accepted += 1
+        return claims
+
+    def principal(self, token):
+        claims = self._checked(self._access, token, self.access_ttl)
+        return Principal(claims["sub"], claims["lang"], claims["lvl"], claims["topic"], claims["ver"])
+
+    def refresh_claims(self, token):
+        """(user id, token_version) from a refresh token; the caller checks the version against the user."""
+        claims = self._checked(self._refresh, token, self.refresh_ttl)
+        return claims["sub"], claims["ver"]
+
+    def authenticate(self, authorization):
+        """Principal for an Authorization header value.
+
+        Returns None when there is no bearer token and tokens aren't required
+        (requests fall back to the userId in the body). Raises TokenError otherwise.
+        """
+        scheme, _, token = (authorization or "").partition(" ")
+        if scheme.lower() != "bearer" or not token:
+            if self.require_token:
+                raise TokenError("Authorization required")
+            return None
+        return self.principal(token.strip())
+
+    def stats(self):
+        with self._lock:
+            return {
+                "issued": self.issued,
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "revokedUsers": len(self._revoked),
+                "accessTtl": self.access_ttl
+            }
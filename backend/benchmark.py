@@ -0,0 +1,334 @@
+# End-to-end benchmark for the backend, with every Azure service replaced by a local fake.
+#
+#   python benchmark.py                                  # defaults below
+#   python benchmark.py --users 50 --messages 2000 --concurrency 16 --requests 400
+#   python benchmark.py --endpoints chat,history --json results.json
+#
+# What it does:
+#   1. seeds a fresh database (a temp SQLite file unless --database-url is given) with
+#      --users users, each with one conversation of --messages messages and one "long"
+#      conversation of --long-messages, through the models (denormalized columns included)
+#   2. drives each endpoint in turn with --requests requests from --concurrency threads,
+#      in-process through the Flask test client:
+#        chat          POST /api/chat/message            (LLM_PROVIDER=mock, see llm_providers.py)
+#        history       GET  /api/chat/history/<id>       (regular conversations)
+#        history_long  GET  /api/chat/history/<id>       (long conversations: should cost the same)
+#        settings      GET/PUT /api/user/settings        (1 in 10 is a PUT)
+#        tts           POST /api/tts                     (fake synthesizer, --tts-ms per call)
+#        stt           POST /api/stt                     (fake recognizer, --stt-rtf x audio length)
+#   3. reports per endpoint: p50/p95/p99 latency, throughput, errors, and SQL statements
+#      per request (counted per thread, so background jobs aren't included)
+#
+# Compare runs with different --messages to catch work that grows with conversation length.
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+ENDPOINTS = ("chat", "history", "history_long", "settings", "tts", "stt")
+LANGUAGES = ("Spanish", "French", "German", "Japanese")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Kairos backend with local fakes for Azure.")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=200, help="messages per regular conversation")
+    parser.add_argument("--long-messages", type=int, default=None, help="messages per long conversation (default 10x --messages)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--database-url", default=None, help="default: a temporary SQLite file. Its tables are dropped and recreated!")
+    parser.add_argument("--llm-first-token-ms", default="lognormal:300,0.5", help="mock LLM latency distribution")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=80)
+    parser.add_argument("--tts-ms", type=float, default=150, help="fake synthesis time per call")
+    parser.add_argument("--stt-rtf", type=float, default=0.3, help="fake recognition time as a fraction of audio length")
+    parser.add_argument("--audio-seconds", type=float, default=3.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", dest="json_path", default=None, help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep the app's own log lines")
+    return parser.parse_args(argv)
+
+
+def configure_environment(args, workdir):
+    # Must happen before the app is imported: Config reads the environment at import time
+    os.environ["LLM_PROVIDER"] = "mock"
+    os.environ["LLM_MOCK_SEED"] = str(args.seed)
+    os.environ["LLM_MOCK_FIRST_TOKEN_MS"] = args.llm_first_token_ms
+    os.environ["LLM_MOCK_TOKENS_PER_SECOND"] = str(args.llm_tokens_per_second)
+    os.environ["LLM_CONCURRENCY"] = str(max(args.concurrency, 16))
+    os.environ["LLM_RPM"] = "1000000" # Measure our stack, not the quota model
+    os.environ["LLM_TPM"] = "1000000000"
+    os.environ["DATABASE_URL"] = args.database_url or "sqlite:///" + os.path.join(workdir, "benchmark.db")
+    os.environ["TTS_CACHE_DIR"] = os.path.join(workdir, "tts_cache")
+    os.environ["TTS_PRESYNTHESIZE"] = "0" # Keep background synthesis out of the chat numbers
+    os.environ["SPEECH_POOL_PREWARM"] = "0"
+    os.environ["AZURE_SPEECH_KEY"] = "benchmark"
+    os.environ["AZURE_SPEECH_REGION"] = "local"
+    os.environ.pop("PHRASE_CACHE_DB", None)
+
+
+# --- Fakes for the Azure Speech services ---
+class FakeSynthesizer:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __call__(self, text, voice):
+        time.sleep(self.seconds)
+        return b"ID3" + f"{voice}:{text}".encode("utf-8") * 8
+
+
+class FakeRecognitionSession:
+    """Same interface as stt_stream.RecognitionSession; 'recognizes' after rtf x the audio pushed."""
+
+    rtf = 0.3
+
+    def __init__(self, speech_config, sample_rate):
+        self.sample_rate = sample_rate
+        self.samples = 0
+        self.finals = []
+
+    def start(self):
+        pass
+
+    def push(self, pcm):
+        self.samples += len(pcm) // 2
+
+    def finish_audio(self):
+        pass
+
+    def pending_events(self):
+        return iter(())
+
+    def remaining_events(self, timeout):
+        time.sleep(self.rtf * self.samples / self.sample_rate)
+        self.finals.append("hola que tal")
+        yield ("final", "hola que tal")
+        yield ("done", None)
+
+    @property
+    def text(self):
+        return " ".join(self.finals)
+
+    def close(self):
+        pass
+
+
+def make_wav(seconds, sample_rate=16000):
+    samples = int(seconds * sample_rate)
+    pcm = b"".join(struct.pack("<h", int(8000 * math.sin(2 * math.pi * 440 * i / sample_rate))) for i in range(samples))
+    header = struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + len(pcm), b"WAVE", b"fmt ", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16, b"data", len(pcm)
+    )
+    return header + pcm
+
+
+# --- SQL statement counting, per thread ---
+class QueryCounter:
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self._local = threading.local()
+        event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        self._local.count = getattr(self._local, "count", 0) + 1
+
+    def reset(self):
+        self._local.count = 0
+
+    @property
+    def count(self):
+        return getattr(self._local, "count", 0)
+
+
+# --- Seeding ---
+def seed(app, users, messages, long_messages):
+    """Create users with one regular and one long conversation each. Returns the fixture ids."""
+    from extensions import db
+    from models import Conversation, Message, User
+
+    fixtures = {"users": [], "conversations": [], "long_conversations": []}
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        start = datetime.utcnow() - timedelta(days=30)
+        for n in range(users):
+            user = User(
+                name=f"Bench User {n}",
+                email=f"bench{n}@example.com",
+                password_hash="placeholder",
+                target_language=LANGUAGES[n % len(LANGUAGES)],
+                fluency_level="Beginner",
+                topic="General"
+            )
+            db.session.add(user)
+            db.session.flush()
+            fixtures["users"].append(user.id)
+
+            for kind, count in (("conversations", messages), ("long_conversations", long_messages)):
+                conversation = Conversation(user_id=user.id, topic="General", start_time=start)
+                rows = [
+                    Message(
+                        sender="user" if i % 2 == 0 else "ai",
+                        text=f"Mensaje numero {i} de la conversacion, con algo de texto para que pese.",
+                        timestamp=start + timedelta(seconds=i)
+                    )
+                    for i in range(count)
+                ]
+                conversation.messages = rows
+                db.session.add(conversation)
+                conversation.record_messages(*rows)
+                db.session.flush()
+                fixtures[kind].append(conversation.id)
+            db.session.commit()
+    return fixtures
+
+
+# --- Scenarios: each returns a function(client, rng, i) that makes one request ---
+def scenarios(fixtures, wav):
+    users = fixtures["users"]
+
+    def chat(client, rng, i):
+        index = rng.randrange(len(users))
+        return client.post("/api/chat/message", json={
+            "userId": users[index],
+            "conversationId": fixtures["conversations"][index],
+            "text": f"Hola, esta es la pregunta {i}"
+        })
+
+    def history(client, rng, i):
+        return client.get(f"/api/chat/history/{rng.choice(fixtures['conversations'])}?limit=50")
+
+    def history_long(client, rng, i):
+        return client.get(f"/api/chat/history/{rng.choice(fixtures['long_conversations'])}?limit=50")
+
+    def settings(client, rng, i):
+        user_id = rng.choice(users)
+        if i % 10 == 9:
+            return client.put("/api/user/settings", json={"userId": user_id, "topic": f"Topic {i}"})
+        return client.get(f"/api/user/settings/{user_id}")
+
+    def tts(client, rng, i):
+        return client.post("/api/tts", json={"text": f"Frase numero {i} para sintetizar", "language": "spanish"})
+
+    def stt(client, rng, i):
+        return client.post("/api/stt", data={"audio": (io.BytesIO(wav), "speech.wav"), "language": "es-ES"}, content_type="multipart/form-data")
+
+    return {
+        "chat": chat,
+        "history": history,
+        "history_long": history_long,
+        "settings": settings,
+        "tts": tts,
+        "stt": stt,
+    }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_endpoint(app, counter, request, requests, concurrency, seed_value):
+    latencies, queries, errors = [], [], []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def one(i):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+            local.rng = random.Random(f"{seed_value}:{threading.get_ident()}")
+        counter.reset()
+        started = time.perf_counter()
+        response = request(local.client, local.rng, i)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            queries.append(counter.count)
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": len(errors),
+        "errorStatuses": sorted(set(errors)),
+        "throughput": round(requests / wall, 1),
+        "p50Ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95Ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99Ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "maxMs": round(latencies[-1] * 1000, 1),
+        "queriesPerRequest": round(sum(queries) / len(queries), 2),
+        "maxQueries": max(queries)
+    }
+
+
+def print_report(results, args):
+    print(f"\nusers={args.users} messages={args.messages} long={args.long_messages} "
+          f"concurrency={args.concurrency} requests/endpoint={args.requests}")
+    header = f"{'endpoint':<14}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}{'q/req':>8}{'max q':>7}"
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        print(f"{name:<14}{result['throughput']:>9}{result['p50Ms']:>10}{result['p95Ms']:>10}{result['p99Ms']:>10}"
+              f"{result['maxMs']:>10}{result['errors']:>8}{result['queriesPerRequest']:>8}{result['maxQueries']:>7}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.long_messages = args.long_messages or args.messages * 10
+    selected = [name.strip() for name in args.endpoints.split(",") if name.strip()]
+    unknown = set(selected) - set(ENDPOINTS)
+    if unknown:
+        sys.exit(f"Unknown endpoints: {', '.join(sorted(unknown))} (choose from {', '.join(ENDPOINTS)})")
+
+    workdir = tempfile.mkdtemp(prefix="kairos-bench-")
+    configure_environment(args, workdir)
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+
+    with quiet:
+        import app as backend
+        from extensions import db
+        backend.synthesize_speech = FakeSynthesizer(args.tts_ms / 1000)
+        FakeRecognitionSession.rtf = args.stt_rtf
+        backend.RecognitionSession = FakeRecognitionSession
+        flask_app = backend.create_app()
+
+        seeding_started = time.perf_counter()
+        fixtures = seed(flask_app, args.users, args.messages, args.long_messages)
+        seeding_time = time.perf_counter() - seeding_started
+        with flask_app.app_context():
+            counter = QueryCounter(db.engine)
+
+        requests = scenarios(fixtures, make_wav(args.audio_seconds))
+        results = {}
+        for name in selected:
+            results[name] = run_endpoint(flask_app, counter, requests[name], args.requests, args.concurrency, args.seed)
+
+    print(f"Seeded {args.users} users in {seeding_time:.1f}s ({os.environ['DATABASE_URL']})")
+    print_report(results, args)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
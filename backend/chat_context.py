@@ -0,0 +1,165 @@
+# Context builder for chat turns.
+#
+# Instead of sending every message of a conversation to Azure OpenAI, we keep:
+#   1. the system prompt,
+#   2. a rolling summary of older turns (stored on the Conversation row), and
+#   3. as many recent messages as fit in the deployment's token budget.
+#
+# Messages that fall out of the window are folded into the summary a batch at a
+# time, so the summary is updated incrementally and never rebuilt from scratch.
+# Folding is an LLM call of its own, so it runs as a background job (see jobs.py):
+# the turn that goes over budget is sent with the current summary and the recent
+# messages that fit, and later turns pick up the new summary once the job is done.
+from flask import current_app
+
+from extensions import db, history_cache, job_queue
+from models import Conversation, Message
+
+# Rough token estimate (~4 characters per token for English/Latin text).
+# Good enough for budgeting; we don't need exact counts here.
+CHARS_PER_TOKEN = 4
+# Every chat message carries a few tokens of overhead (role, separators)
+TOKENS_PER_MESSAGE = 4
+
+SUMMARY_PROMPT = """
+You maintain a running summary of a language-learning conversation between a student and Kairos, their AI tutor.
+Update the existing summary with the new messages below.
+Keep: topics discussed, facts the student shared about themselves, and recurring mistakes they made.
+Write at most 8 short bullet points, in English.
+"""
+
+
+def estimate_tokens(text):
+    return len(text or "") // CHARS_PER_TOKEN + TOKENS_PER_MESSAGE
+
+
+def token_budget(deployment):
+    """Prompt token budget for a deployment (system prompt + summary + recent turns)."""
+    budgets = current_app.config.get('CHAT_CONTEXT_TOKEN_BUDGETS') or {}
+    return budgets.get(deployment, current_app.config['CHAT_CONTEXT_DEFAULT_TOKEN_BUDGET'])
+
+
+def to_api_message(msg):
+    # Translate our database role ('user' or 'ai') to the API role ('user' or 'assistant')
+    role = "assistant" if msg.sender == "ai" else "user"
+    return {"role": role, "content": msg.text}
+
+
+def summary_message(summary):
+    return {"role": "system", "content": f"Summary of the earlier part of this conversation:\n{summary}"}
+
+
+def load_unsummarized_messages(conversation):
+    """Newest messages not yet folded into the summary, oldest first (bounded query)."""
+    if conversation.id is None:
+        return [] # Not inserted yet, so no history
+    limit = current_app.config['CHAT_CONTEXT_MAX_MESSAGES']
+    after_id = conversation.summarized_until_id or 0
+
+    cached = history_cache.get(conversation.id)
+    if cached is not None:
+        return [msg for msg in cached if msg.id > after_id][-limit:]
+
+    query = Message.query.filter(Message.conversation_id == conversation.id)
+    if after_id:
+        query = query.filter(Message.id > after_id)
+
+    newest_first = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit).all()
+    messages = list(reversed(newest_first))
+
+    # Cache what we read; it's the whole conversation if nothing was summarized or cut off
+    history_cache.put(conversation.id, messages, complete=not after_id and len(messages) < limit)
+    return messages
+
+
+def split_window(messages, available_tokens):
+    """Split messages into (older, recent) so that recent fits in available_tokens.
+
+    The newest message is always kept, even if it alone is over budget.
+    """
+    used = 0
+    cut = len(messages)
+    for i in range(len(messages) - 1, -1, -1):
+        cost = estimate_tokens(messages[i].text)
+        if used + cost > available_tokens and cut < len(messages):
+            break
+        used += cost
+        cut = i
+    return messages[:cut], messages[cut:]
+
+
+def summarize(client, deployment, summary, messages):
+    """The existing summary updated with messages (one LLM call)."""
+    transcript = "\n".join(
+        f"{'Tutor' if msg.sender == 'ai' else 'Student'}: {msg.text}" for msg in messages
+    )
+    response = client.chat.completions.create(
+        model=deployment,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Existing summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"}
+        ],
+        temperature=0.2,
+        max_tokens=current_app.config['CHAT_CONTEXT_SUMMARY_MAX_TOKENS']
+    )
+    return response.choices[0].message.content.strip()
+
+
+def fold_into_summary(client, deployment, conversation_id, until_id):
+    """Background job: fold the conversation's messages up to until_id into its summary."""
+    conversation = db.session.get(Conversation, conversation_id)
+    if conversation is None or (conversation.summarized_until_id or 0) >= until_id:
+        return {"summarizedUntilId": conversation and conversation.summarized_until_id} # Already done
+    summarized_until_id, summary = conversation.summarized_until_id, conversation.summary
+    query = Message.query.filter(Message.conversation_id == conversation_id, Message.id <= until_id)
+    if summarized_until_id:
+        query = query.filter(Message.id > summarized_until_id)
+    messages = query.order_by(Message.timestamp, Message.id).all()
+    db.session.rollback() # No transaction open during the LLM call
+    if not messages:
+        return {"summarizedUntilId": summarized_until_id}
+
+    new_summary = summarize(client, deployment, summary, messages)
+    conversation = db.session.get(Conversation, conversation_id)
+    if conversation is None or conversation.summarized_until_id != summarized_until_id:
+        db.session.rollback()
+        return {"summarizedUntilId": conversation and conversation.summarized_until_id} # Folded elsewhere meanwhile
+    conversation.summary = new_summary
+    conversation.summarized_until_id = messages[-1].id
+    db.session.commit()
+    print(f"📝 Summarized {len(messages)} older messages in conversation {conversation_id}")
+    return {"summarizedUntilId": messages[-1].id}
+
+
+def build_context(client, deployment, conversation, system_prompt, pending=()):
+    """Return the message list to send to the model for this conversation.
+
+    pending are messages of this turn that aren't committed yet (newest last).
+    Cost stays flat as the conversation grows: the DB read is bounded by
+    CHAT_CONTEXT_MAX_MESSAGES and the prompt by the deployment's token budget.
+    """
+    budget = token_budget(deployment)
+    available = budget - estimate_tokens(system_prompt)
+    if conversation.summary:
+        available -= estimate_tokens(summary_message(conversation.summary)["content"])
+
+    messages = load_unsummarized_messages(conversation) + list(pending)
+    older, recent = split_window(messages, available)
+
+    if older:
+        # Over budget: fold down to the low watermark, so we only summarize every few
+        # turns instead of on every single one. In the background: this turn goes out
+        # with the current summary and what fits. A fold already queued or running for
+        # the conversation is reused, and a failed or skipped one is retried next turn.
+        watermark = current_app.config['CHAT_CONTEXT_LOW_WATERMARK']
+        to_fold, _ = split_window(messages, int(available * watermark))
+        to_fold = [msg for msg in to_fold if msg.id is not None] # Committed ones only
+        if to_fold:
+            job_queue.submit("summary", fold_into_summary, client, deployment, conversation.id, to_fold[-1].id,
+                             key=f"summary:{conversation.id}")
+
+    context = [{"role": "system", "content": system_prompt}]
+    if conversation.summary:
+        context.append(summary_message(conversation.summary))
+    context.extend(to_api_message(msg) for msg in recent)
+    return context
@@ -0,0 +1,147 @@
+# Unit of work for one chat turn: one read, one commit.
+#
+#   turn = ChatTurn(data)
+#   error = turn.load()                        # user + conversation in a single query
+#   ai_text = turn.quick_reply(client, deployment)   # 'translate <phrase>': cached, no history
+#   messages = turn.context(client, deployment)      # otherwise: the full prompt
+#   ... call the model ...
+#   ai_message = turn.commit(ai_text)          # conversation, user + AI messages, one commit
+#
+# A streaming Flask view gets a new session for its response body: call turn.resume()
+# in the generator before commit().
+#
+# With a token-authenticated request, pass ChatTurn(data, principal): the token's claims
+# stand in for the User row, so only the conversation is read (nothing at all for a
+# new conversation).
+#
+# Nothing is written before commit(): a new conversation and the user's message stay
+# pending in the session while the model runs (no write lock held for seconds, which on
+# SQLite would block every other writer). If anything fails, rollback() leaves the
+# database exactly as it was before the turn. The one exception: load() puts an archived
+# conversation's messages back first, in a transaction of its own (see retention.py).
+from datetime import datetime
+
+from chat_context import build_context
+from extensions import db, history_cache, phrase_cache, prompt_cache, retention
+from history_cache import cached_message
+from models import Conversation, Message, User
+
+
+class ChatTurn:
+    def __init__(self, data, principal=None):
+        self.data = data
+        self.principal = principal # auth_tokens.Principal, or None to trust data['userId']
+        self.user = None
+        self.target_language = None
+        self.conversation = None
+        self.is_new_conversation = False
+        self.user_message = None
+        self.committed = False
+
+    def load(self):
+        """Load the user and conversation and stage the user's message.
+
+        Returns None, or (error json, status) when the turn can't go ahead.
+        """
+        user_id = self.data.get('userId')
+        conversation_id = self.data.get('conversationId')
+
+        # Step 1: Find the user (and the conversation, in the same query)
+        if self.principal is not None:
+            self.user = self.principal
+            if conversation_id:
+                self.conversation = db.session.get(Conversation, conversation_id)
+                if self.conversation and self.conversation.user_id != self.user.id:
+                    self.conversation = None # Someone else's conversation: same as not found
+        elif conversation_id:
+            row = (
+                db.session.query(User, Conversation)
+                .outerjoin(Conversation, Conversation.id == conversation_id)
+                .filter(User.id == user_id)
+                .first()
+            )
+            self.user, self.conversation = row if row else (None, None)
+        else:
+            self.user = db.session.get(User, user_id) if user_id else None
+
+        if not self.user:
+            return {"error": "User not found"}, 404
+        # commit() expires the User row; keep what the reply's audio needs
+        self.target_language = self.user.target_language
+
+        # Step 2: Find or create the conversation
+        if conversation_id and not self.conversation:
+            return {"error": "Conversation not found"}, 404
+        if self.conversation and self.conversation.archived_at is not None:
+            retention.rehydrate(self.conversation) # Before anything reads its messages (see retention.py)
+        if not self.conversation:
+            # Let's use the topic from the frontend, or a default
+            topic = self.data.get('topic', 'General Conversation')
+            self.conversation = Conversation(user_id=self.user.id, topic=topic, start_time=datetime.utcnow())
+            db.session.add(self.conversation)
+            self.is_new_conversation = True
+
+        # Step 3: Stage the user's message (written by commit())
+        self.user_message = self._new_message('user', self.data.get('text'))
+        return None
+
+    def _new_message(self, sender, text):
+        message = Message(sender=sender, text=text, timestamp=datetime.utcnow())
+        if self.is_new_conversation:
+            message.conversation = self.conversation # FK is filled in when the conversation is inserted
+        else:
+            message.conversation_id = self.conversation.id
+        db.session.add(message)
+        return message
+
+    def quick_reply(self, client, deployment):
+        """Answer for a 'translate <phrase>' message (see phrase_cache.py), or None for anything else."""
+        phrase = phrase_cache.request_phrase(self.user_message.text)
+        if phrase is None:
+            return None
+        return phrase_cache.translate(client, deployment, phrase, self.user.target_language, self.user.fluency_level)
+
+    def context(self, client, deployment):
+        """Messages to send to the model: system prompt, summary, recent turns + this message."""
+        system_prompt = prompt_cache.system_prompt(
+            self.user.target_language, self.user.fluency_level, self.conversation.topic
+        )
+        # Reads only; keep the staged rows out of the database until commit()
+        with db.session.no_autoflush:
+            return build_context(client, deployment, self.conversation, system_prompt, pending=[self.user_message])
+
+    def resume(self):
+        """Re-attach what load() staged to the current session.
+
+        For streamed responses: Flask tears down the app context (and removes its
+        session) when the view returns, then pushes it again for the response body, so
+        by the time the stream ends the staged rows are no longer in any session.
+        """
+        for obj in (self.conversation, self.user_message):
+            if obj not in db.session:
+                db.session.add(obj)
+
+    def commit(self, ai_text):
+        """Save the AI reply together with everything staged by load(). Returns the AI message."""
+        ai_message = self._new_message('ai', ai_text)
+        self.conversation.record_messages(self.user_message, ai_message)
+        db.session.flush() # Assigns ids; the commit right after makes it durable
+        saved = [cached_message(self.user_message), cached_message(ai_message)]
+        conversation_id = self.conversation.id
+        db.session.commit()
+        self.committed = True
+
+        # Write-through, now that the rows are committed
+        if self.is_new_conversation:
+            history_cache.put(conversation_id, saved, complete=True)
+        else:
+            for msg in saved:
+                history_cache.append(conversation_id, msg)
+
+        self.conversation_id = conversation_id
+        self.user_message, ai_message = saved # Detached copies, safe to use after the commit
+        return ai_message
+
+    def rollback(self):
+        if not self.committed:
+            db.session.rollback()
@@ -1,22 +1,174 @@
 import os
+import tempfile
 from dotenv import load_dotenv
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 load_dotenv(os.path.join(basedir, '.env'))
 
+
+def engine_options(database_uri):
+    """SQLALCHEMY_ENGINE_OPTIONS profile for the database we're pointed at."""
+    if database_uri.startswith('sqlite'):
+        # One file, one writer: wait for the lock instead of failing right away.
+        # WAL / synchronous / busy_timeout pragmas are set per connection (see db_engine.py).
+        return {"connect_args": {"timeout": int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)) / 1000}}
+
+    # PostgreSQL (or any other server database)
+    return {
+        "pool_size": int(os.environ.get('DB_POOL_SIZE', 10)),
+        "max_overflow": int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        "pool_timeout": int(os.environ.get('DB_POOL_TIMEOUT', 10)), # Seconds to wait for a free connection
+        "pool_recycle": int(os.environ.get('DB_POOL_RECYCLE', 1800)), # Replace connections older than this
+        "pool_pre_ping": True, # Detect connections the server (or a pooler) has dropped
+    }
+
+
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
+    MIGRATIONS_DIR = os.path.join(basedir, 'migrations') # Alembic scripts; the newest one is what startup expects
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db') # Fallback to SQLite if URL not set
     SQLALCHEMY_TRACK_MODIFICATIONS = False 
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+    SQLITE_PRAGMAS = {
+        "journal_mode": "WAL", # Readers don't block the writer (and vice versa)
+        "synchronous": "NORMAL", # Safe with WAL, far fewer fsyncs than FULL
+        "busy_timeout": int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+    }
     
    # Azure Credentials
     AZURE_SPEECH_KEY = os.environ.get('AZURE_SPEECH_KEY')
     AZURE_SPEECH_REGION = os.environ.get('AZURE_SPEECH_REGION')
     # AZURE_SPEECH_ENDPOINT = os.environ.get('AZURE_SPEECH_ENDPOINT') # If needed
+    # Name of a speechsdk.SpeechSynthesisOutputFormat member; /api/tts serves it as audio/mpeg
+    AZURE_SPEECH_OUTPUT_FORMAT = os.environ.get('AZURE_SPEECH_OUTPUT_FORMAT') or 'Audio24Khz48KBitRateMonoMp3'
+
+    # Warm speech client pool (see speech_pool.py)
+    SPEECH_POOL_PREWARM = os.environ.get('SPEECH_POOL_PREWARM', '1') == '1' # Open connections at startup
+    SPEECH_POOL_SIZE_PER_VOICE = int(os.environ.get('SPEECH_POOL_SIZE_PER_VOICE', 4))
+    SPEECH_POOL_CHECKOUT_TIMEOUT = 10 # Seconds to wait for a free synthesizer
+    SPEECH_POOL_MAX_AGE_SECONDS = 9 * 60 # Recycle before the ~10 minute auth token expires
+    SPEECH_POOL_MAX_USES = 500
+
+    # Speech-to-text (see stt_stream.py). Uploads are kept in memory, so cap their size.
+    MAX_CONTENT_LENGTH = int(os.environ.get('MAX_UPLOAD_BYTES', 25 * 1024 * 1024))
+    STT_RECOGNITION_TIMEOUT = 30 # Seconds to wait for Azure after the last audio chunk
+
+    # Password hashing (see password_hasher.py), in worker processes off the request threads
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12)) # Changing it rehashes passwords at next login
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+    PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 16)) # Queued + running; more gets a 503
+    PASSWORD_HASH_TIMEOUT = 10 # Seconds to wait for a worker before giving up
+
+    # Session tokens issued at login (see auth_tokens.py), signed with SECRET_KEY
+    ACCESS_TOKEN_TTL = int(os.environ.get('ACCESS_TOKEN_TTL', 15 * 60)) # Seconds; also how long a revoked token may linger in other workers without a shared cache
+    REFRESH_TOKEN_TTL = int(os.environ.get('REFRESH_TOKEN_TTL', 30 * 24 * 3600))
+    # Off until the frontend logs in: requests without a bearer token still use the userId they send
+    AUTH_REQUIRE_TOKEN = os.environ.get('AUTH_REQUIRE_TOKEN', '0') == '1'
+
+    # Attempts allowed per window on /api/login and /api/register (see rate_limit.py)
+    AUTH_RATE_LIMIT_WINDOW = 60 # Seconds
+    AUTH_RATE_LIMIT_PER_IP = int(os.environ.get('AUTH_RATE_LIMIT_PER_IP', 30))
+    AUTH_RATE_LIMIT_PER_EMAIL = int(os.environ.get('AUTH_RATE_LIMIT_PER_EMAIL', 5))
+    AUTH_RATE_LIMIT_MAX_KEYS = 100000 # Bound on the IPs/emails tracked at once
+
+    # Background media jobs (see jobs.py)
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+    JOB_QUEUE_MAX = 256 # Waiting jobs; past this, background work is skipped
+    JOB_RETENTION = 1000 # Finished jobs kept for polling
+    TTS_PRESYNTHESIZE = os.environ.get('TTS_PRESYNTHESIZE', '1') == '1' # Synthesize each AI reply as soon as it's saved
+    TTS_FLIGHT_TIMEOUT = 30 # Seconds a request waits on an identical synthesis in flight (see single_flight.py)
 
+    # Request timing and metrics (see instrumentation.py)
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1' # Per-request timings, SQL counters and /metrics
+    SERVER_TIMING_HEADER = os.environ.get('SERVER_TIMING_HEADER', '1') == '1' # Send each request's phases back to the client
+    # Sampling profiler, for diagnosing a live worker. Off unless you need it: it exposes code paths
+    PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', '0') == '1'
+    PROFILER_INTERVAL = float(os.environ.get('PROFILER_INTERVAL', 0.01)) # Seconds between samples
+    PROFILER_MAX_SECONDS = 300 # A forgotten profiler stops itself
+    PROFILER_OUTPUT_DIR = os.environ.get('PROFILER_OUTPUT_DIR') or tempfile.gettempdir() # Where SIGUSR2 writes profiles
+
+    # Async serving mode (asgi.py): threads for DB work and blocking Speech SDK calls
+    ASYNC_BLOCKING_THREADS = int(os.environ.get('ASYNC_BLOCKING_THREADS', 32))
+
+    # Chat completions backend (see llm_providers.py): "azure", or "mock" for offline load tests
+    LLM_PROVIDER = os.environ.get('LLM_PROVIDER', 'azure')
     AZURE_OPENAI_KEY = os.environ.get('AZURE_OPENAI_KEY')
     AZURE_OPENAI_ENDPOINT = os.environ.get('AZURE_OPENAI_ENDPOINT')
-    AZURE_OPENAI_DEPLOYMENT_NAME = os.environ.get('AZURE_OPENAI_DEPLOYMENT_NAME')
+    AZURE_OPENAI_DEPLOYMENT_NAME = os.environ.get('AZURE_OPENAI_DEPLOYMENT_NAME') or \
+        ('mock' if LLM_PROVIDER == 'mock' else None)
     AZURE_DALLE_DEPLOYMENT_NAME = os.environ.get('AZURE_DALLE_DEPLOYMENT_NAME')
 
+    # Local stand-in model (LLM_PROVIDER=mock), distributions as in llm_providers.py
+    LLM_MOCK_SEED = int(os.environ.get('LLM_MOCK_SEED', 0))
+    LLM_MOCK_FIRST_TOKEN_MS = os.environ.get('LLM_MOCK_FIRST_TOKEN_MS', 'lognormal:400,0.6')
+    LLM_MOCK_REPLY_TOKENS = os.environ.get('LLM_MOCK_REPLY_TOKENS', 'uniform:20,120')
+    LLM_MOCK_TOKENS_PER_SECOND = float(os.environ.get('LLM_MOCK_TOKENS_PER_SECOND', 60))
+    LLM_MOCK_CHUNK_TOKENS = int(os.environ.get('LLM_MOCK_CHUNK_TOKENS', 3))
+    LLM_MOCK_ERROR_RATE = float(os.environ.get('LLM_MOCK_ERROR_RATE', 0))
+
+    # Gateway in front of Azure OpenAI (see llm_gateway.py)
+    LLM_TIMEOUT = float(os.environ.get('LLM_TIMEOUT', 60)) # Seconds per HTTP attempt
+    LLM_DEFAULT_CONCURRENCY = int(os.environ.get('LLM_CONCURRENCY', 16)) # Calls in flight per deployment
+    LLM_DEFAULT_RPM = int(os.environ.get('LLM_RPM', 180)) # Match the deployment's Azure quota
+    LLM_DEFAULT_TPM = int(os.environ.get('LLM_TPM', 30000))
+    LLM_DEPLOYMENT_LIMITS = {} # Per deployment overrides, e.g. {"gpt-4o": {"concurrency": 32, "rpm": 480, "tpm": 80000}}
+    LLM_QUEUE_TIMEOUT = 10 # Seconds to wait for a free slot before answering 503
+    LLM_RATE_MAX_WAIT = 5 # Seconds a call may wait for quota before answering 429
+    LLM_MAX_RETRIES = 2
+    LLM_RETRY_BASE_DELAY = 0.5 # Seconds; backoff is random in [0, base * 2^attempt]
+    LLM_RETRY_MAX_DELAY = 8 # Longer Retry-After than this: give up instead of holding the request
+    LLM_RETRY_BUDGET = 0.2 # Retries earned per call
+    LLM_RETRY_BUDGET_BURST = 10
+    LLM_BREAKER_FAILURES = 5 # Failures in a row before failing fast
+    LLM_BREAKER_RESET_SECONDS = 30
+
+    # Chat context window (see chat_context.py)
+    # Prompt token budget per deployment; anything older is folded into a rolling summary
+    CHAT_CONTEXT_TOKEN_BUDGETS = {
+        "gpt-4o": 6000,
+        "gpt-35-turbo": 3000,
+    }
+    CHAT_CONTEXT_DEFAULT_TOKEN_BUDGET = int(os.environ.get('CHAT_CONTEXT_TOKEN_BUDGET', 4000))
+    CHAT_CONTEXT_MAX_MESSAGES = int(os.environ.get('CHAT_CONTEXT_MAX_MESSAGES', 200)) # Max rows read per turn
+    CHAT_CONTEXT_LOW_WATERMARK = 0.75 # When over budget, trim the window to this fraction of it
+    CHAT_CONTEXT_SUMMARY_MAX_TOKENS = 250
+    PROMPT_CACHE_MAX_ENTRIES = 1024 # Rendered system prompts kept (see prompts.py)
+
+    # 'translate <phrase>' lookups (see phrase_cache.py)
+    PHRASE_MAX_CHARS = 200 # Longer requests go through a normal chat turn
+    PHRASE_MAX_TOKENS = 120
+    PHRASE_CACHE_MAX_ENTRIES = int(os.environ.get('PHRASE_CACHE_MAX_ENTRIES', 10000))
+    PHRASE_CACHE_TTL = int(os.environ.get('PHRASE_CACHE_TTL', 7 * 24 * 3600)) # Seconds
+    PHRASE_CACHE_DB = os.environ.get('PHRASE_CACHE_DB') # Optional SQLite file shared by all workers
+    PHRASE_CACHE_DB_MAX_ENTRIES = int(os.environ.get('PHRASE_CACHE_DB_MAX_ENTRIES', 200000))
+
+    # In-process conversation history cache (see history_cache.py), LRU-evicted above this size
+    HISTORY_CACHE_MAX_BYTES = int(os.environ.get('HISTORY_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+    # On-disk TTS audio cache (see tts_cache.py), least recently played files deleted above this size
+    TTS_CACHE_DIR = os.environ.get('TTS_CACHE_DIR') or os.path.join(basedir, 'tts_cache')
+    TTS_CACHE_MAX_BYTES = int(os.environ.get('TTS_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+    # Archiving idle conversations + Message partitioning (see retention.py)
+    RETENTION_IDLE_DAYS = int(os.environ.get('RETENTION_IDLE_DAYS', 90)) # Days without a message before a conversation is archived
+    RETENTION_BATCH_SIZE = 100 # Idle conversations looked up per query
+    RETENTION_COMPRESSION_LEVEL = 6 # zlib, 1 (fast) to 9 (small)
+    MESSAGE_PARTITION_MONTHS_AHEAD = int(os.environ.get('MESSAGE_PARTITION_MONTHS_AHEAD', 3)) # PostgreSQL only
+
+    # Bulk export / import (see data_transfer.py)
+    DATA_TRANSFER_ENABLED = os.environ.get('DATA_TRANSFER_ENABLED', '0') == '1' # The HTTP endpoints; `flask data` always works
+    DATA_TRANSFER_BATCH_SIZE = int(os.environ.get('DATA_TRANSFER_BATCH_SIZE', 1000)) # Rows per fetch / insert
+    DATA_IMPORT_MAX_BYTES = int(os.environ.get('DATA_IMPORT_MAX_BYTES', 4 * 1024 * 1024 * 1024)) # POST /api/data/import body
+
+    # Cache tier shared by every worker + cross-worker invalidation (see shared_cache.py)
+    SHARED_CACHE_BACKEND = os.environ.get('SHARED_CACHE_BACKEND', 'sqlite') # sqlite | redis | none
+    SHARED_CACHE_PATH = os.environ.get('SHARED_CACHE_PATH') or os.path.join(tempfile.gettempdir(), 'kairos_shared_cache.db')
+    SHARED_CACHE_URL = os.environ.get('SHARED_CACHE_URL', 'redis://localhost:6379/0') # For the redis backend
+    SHARED_CACHE_TTL = int(os.environ.get('SHARED_CACHE_TTL', 300)) # Seconds; a backstop, writes invalidate right away
+    SHARED_CACHE_L1_MAX_ENTRIES = int(os.environ.get('SHARED_CACHE_L1_MAX_ENTRIES', 10000)) # Per cache, per worker
+    SHARED_CACHE_MAX_ENTRIES = int(os.environ.get('SHARED_CACHE_MAX_ENTRIES', 200000)) # In the SQLite file
+    SHARED_CACHE_MMAP_BYTES = 64 * 1024 * 1024
+    SHARED_CACHE_EVENT_RETENTION = 3600 # Seconds of invalidation messages kept in the SQLite file
+    SHARED_CACHE_MAX_EVENTS = 100000 # Invalidation messages kept in the Redis stream
+    SHARED_CACHE_SYNC_INTERVAL = float(os.environ.get('SHARED_CACHE_SYNC_INTERVAL', 0)) # Seconds between reads of new messages; 0 = every request
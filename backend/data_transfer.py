@@ -0,0 +1,303 @@
+# Bulk export / import of users, conversations and messages as NDJSON.
+#
+# One JSON object per line, parents first:
+#   {"type": "header", "format": "kairos-export", "version": 1, "exportedAt": "..."}
+#   {"type": "user", "id": 1, "name": "...", ...}               every User column
+#   {"type": "conversation", "id": 7, "user_id": 1, ...}        every Conversation column
+#   {"type": "message", "id": 42, "conversation_id": 7, ...}    every Message column
+# Columns are read off the models, so a migration that adds one is exported without
+# changes here. Exports carry password hashes: treat the files like a database dump.
+# Archived conversations (see retention.py) are exported like the others: their
+# messages come out of the archive as plain message records.
+#
+# Memory stays flat whatever the size: rows are read through streaming (server-side)
+# cursors, DATA_TRANSFER_BATCH_SIZE at a time, and written out batch by batch. Import
+# reads the same way and inserts each batch with one executemany (Core, no ORM objects),
+# all in one transaction: a file goes in completely or not at all.
+#
+# Import keeps the ids from the file (restoring into an empty database), or with
+# new_ids gives every row a fresh id and rewires the references (adding users to a
+# database that already has some).
+#
+#   flask data export PATH [--user ID ...]      *.gz files are gzipped
+#   flask data import PATH [--new-ids]          PATH "-" reads stdin
+#   GET  /api/data/export, POST /api/data/import  (DATA_TRANSFER_ENABLED, see app.py)
+import gzip
+import json
+import sys
+import time
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import DateTime, bindparam, func, insert, select, text
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+from models import ArchivedConversation, Conversation, Message, User
+from retention import decode_messages
+
+FORMAT = "kairos-export"
+FORMAT_VERSION = 1
+TABLES = (("user", User), ("conversation", Conversation), ("message", Message)) # Parents first
+
+
+class TransferError(ValueError):
+    pass
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Can't export {type(value).__name__}")
+
+
+# --- Export ---
+def _last_ids(connection):
+    # Read children first: a message up to the last message id belongs to a conversation
+    # that existed before it (so up to the last conversation id), and so on. Rows added
+    # while the export runs are left out, and every exported row's parent is exported.
+    return {name: connection.execute(select(func.max(model.id))).scalar() or 0 for name, model in reversed(TABLES)}
+
+
+def _export_query(name, model, last_id, user_ids):
+    table = model.__table__
+    query = select(table).where(table.c.id <= last_id).order_by(table.c.id)
+    if user_ids is None:
+        return query
+    conversations = Conversation.__table__
+    if name == "user":
+        return query.where(table.c.id.in_(user_ids))
+    if name == "conversation":
+        return query.where(table.c.user_id.in_(user_ids))
+    return query.where(table.c.conversation_id.in_(
+        select(conversations.c.id).where(conversations.c.user_id.in_(user_ids))
+    ))
+
+
+def export_records(connection, user_ids=None, batch_size=1000, counts=None):
+    """Yield the header, then every row (of user_ids' data, or everything) as a dict."""
+    last_ids = _last_ids(connection)
+    yield {"type": "header", "format": FORMAT, "version": FORMAT_VERSION, "exportedAt": datetime.utcnow().isoformat()}
+    streaming = connection.execution_options(stream_results=True, yield_per=batch_size)
+    for name, model in TABLES:
+        for row in streaming.execute(_export_query(name, model, last_ids[name], user_ids)):
+            if counts is not None:
+                counts[name] = counts.get(name, 0) + 1
+            record = {"type": name, **row._mapping}
+            if name == "conversation":
+                record["archived_at"] = None # Its messages are in the file either way
+            yield record
+    for row in _archived_messages(connection, last_ids["conversation"], user_ids):
+        if counts is not None:
+            counts["message"] = counts.get("message", 0) + 1
+        yield {"type": "message", **row}
+
+
+def _archived_messages(connection, last_conversation_id, user_ids):
+    # One archive (one conversation's messages) in memory at a time
+    archives, conversations = ArchivedConversation.__table__, Conversation.__table__
+    query = select(archives.c.payload).where(archives.c.conversation_id <= last_conversation_id).order_by(archives.c.conversation_id)
+    if user_ids is not None:
+        query = query.where(archives.c.conversation_id.in_(
+            select(conversations.c.id).where(conversations.c.user_id.in_(user_ids))
+        ))
+    for payload in connection.execution_options(stream_results=True, yield_per=1).execute(query).scalars():
+        yield from decode_messages(payload, Message.__table__)
+
+
+def export_ndjson(engine, user_ids=None, batch_size=1000, counts=None):
+    """NDJSON as chunks of bytes, batch_size lines each."""
+    with engine.connect() as connection:
+        lines = []
+        for record in export_records(connection, user_ids, batch_size, counts):
+            lines.append(json.dumps(record, default=_json_default, ensure_ascii=False))
+            if len(lines) >= batch_size:
+                yield ("\n".join(lines) + "\n").encode("utf-8")
+                lines = []
+        if lines:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+# --- Import ---
+class Importer:
+    """Buffers records per table and inserts them batch_size at a time, parents first."""
+
+    def __init__(self, connection, new_ids=False, batch_size=1000):
+        self.connection = connection
+        self.new_ids = new_ids
+        self.batch_size = batch_size
+        self.counts = {name: 0 for name, _ in TABLES}
+        self._models = dict(TABLES)
+        self._pending = {name: [] for name, _ in TABLES}
+        # new_ids only: old id -> new id. Users and conversations only (messages aren't
+        # referenced, except by the few summarized_until_id values kept in _summaries)
+        self._ids = {"user": {}, "conversation": {}}
+        self._summaries = {} # old message id -> [old conversation ids summarized up to it]
+        self._summary_ids = {} # old message id -> new message id, for those
+
+    def add(self, number, record):
+        kind = record.pop("type", None)
+        if kind == "header":
+            if record.get("format") != FORMAT or record.get("version") != FORMAT_VERSION:
+                raise TransferError(f"Line {number}: not a {FORMAT} v{FORMAT_VERSION} file")
+            return
+        if kind not in self._pending:
+            raise TransferError(f"Line {number}: unknown record type {kind!r}")
+        self._pending[kind].append(self._decode(number, kind, record))
+        if len(self._pending[kind]) >= self.batch_size:
+            self._flush_through(kind)
+
+    def finish(self):
+        self._flush_through(TABLES[-1][0])
+        if self.new_ids:
+            self._restore_summaries()
+        elif self.connection.dialect.name == 'postgresql':
+            # Rows came with their ids: move the sequences past them
+            for _, model in TABLES:
+                name = model.__table__.name
+                self.connection.execute(text(
+                    f"SELECT setval(pg_get_serial_sequence('\"{name}\"', 'id'), COALESCE((SELECT MAX(id) FROM \"{name}\"), 1))"
+                ))
+        return self.counts
+
+    def _decode(self, number, kind, record):
+        columns = self._models[kind].__table__.c
+        row = {}
+        for key, value in record.items():
+            if key not in columns:
+                raise TransferError(f"Line {number}: unknown {kind} field {key!r}")
+            if value is not None and isinstance(columns[key].type, DateTime):
+                try:
+                    value = datetime.fromisoformat(value)
+                except (TypeError, ValueError):
+                    raise TransferError(f"Line {number}: {kind} {key} is not a timestamp: {value!r}")
+            row[key] = value
+        if self.new_ids:
+            self._rewire(number, kind, row)
+        return row
+
+    def _rewire(self, number, kind, row):
+        parent = {"conversation": ("user", "user_id"), "message": ("conversation", "conversation_id")}.get(kind)
+        if parent is not None:
+            parent_kind, column = parent
+            if self._pending[parent_kind]:
+                self._flush_through(parent_kind) # Buffered parents get their new ids first
+            old = row.get(column)
+            if old not in self._ids[parent_kind]:
+                raise TransferError(f"Line {number}: {kind} refers to {parent_kind} {old}, which isn't earlier in the file")
+            row[column] = self._ids[parent_kind][old]
+        if kind == "conversation" and row.get("summarized_until_id") is not None:
+            self._summaries.setdefault(row.pop("summarized_until_id"), []).append(row["id"])
+
+    def _flush_through(self, kind):
+        for name, _ in TABLES:
+            self._flush(name)
+            if name == kind:
+                return
+
+    def _flush(self, kind):
+        rows = self._pending[kind]
+        if not rows:
+            return
+        self._pending[kind] = []
+        table = self._models[kind].__table__
+        old_ids = [row.pop("id", None) for row in rows] if self.new_ids else None
+        # One executemany per run of rows with the same fields (left-out fields get their defaults)
+        start = 0
+        while start < len(rows):
+            end = start + 1
+            while end < len(rows) and rows[end].keys() == rows[start].keys():
+                end += 1
+            if not self.new_ids:
+                self.connection.execute(insert(table), rows[start:end])
+            else:
+                new_ids = self.connection.execute(
+                    insert(table).returning(table.c.id, sort_by_parameter_order=True), rows[start:end]
+                ).scalars().all()
+                pairs = zip(old_ids[start:end], new_ids)
+                if kind in self._ids:
+                    self._ids[kind].update(pairs)
+                else:
+                    self._summary_ids.update((old, new) for old, new in pairs if old in self._summaries)
+            start = end
+        self.counts[kind] += len(rows)
+
+    def _restore_summaries(self):
+        updates = [
+            {"conversation_id": self._ids["conversation"][conversation], "message_id": self._summary_ids[message]}
+            for message, conversations in self._summaries.items() if message in self._summary_ids
+            for conversation in conversations
+        ]
+        if updates:
+            table = Conversation.__table__
+            self.connection.execute(
+                table.update().where(table.c.id == bindparam("conversation_id")).values(summarized_until_id=bindparam("message_id")),
+                updates
+            )
+
+
+def import_ndjson(engine, lines, new_ids=False, batch_size=1000):
+    """Insert every record from an iterable of NDJSON lines, in one transaction. Returns counts per table."""
+    with engine.begin() as connection:
+        importer = Importer(connection, new_ids, batch_size)
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise TransferError(f"Line {number}: not JSON ({e})")
+            if not isinstance(record, dict):
+                raise TransferError(f"Line {number}: expected an object")
+            importer.add(number, record)
+        return importer.finish()
+
+
+# --- `flask data` commands ---
+data_cli = AppGroup('data', help="Export / import users, conversations and messages as NDJSON.")
+
+
+def _open(path, mode):
+    if path == '-':
+        return sys.stdin.buffer
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _summary(counts):
+    return ", ".join(f"{counts.get(name, 0)} {name}s" for name, _ in TABLES)
+
+
+@data_cli.command('export')
+@click.argument('path') # Not stdout: the app prints to it while starting
+@click.option('--user', 'user_ids', type=int, multiple=True, help="Only this user's data (repeatable).")
+def export_command(path, user_ids):
+    """Write users, conversations and messages to PATH."""
+    started = time.perf_counter()
+    counts = {}
+    with _open(path, 'wb') as out:
+        for chunk in export_ndjson(db.engine, list(user_ids) or None, current_app.config['DATA_TRANSFER_BATCH_SIZE'], counts):
+            out.write(chunk)
+    click.echo(f"✅ Exported {_summary(counts)} in {time.perf_counter() - started:.1f}s")
+
+
+@data_cli.command('import')
+@click.argument('path')
+@click.option('--new-ids', is_flag=True, help="Give every row a new id (the database already has data).")
+def import_command(path, new_ids):
+    """Insert users, conversations and messages from PATH ("-" for stdin)."""
+    started = time.perf_counter()
+    source = _open(path, 'rb')
+    try:
+        counts = import_ndjson(db.engine, source, new_ids, current_app.config['DATA_TRANSFER_BATCH_SIZE'])
+    except TransferError as e:
+        raise click.ClickException(str(e))
+    except IntegrityError as e:
+        raise click.ClickException(f"Rows conflict with existing data (use --new-ids to add them as new rows): {e.orig}")
+    finally:
+        if path != '-':
+            source.close()
+    click.echo(f"✅ Imported {_summary(counts)} in {time.perf_counter() - started:.1f}s")
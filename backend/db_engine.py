@@ -0,0 +1,88 @@
+# Database engine setup and connection pool metrics.
+#
+# Engine options (pool sizing, pre-ping, ...) come from Config.SQLALCHEMY_ENGINE_OPTIONS.
+# Here we add what can only be done on the engine itself:
+#   - SQLite pragmas (WAL, synchronous, busy_timeout) on every new connection
+#   - pool event listeners that count checkouts, so we can see pool pressure
+import threading
+import time
+
+from sqlalchemy import event
+
+
+class PoolMonitor:
+    def __init__(self):
+        self.engine = None
+        self._lock = threading.Lock()
+        self._checked_out_at = {} # id(dbapi connection) -> checkout time
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidated = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.total_hold_seconds = 0.0
+
+    def init_app(self, app, db):
+        with app.app_context():
+            self.engine = db.engine
+
+        if self.engine.dialect.name == 'sqlite':
+            pragmas = app.config['SQLITE_PRAGMAS']
+            event.listen(self.engine, 'connect', lambda dbapi_conn, record: self._set_pragmas(dbapi_conn, pragmas))
+
+        event.listen(self.engine, 'connect', self._on_connect)
+        event.listen(self.engine, 'checkout', self._on_checkout)
+        event.listen(self.engine, 'checkin', self._on_checkin)
+        event.listen(self.engine, 'invalidate', self._on_invalidate)
+        app.extensions['pool_monitor'] = self
+
+    @staticmethod
+    def _set_pragmas(dbapi_conn, pragmas):
+        cursor = dbapi_conn.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    def _on_connect(self, dbapi_conn, record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_conn, record, proxy):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+            self._checked_out_at[id(dbapi_conn)] = time.perf_counter()
+
+    def _on_checkin(self, dbapi_conn, record):
+        with self._lock:
+            started = self._checked_out_at.pop(id(dbapi_conn), None)
+            if started is None:
+                return # Connection was never checked out through us (e.g. invalidated)
+            self.checkins += 1
+            self.checked_out -= 1
+            self.total_hold_seconds += time.perf_counter() - started
+
+    def _on_invalidate(self, dbapi_conn, record, exception):
+        with self._lock:
+            self.invalidated += 1
+
+    def stats(self):
+        pool = self.engine.pool
+        with self._lock:
+            stats = {
+                "dialect": self.engine.dialect.name,
+                "pool": pool.__class__.__name__,
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkedOut": self.checked_out,
+                "peakCheckedOut": self.peak_checked_out,
+                "invalidated": self.invalidated,
+                "avgHoldMs": round(1000 * self.total_hold_seconds / self.checkins, 2) if self.checkins else None
+            }
+        # QueuePool-only details (pool size and how far into overflow we are)
+        if hasattr(pool, 'size') and hasattr(pool, 'overflow'):
+            stats["size"] = pool.size()
+            stats["overflow"] = pool.overflow()
+        return stats
@@ -1,7 +1,36 @@
 from flask_sqlalchemy import SQLAlchemy # Holds database elements to be imported by models and app.py
-from flask_bcrypt import Bcrypt
-from flask_migrate import Migrate
+from history_cache import HistoryCache
+from tts_cache import AudioCache
+from speech_pool import SpeechPool
+from prompts import PromptCache
+from db_engine import PoolMonitor
+from password_hasher import PasswordHasher
+from rate_limit import AuthRateLimiter
+from auth_tokens import TokenService
+from phrase_cache import PhraseCache
+from llm_gateway import LLMGateway
+from jobs import JobQueue
+from instrumentation import Instrumentation
+from startup import Startup
+from shared_cache import SharedCache
+from retention import Retention
+from single_flight import SingleFlight
 
 db = SQLAlchemy()
-bcrypt = Bcrypt()
-migrate = Migrate()
\ No newline at end of file
+shared_cache = SharedCache() # Shared cache tier + cross-worker invalidation (see shared_cache.py)
+history_cache = HistoryCache() # Per-process conversation history cache (see history_cache.py)
+tts_cache = AudioCache() # On-disk cache of synthesized speech (see tts_cache.py)
+tts_flights = SingleFlight("tts") # One Azure synthesis per text + voice at a time (see single_flight.py)
+speech_pool = SpeechPool() # Warm Azure Speech synthesizers/configs (see speech_pool.py)
+prompt_cache = PromptCache() # Rendered system prompts (see prompts.py)
+pool_monitor = PoolMonitor() # SQLite pragmas + connection pool metrics (see db_engine.py)
+password_hasher = PasswordHasher() # bcrypt in worker processes (see password_hasher.py)
+auth_rate_limiter = AuthRateLimiter() # Per-IP / per-email limits on login + register (see rate_limit.py)
+token_service = TokenService() # Signed access/refresh tokens (see auth_tokens.py)
+phrase_cache = PhraseCache() # Cached 'translate <phrase>' answers (see phrase_cache.py)
+llm_gateway = LLMGateway() # Concurrency, rate limits, retries + breaker for Azure OpenAI (see llm_gateway.py)
+job_queue = JobQueue() # Background TTS / image jobs (see jobs.py)
+instrumentation = Instrumentation() # Request timings, /metrics and the sampling profiler (see instrumentation.py)
+startup = Startup() # Startup timings, first-request tasks and warm-up (see startup.py)
+retention = Retention() # Archiving idle conversations + rehydrating them on use (see retention.py)
+settings_cache = shared_cache.cache("settings", channel="user") # User settings, dropped when the User row changes
@@ -0,0 +1,121 @@
+# In-process cache of conversation history, keyed by conversation_id.
+#
+# The app writes every Message itself, so instead of re-reading a conversation's
+# rows on every chat turn we keep them in memory and append to the cached copy
+# right after each commit (write-through). Least recently used conversations are
+# evicted once the cache goes over HISTORY_CACHE_MAX_BYTES.
+#
+# An entry is either:
+#   - complete: every message of the conversation (what /api/chat/history needs), or
+#   - a tail:   every message newer than the chat window's starting point
+#               (what chat_context loads with its bounded query).
+# Both are kept up to date by append(), so both stay correct.
+import threading
+from collections import OrderedDict, namedtuple
+
+# Lightweight, session-independent copy of a Message row
+CachedMessage = namedtuple('CachedMessage', ['id', 'sender', 'text', 'timestamp'])
+
+# Rough per-message overhead (tuple, datetime, ints) on top of the text itself
+MESSAGE_OVERHEAD_BYTES = 200
+
+
+def cached_message(msg):
+    return CachedMessage(msg.id, msg.sender, msg.text, msg.timestamp)
+
+
+def message_size(msg):
+    return len(msg.text or "") + MESSAGE_OVERHEAD_BYTES
+
+
+class CacheEntry:
+    def __init__(self, messages, complete):
+        self.messages = messages
+        self.complete = complete
+        self.size = sum(message_size(msg) for msg in messages)
+
+
+class HistoryCache:
+    def __init__(self):
+        self.max_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def init_app(self, app):
+        self.max_bytes = app.config['HISTORY_CACHE_MAX_BYTES']
+        app.extensions['history_cache'] = self
+
+    def get(self, conversation_id, complete=False):
+        """Cached messages (oldest first), or None on a miss.
+
+        Pass complete=True when the caller needs the whole conversation;
+        a cached tail counts as a miss then.
+        """
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is None or (complete and not entry.complete):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(conversation_id)
+            self.hits += 1
+            return list(entry.messages)
+
+    def put(self, conversation_id, messages, complete):
+        entry = CacheEntry([cached_message(msg) for msg in messages], complete)
+        with self._lock:
+            self._remove(conversation_id)
+            if entry.size > self.max_bytes:
+                return # Too big to ever fit; leave it to the database
+            self._entries[conversation_id] = entry
+            self._size += entry.size
+            self._evict()
+
+    def append(self, conversation_id, msg):
+        """Write-through for a newly committed message. No-op if the conversation isn't cached."""
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is None:
+                return
+            entry.messages.append(cached_message(msg))
+            entry.size += message_size(msg)
+            self._size += message_size(msg)
+            self._entries.move_to_end(conversation_id)
+            self._evict()
+
+    def invalidate(self, conversation_id):
+        with self._lock:
+            self._remove(conversation_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions,
+                "conversations": len(self._entries),
+                "bytes": self._size,
+                "maxBytes": self.max_bytes
+            }
+
+    # --- internal helpers, call with self._lock held ---
+    def _remove(self, conversation_id):
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None:
+            self._size -= entry.size
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._size -= entry.size
+            self.evictions += 1
@@ -0,0 +1,381 @@
+# Per-request timing, Prometheus metrics and an on-demand sampling profiler.
+#
+# Each request gets a RequestTimings, held in a ContextVar so it follows the request
+# onto other threads that run in its context (the ASGI blocking pool, see asgi.py).
+# Phases are marked in the endpoints:
+#     with span("load"):
+#         error = turn.load()
+# and two things are added without any code at the call site:
+#   db   - every SQL statement (count + time), from SQLAlchemy engine events
+#   llm  - every Azure OpenAI attempt, reported by the gateway (see llm_gateway.py)
+#
+# Where they go:
+#   - a Server-Timing header on the response (shown under "Timing" in browser dev tools),
+#     e.g.  load;dur=2.1, prompt;dur=0.4, llm;dur=812.5, commit;dur=3.0, db;dur=4.2;desc="5 queries", total;dur=823.9
+#     For streamed responses it covers the time until the response starts.
+#   - Prometheus metrics at GET /metrics: request counts and durations, phase durations,
+#     query counts and time per endpoint, upstream call durations, plus the counters from
+#     the /api/*/stats endpoints
+#
+# The profiler (PROFILER_ENABLED=1 only) samples every thread's stack in this worker every
+# PROFILER_INTERVAL seconds and returns "folded" stacks, the input of flamegraph.pl and
+# speedscope. Start/stop it with POST /api/debug/profiler/start|stop, or send the worker
+# SIGUSR2 (once to start, again to write the profile to PROFILER_OUTPUT_DIR).
+import bisect
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+NO_REQUEST = "background" # Endpoint label for work outside a request (background jobs, startup)
+MAX_STACK_DEPTH = 64
+
+_current = ContextVar('kairos_request_timings', default=None)
+
+
+# --- Metrics ---
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(DURATION_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(DURATION_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def render_family(name, kind, help_text, samples):
+    """Prometheus text format for one metric: samples is [(labels dict, value)]."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        if value is None:
+            continue
+        lines.append(f"{name}{_labels(sorted(labels.items()))} {float(value):g}")
+    return lines
+
+
+class MetricsRegistry:
+    """Counters and histograms, keyed by metric name and a sorted tuple of label pairs."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {} # name -> (kind, help, {labels: float or Histogram})
+
+    def describe(self, name, kind, help_text):
+        self._families[name] = (kind, help_text, {})
+
+    def inc(self, name, labels, amount=1):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            samples = self._families[name][2]
+            samples[key] = samples.get(key, 0) + amount
+
+    def observe(self, name, labels, seconds):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            samples = self._families[name][2]
+            histogram = samples.get(key)
+            if histogram is None:
+                histogram = samples[key] = Histogram()
+            histogram.observe(seconds)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, samples) in self._families.items():
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                for labels, value in samples.items():
+                    if kind != "histogram":
+                        lines.append(f"{name}{_labels(labels)} {value:g}")
+                        continue
+                    running = 0
+                    for bound, count in zip(list(DURATION_BUCKETS) + ["+Inf"], value.counts):
+                        running += count
+                        lines.append(f"{name}_bucket{_labels(labels, [('le', bound)])} {running}")
+                    lines.append(f"{name}_sum{_labels(labels)} {value.sum:g}")
+                    lines.append(f"{name}_count{_labels(labels)} {value.count}")
+        return lines
+
+
+registry = MetricsRegistry()
+registry.describe("kairos_http_requests_total", "counter", "Requests handled, by endpoint, method and status.")
+registry.describe("kairos_http_request_duration_seconds", "histogram", "Time until the response starts, by endpoint.")
+registry.describe("kairos_request_phase_duration_seconds", "histogram", "Time spent in each phase of a request (spans), by endpoint.")
+registry.describe("kairos_db_queries_total", "counter", "SQL statements executed, by endpoint.")
+registry.describe("kairos_db_query_duration_seconds_total", "counter", "Time spent executing SQL statements, by endpoint.")
+registry.describe("kairos_upstream_call_duration_seconds", "histogram", "Azure OpenAI attempts, by deployment and kind (stream = until streaming starts).")
+
+
+# --- Per-request timings ---
+class RequestTimings:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.phases = {} # name -> seconds, in the order they first ran
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self._lock = threading.Lock() # Steps of one request can run on different threads
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def add_query(self, seconds):
+        with self._lock:
+            self.db_queries += 1
+            self.db_seconds += seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        with self._lock:
+            entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.phases.items()]
+            if self.db_queries:
+                entries.append(f'db;dur={self.db_seconds * 1000:.1f};desc="{self.db_queries} queries"')
+        entries.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(entries)
+
+
+def record_phase(name, seconds):
+    """Add time to a phase of the current request (no-op outside a request)."""
+    timings = _current.get()
+    if timings is None:
+        return
+    timings.add(name, seconds)
+    registry.observe("kairos_request_phase_duration_seconds", {"endpoint": timings.endpoint, "phase": name}, seconds)
+
+
+@contextmanager
+def span(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - started)
+
+
+def record_upstream(deployment, kind, seconds):
+    """One Azure OpenAI attempt (called by the gateway), including failed ones."""
+    registry.observe("kairos_upstream_call_duration_seconds", {"deployment": deployment or "", "kind": kind}, seconds)
+    record_phase("llm", seconds)
+
+
+# --- Profiler ---
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Samples the stacks of every thread in this process from a background thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.samples = Counter() # folded stack -> times seen
+        self.ticks = 0
+        self.interval = 0.0
+        self.started_at = None
+        self.stopped_at = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval, max_seconds):
+        """Start sampling (for at most max_seconds). False if it's already running."""
+        with self._lock:
+            if self.running:
+                return False
+            self.samples = Counter()
+            self.ticks = 0
+            self.interval = interval
+            self.started_at = time.time()
+            self.stopped_at = None
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval, time.monotonic() + max_seconds), name="kairos-profiler", daemon=True)
+            self._thread.start()
+            return True
+
+    def _run(self, interval, deadline):
+        own = threading.get_ident()
+        while not self._stop.wait(interval) and time.monotonic() < deadline:
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stacks.append(";".join(reversed(stack)))
+            with self._lock:
+                self.samples.update(stacks)
+                self.ticks += 1
+        self.stopped_at = time.time()
+
+    def stop(self):
+        """Stop sampling and return the folded stacks."""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+        return self.folded()
+
+    def folded(self):
+        with self._lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def status(self):
+        with self._lock:
+            return {
+                "running": self.running,
+                "interval": self.interval,
+                "startedAt": self.started_at,
+                "stoppedAt": self.stopped_at,
+                "ticks": self.ticks,
+                "stacks": len(self.samples)
+            }
+
+
+# --- Extension ---
+class Instrumentation:
+    def __init__(self):
+        self.config = {}
+        self.enabled = False
+        self.profiler = SamplingProfiler()
+        self._collectors = []
+
+    def init_app(self, app, db):
+        self.config = app.config
+        self.enabled = app.config['METRICS_ENABLED']
+        if self.enabled:
+            app.before_request(self._before_request)
+            app.after_request(self._after_request)
+            app.teardown_request(self._teardown_request)
+            with app.app_context():
+                engine = db.engine
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        if app.config['PROFILER_ENABLED']:
+            self._install_signal_toggle()
+        app.extensions['instrumentation'] = self
+
+    def add_collector(self, collect):
+        """collect() -> [(name, kind, help, [(labels dict, value)])], read on every /metrics scrape."""
+        if collect not in self._collectors:
+            self._collectors.append(collect)
+
+    # --- Requests ---
+    def start(self, endpoint):
+        """Begin timing a request. Returns (timings, token for finish())."""
+        timings = RequestTimings(endpoint)
+        return timings, _current.set(timings)
+
+    def finish(self, timings, method, status):
+        """Record the request's metrics. Returns the Server-Timing header value, or None."""
+        registry.inc("kairos_http_requests_total", {"endpoint": timings.endpoint, "method": method, "status": str(status)})
+        registry.observe("kairos_http_request_duration_seconds", {"endpoint": timings.endpoint}, timings.elapsed())
+        return timings.server_timing() if self.config['SERVER_TIMING_HEADER'] else None
+
+    def _before_request(self):
+        from flask import g, request
+        endpoint = (request.endpoint or "unmatched").rpartition('.')[2] # "api.process_message" -> "process_message"
+        g.request_timings, g.request_timings_token = self.start(endpoint)
+
+    def _after_request(self, response):
+        from flask import g, request
+        timings = g.get('request_timings')
+        if timings is not None:
+            header = self.finish(timings, request.method, response.status_code)
+            if header:
+                response.headers['Server-Timing'] = header
+                response.headers['Timing-Allow-Origin'] = '*' # Let the frontend read it (PerformanceServerTiming)
+        return response
+
+    def _teardown_request(self, exc):
+        from flask import g
+        token = g.pop('request_timings_token', None)
+        if token is None:
+            return
+        try:
+            _current.reset(token)
+        except ValueError:
+            _current.set(None) # Streamed body finished in another context (e.g. a2wsgi's threads)
+
+    # --- SQL ---
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # On the statement's own execution context: a statement that raises never gets an
+        # after_cursor_execute, and must not leave a start time behind on the connection
+        if context is not None:
+            context.kairos_query_started = time.perf_counter()
+
+    @staticmethod
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, 'kairos_query_started', None)
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        timings = _current.get()
+        endpoint = timings.endpoint if timings is not None else NO_REQUEST
+        if timings is not None:
+            timings.add_query(seconds)
+        registry.inc("kairos_db_queries_total", {"endpoint": endpoint})
+        registry.inc("kairos_db_query_duration_seconds_total", {"endpoint": endpoint}, seconds)
+
+    # --- /metrics ---
+    def render_metrics(self):
+        lines = registry.render()
+        for collect in self._collectors:
+            for name, kind, help_text, samples in collect():
+                lines += render_family(name, kind, help_text, samples)
+        return "\n".join(lines) + "\n"
+
+    # --- Profiler ---
+    def start_profiler(self, interval=None, seconds=None):
+        interval = interval or self.config['PROFILER_INTERVAL']
+        seconds = min(seconds or self.config['PROFILER_MAX_SECONDS'], self.config['PROFILER_MAX_SECONDS'])
+        return self.profiler.start(interval, seconds)
+
+    def _install_signal_toggle(self):
+        if not hasattr(signal, 'SIGUSR2') or threading.current_thread() is not threading.main_thread():
+            return
+        signal.signal(signal.SIGUSR2, self._toggle_profiler)
+
+    def _toggle_profiler(self, signum, frame):
+        if not self.profiler.running:
+            self.start_profiler()
+            print(f"✅ Profiler started in worker {os.getpid()}")
+            return
+        # Not in the handler itself: stop() joins the sampler thread
+        threading.Thread(target=self._write_profile, name="kairos-profiler-dump", daemon=True).start()
+
+    def _write_profile(self):
+        folded = self.profiler.stop()
+        path = os.path.join(self.config['PROFILER_OUTPUT_DIR'], f"kairos-{os.getpid()}-{int(time.time())}.folded")
+        with open(path, 'w') as f:
+            f.write(folded)
+        print(f"✅ Profile written to {path}")
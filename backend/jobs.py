@@ -0,0 +1,138 @@
+# In-process background jobs for slow media work (TTS pre-synthesis, image generation).
+#
+# Jobs run on a small thread pool (JOB_WORKERS), each inside a Flask app context. The
+# request that submits one gets its id back right away; clients then poll
+#   GET /api/jobs/<id>            -> {"id", "kind", "status", "result", "error"}
+#   GET /api/jobs/<id>?wait=10    -> same, but holds the request until the job finishes (or 10s pass)
+# status: queued -> running -> done | failed
+#
+# - Jobs with a key (e.g. the TTS cache key) are deduplicated: submitting the same key
+#   again while the job is queued or running returns the existing job.
+# - At most JOB_QUEUE_MAX jobs wait at once; past that, submit() returns None and the
+#   work is simply not done in the background (media is still made on demand).
+# - The last JOB_RETENTION finished jobs are kept for polling. Nothing survives a
+#   restart; everything these jobs produce is cached on disk anyway.
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class Job:
+    def __init__(self, kind, key):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.key = key
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.finished = threading.Event()
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error
+        }
+
+
+class JobQueue:
+    def __init__(self):
+        self.app = None
+        self.max_queued = 0
+        self.retention = 0
+        self._executor = None
+        self._jobs = OrderedDict() # id -> Job, oldest first
+        self._by_key = {} # key -> Job
+        self._queued = 0
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.deduplicated = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.max_queued = app.config['JOB_QUEUE_MAX']
+        self.retention = app.config['JOB_RETENTION']
+        self._executor = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'], thread_name_prefix="kairos-jobs")
+        app.extensions['job_queue'] = self
+
+    def submit(self, kind, func, *args, key=None):
+        """Run func(*args) in the background. Returns the Job, or None if the queue is full."""
+        with self._lock:
+            existing = self._by_key.get(key) if key is not None else None
+            if existing is not None and existing.status in (QUEUED, RUNNING):
+                self.deduplicated += 1
+                return existing
+            if self._queued >= self.max_queued:
+                self.dropped += 1
+                return None
+
+            job = Job(kind, key)
+            self._jobs[job.id] = job
+            if key is not None:
+                self._by_key[key] = job
+            self._queued += 1
+            self.submitted += 1
+            self._trim()
+        self._executor.submit(self._run, job, func, args)
+        return job
+
+    def _run(self, job, func, args):
+        with self._lock:
+            self._queued -= 1
+            job.status = RUNNING
+        try:
+            with self.app.app_context():
+                result = func(*args)
+            status, error = DONE, None
+        except Exception as e:
+            print(f"❌ Background {job.kind} job failed: {e}")
+            result, status, error = None, FAILED, str(e)
+
+        with self._lock:
+            job.result, job.status, job.error = result, status, error
+            job.finished_at = time.time()
+            if status == FAILED:
+                self.failed += 1
+        job.finished.set()
+
+    def _trim(self):
+        # Call with self._lock held. Forget the oldest finished jobs beyond the retention.
+        finished = sum(1 for job in self._jobs.values() if job.finished_at is not None)
+        for job_id in list(self._jobs):
+            if finished <= self.retention:
+                break
+            job = self._jobs[job_id]
+            if job.finished_at is None:
+                continue
+            del self._jobs[job_id]
+            if self._by_key.get(job.key) is job:
+                del self._by_key[job.key]
+            finished -= 1
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self._queued,
+                "tracked": len(self._jobs),
+                "submitted": self.submitted,
+                "deduplicated": self.deduplicated,
+                "dropped": self.dropped,
+                "failed": self.failed
+            }
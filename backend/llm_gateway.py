@@ -0,0 +1,551 @@
+# Gateway for every call to Azure OpenAI.
+#
+# Without it, a deployment that throttles (429) or slows down ties up every worker that
+# talks to it, and the whole service stalls behind one upstream. Per deployment (the
+# "model" argument) the gateway adds:
+#   - a concurrency bound: at most `concurrency` calls in flight; callers wait up to
+#     LLM_QUEUE_TIMEOUT for a slot, then get UpstreamBusy (503)
+#   - token buckets sized to the deployment's Azure quota, requests/minute and
+#     tokens/minute (prompt estimate + max_tokens, refunded from the real usage).
+#     A call that would wait more than LLM_RATE_MAX_WAIT gets UpstreamRateLimited (429)
+#   - retries for 429s, 5xx, timeouts and dropped connections: after the Retry-After
+#     Azure sends, or with full-jitter backoff. Retries spend from a budget that each
+#     call tops up by LLM_RETRY_BUDGET, so a bad minute doesn't multiply the load.
+#     When retrying stops, the caller gets UpstreamRateLimited (429) for a 429 and
+#     UpstreamError (503) otherwise, with Azure's Retry-After or the breaker's remaining time
+#   - a circuit breaker: after LLM_BREAKER_FAILURES failures in a row calls fail
+#     right away (CircuitOpen, 503) for LLM_BREAKER_RESET_SECONDS, then a single
+#     trial call decides whether to close it again
+#   - latency histograms per call kind ("completion", and "stream" = time until
+#     Azure starts streaming), also exported at /metrics (see instrumentation.py)
+#
+#   client = llm_gateway.wrap(AzureOpenAI(...))                # same .chat.completions.create()
+#   async_client = llm_gateway.wrap_async(AsyncAzureOpenAI(...))
+import asyncio
+import email.utils
+import random
+import threading
+import time
+from collections import deque
+
+from instrumentation import record_upstream
+
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class UpstreamError(Exception):
+    status = 503
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UpstreamBusy(UpstreamError):
+    pass
+
+
+class UpstreamRateLimited(UpstreamError):
+    status = 429
+
+
+class CircuitOpen(UpstreamError):
+    pass
+
+
+def retry_after_seconds(error):
+    """The Retry-After Azure sent with an error response, in seconds (or None)."""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        if value.isdigit():
+            return float(value)
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def request_tokens(kwargs):
+    """Tokens a chat completion call may use: prompt estimate + max_tokens."""
+    from chat_context import estimate_tokens # Not at import time: chat_context imports extensions
+    prompt = sum(estimate_tokens(message.get('content')) for message in kwargs.get('messages', ()))
+    return prompt + (kwargs.get('max_tokens') or 0)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.sum_ms = 0.0
+
+    def observe(self, seconds):
+        ms = seconds * 1000
+        index = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if ms <= bound), len(LATENCY_BUCKETS_MS))
+        self.counts[index] += 1
+        self.count += 1
+        self.sum_ms += ms
+
+    def snapshot(self):
+        # Cumulative, like Prometheus "le" buckets
+        buckets, running = {}, 0
+        for bound, count in zip(list(LATENCY_BUCKETS_MS) + ["+Inf"], self.counts):
+            running += count
+            buckets[str(bound)] = running
+        return {
+            "count": self.count,
+            "avgMs": round(self.sum_ms / self.count, 1) if self.count else None,
+            "buckets": buckets
+        }
+
+
+class TokenBucket:
+    """Refills at per_minute / 60 per second, up to per_minute. Call with the gateway lock held."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount, now):
+        """Take amount now (the level may go negative). Returns the seconds until it is covered."""
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class CircuitBreaker:
+    """closed -> open after `failures` failures in a row -> half-open after reset_seconds -> one trial call."""
+
+    def __init__(self, failures, reset_seconds):
+        self.threshold = failures
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.opens = 0
+
+    def before_call(self, now):
+        # Call with the gateway lock held
+        if self.state == "open":
+            if now < self.opened_at + self.reset_seconds:
+                raise CircuitOpen("Upstream unavailable, failing fast", retry_after=self.opened_at + self.reset_seconds - now)
+            self.state = "half-open"
+        if self.state == "half-open":
+            if self.trial_in_flight:
+                raise CircuitOpen("Upstream unavailable, failing fast", retry_after=1)
+            self.trial_in_flight = True
+
+    def record(self, ok, now):
+        """ok=True: Azure answered. ok=False: it failed. ok=None: the call never got an answer either way."""
+        self.trial_in_flight = False
+        if ok:
+            self.state = "closed"
+            self.failures = 0
+        elif ok is False:
+            self.failures += 1
+            if self.state == "half-open" or self.failures >= self.threshold:
+                if self.state != "open":
+                    self.opens += 1
+                self.state = "open"
+                self.opened_at = now
+
+
+class _Waiter:
+    def __init__(self, notify):
+        self.notify = notify
+        self.granted = False
+
+
+class Slots:
+    """FIFO counting semaphore that both threads and asyncio tasks can wait on."""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.in_use = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        self.waits = 0
+        self.rejected = 0
+
+    def _take(self):
+        # Call with self._lock held
+        if self.in_use < self.size and not self._waiters:
+            self.in_use += 1
+            return True
+        self.waits += 1
+        return False
+
+    def _give_up(self, waiter):
+        """After a wait timed out: True if the slot was handed over in the meantime."""
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            self.rejected += 1
+            return False
+
+    def acquire(self, timeout):
+        with self._lock:
+            if self._take():
+                return
+            event = threading.Event()
+            waiter = _Waiter(event.set)
+            self._waiters.append(waiter)
+        if not event.wait(timeout) and not self._give_up(waiter):
+            raise UpstreamBusy(f"Too many requests waiting for {self.name}", retry_after=1)
+
+    async def acquire_async(self, timeout):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._take():
+                return
+            future = loop.create_future()
+            waiter = _Waiter(lambda: loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None)))
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            if not self._give_up(waiter):
+                raise UpstreamBusy(f"Too many requests waiting for {self.name}", retry_after=1)
+        except asyncio.CancelledError:
+            if self._give_up(waiter):
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.granted = True # The slot goes straight to the next waiter
+                waiter.notify()
+            else:
+                self.in_use -= 1
+
+
+class DeploymentState:
+    def __init__(self, name, limits, config):
+        self.name = name
+        self.slots = Slots(name, limits['concurrency'])
+        self.requests = TokenBucket(limits['rpm'])
+        self.tokens = TokenBucket(limits['tpm'])
+        self.breaker = CircuitBreaker(config['LLM_BREAKER_FAILURES'], config['LLM_BREAKER_RESET_SECONDS'])
+        self.retry_credits = config['LLM_RETRY_BUDGET_BURST']
+        self.histograms = {}
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.fast_failed = 0
+
+
+class GatedStream:
+    """A completion stream that gives its concurrency slot back when it ends or is closed."""
+
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+        self._released = False
+
+    def _done(self):
+        if not self._released:
+            self._released = True
+            self._release()
+
+    def __iter__(self):
+        try:
+            yield from self._stream
+        finally:
+            self._done()
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            self._done()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class GatedAsyncStream(GatedStream):
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        finally:
+            self._done()
+
+    async def close(self):
+        try:
+            await self._stream.close()
+        finally:
+            self._done()
+
+
+class _Completions:
+    def __init__(self, create):
+        self.create = create
+
+
+class _Chat:
+    def __init__(self, create):
+        self.completions = _Completions(create)
+
+
+class GatedClient:
+    """Looks like the OpenAI client for chat completions; everything else goes straight through."""
+
+    def __init__(self, client, create):
+        self._client = client
+        self.chat = _Chat(create)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class LLMGateway:
+    def __init__(self):
+        self.config = {}
+        self._deployments = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.config = app.config
+        app.extensions['llm_gateway'] = self
+
+    def wrap(self, client):
+        # The gateway does the retrying; one HTTP attempt per call from the SDK
+        client = client.with_options(timeout=self.config['LLM_TIMEOUT'], max_retries=0)
+        return GatedClient(client, lambda **kwargs: self.call(client.chat.completions.create, kwargs))
+
+    def wrap_async(self, client):
+        client = client.with_options(timeout=self.config['LLM_TIMEOUT'], max_retries=0)
+        return GatedClient(client, lambda **kwargs: self.acall(client.chat.completions.create, kwargs))
+
+    def _deployment(self, name):
+        with self._lock:
+            state = self._deployments.get(name)
+            if state is None:
+                limits = {
+                    "concurrency": self.config['LLM_DEFAULT_CONCURRENCY'],
+                    "rpm": self.config['LLM_DEFAULT_RPM'],
+                    "tpm": self.config['LLM_DEFAULT_TPM'],
+                    **self.config['LLM_DEPLOYMENT_LIMITS'].get(name, {})
+                }
+                state = self._deployments[name] = DeploymentState(name, limits, self.config)
+            return state
+
+    # --- Steps shared by the sync and async paths ---
+    def _check_open(self, state):
+        """Fail fast while the breaker is open, before taking any quota or waiting for it."""
+        with self._lock:
+            breaker = state.breaker
+            now = time.monotonic()
+            if breaker.state == "open" and now < breaker.opened_at + breaker.reset_seconds:
+                state.fast_failed += 1
+                raise CircuitOpen("Upstream unavailable, failing fast", retry_after=breaker.opened_at + breaker.reset_seconds - now)
+
+    def _reserve(self, state, tokens):
+        """Take quota for one attempt. Returns the seconds to wait before sending it."""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(state.requests.reserve(1, now), state.tokens.reserve(tokens, now))
+            if wait > self.config['LLM_RATE_MAX_WAIT']:
+                state.requests.refund(1)
+                state.tokens.refund(tokens)
+                state.rate_limited += 1
+                raise UpstreamRateLimited(f"Rate limit for {state.name} reached", retry_after=wait)
+            return wait
+
+    def _refund(self, state, tokens):
+        # The attempt was never sent (breaker, queue timeout, cancelled): give its quota back
+        with self._lock:
+            state.requests.refund(1)
+            state.tokens.refund(tokens)
+
+    def _start(self, state):
+        """Check the breaker once a slot is held. Returns the start time."""
+        with self._lock:
+            now = time.monotonic()
+            try:
+                state.breaker.before_call(now)
+            except CircuitOpen:
+                state.fast_failed += 1
+                raise
+            state.calls += 1
+            state.retry_credits = min(self.config['LLM_RETRY_BUDGET_BURST'], state.retry_credits + self.config['LLM_RETRY_BUDGET'])
+            return now
+
+    def _observe(self, state, kind, started):
+        elapsed = time.monotonic() - started
+        with self._lock:
+            histogram = state.histograms.get(kind)
+            if histogram is None:
+                histogram = state.histograms[kind] = LatencyHistogram()
+            histogram.observe(elapsed)
+        record_upstream(state.name, kind, elapsed) # /metrics + the request's Server-Timing (see instrumentation.py)
+
+    def _succeeded(self, state, kind, started, tokens, result):
+        self._observe(state, kind, started)
+        usage = getattr(result, 'usage', None)
+        with self._lock:
+            state.breaker.record(True, time.monotonic())
+            if usage is not None and usage.total_tokens:
+                state.tokens.refund(max(0, tokens - usage.total_tokens))
+
+    def _abandoned(self, state):
+        with self._lock:
+            state.breaker.record(None, time.monotonic())
+
+    def _failed(self, state, kind, started, error, attempt):
+        """Record a failed attempt. Returns the delay before retrying, None to re-raise error (not an
+        upstream failure), or raises UpstreamError when an upstream failure won't be retried."""
+        import openai # Not at import time (see llm_providers.py); loaded by the client by now
+        retryable = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError) # APITimeoutError is an APIConnectionError
+        self._observe(state, kind, started)
+        with self._lock:
+            now = time.monotonic()
+            if not isinstance(error, retryable):
+                # Azure answered (e.g. a 400), or the error is ours: not an upstream failure
+                state.breaker.record(True if isinstance(error, openai.APIStatusError) else None, now)
+                return None
+            state.breaker.record(False, now)
+            state.failures += 1
+
+            retry_after = retry_after_seconds(error)
+            if (attempt >= self.config['LLM_MAX_RETRIES'] or state.breaker.state == "open" or state.retry_credits < 1
+                    or (retry_after is not None and retry_after > self.config['LLM_RETRY_MAX_DELAY'])):
+                if retry_after is None and state.breaker.state == "open":
+                    retry_after = state.breaker.reset_seconds
+                if isinstance(error, openai.RateLimitError):
+                    raise UpstreamRateLimited(f"Azure OpenAI is throttling {state.name}", retry_after=retry_after) from error
+                raise UpstreamError(f"Azure OpenAI unavailable for {state.name}: {error}", retry_after=retry_after) from error
+            state.retry_credits -= 1
+            state.retries += 1
+
+        base = self.config['LLM_RETRY_BASE_DELAY']
+        if retry_after is not None:
+            return retry_after + random.uniform(0, base) # Don't have every waiter come back at the same instant
+        return random.uniform(0, min(self.config['LLM_RETRY_MAX_DELAY'], base * 2 ** attempt))
+
+    # --- Calls ---
+    def call(self, create, kwargs):
+        state = self._deployment(kwargs.get('model'))
+        kind = "stream" if kwargs.get('stream') else "completion"
+        tokens = request_tokens(kwargs)
+        attempt = 0
+        while True:
+            self._check_open(state)
+            wait = self._reserve(state, tokens)
+            try:
+                if wait:
+                    time.sleep(wait)
+                state.slots.acquire(self.config['LLM_QUEUE_TIMEOUT'])
+            except BaseException:
+                self._refund(state, tokens) # UpstreamBusy, or cancelled while waiting
+                raise
+            started = None
+            try:
+                started = self._start(state)
+                result = create(**kwargs)
+            except Exception as error:
+                state.slots.release()
+                if started is None: # CircuitOpen: nothing was sent
+                    self._refund(state, tokens)
+                    raise
+                delay = self._failed(state, kind, started, error, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                # Cancelled (client went away) or interrupted mid-call
+                state.slots.release()
+                if started is not None:
+                    self._abandoned(state)
+                raise
+
+            self._succeeded(state, kind, started, tokens, result)
+            if kind == "stream":
+                return GatedStream(result, state.slots.release) # Slot held until the stream is done
+            state.slots.release()
+            return result
+
+    async def acall(self, create, kwargs):
+        state = self._deployment(kwargs.get('model'))
+        kind = "stream" if kwargs.get('stream') else "completion"
+        tokens = request_tokens(kwargs)
+        attempt = 0
+        while True:
+            self._check_open(state)
+            wait = self._reserve(state, tokens)
+            try:
+                if wait:
+                    await asyncio.sleep(wait)
+                await state.slots.acquire_async(self.config['LLM_QUEUE_TIMEOUT'])
+            except BaseException:
+                self._refund(state, tokens) # UpstreamBusy, or cancelled while waiting
+                raise
+            started = None
+            try:
+                started = self._start(state)
+                result = await create(**kwargs)
+            except Exception as error:
+                state.slots.release()
+                if started is None: # CircuitOpen: nothing was sent
+                    self._refund(state, tokens)
+                    raise
+                delay = self._failed(state, kind, started, error, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                # Cancelled (client went away) or interrupted mid-call
+                state.slots.release()
+                if started is not None:
+                    self._abandoned(state)
+                raise
+
+            self._succeeded(state, kind, started, tokens, result)
+            if kind == "stream":
+                return GatedAsyncStream(result, state.slots.release)
+            state.slots.release()
+            return result
+
+    def stats(self):
+        with self._lock:
+            deployments = list(self._deployments.values())
+            return {
+                state.name: {
+                    "inFlight": state.slots.in_use,
+                    "concurrency": state.slots.size,
+                    "queueWaits": state.slots.waits,
+                    "queueRejected": state.slots.rejected,
+                    "calls": state.calls,
+                    "failures": state.failures,
+                    "retries": state.retries,
+                    "rateLimited": state.rate_limited,
+                    "fastFailed": state.fast_failed,
+                    "breaker": state.breaker.state,
+                    "breakerOpens": state.breaker.opens,
+                    "latency": {kind: histogram.snapshot() for kind, histogram in state.histograms.items()}
+                }
+                for state in deployments
+            }
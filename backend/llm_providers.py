@@ -0,0 +1,272 @@
+# Where chat completions come from.
+#
+# Everything in the backend talks to "a client with .chat.completions.create()", the
+# OpenAI SDK interface (see chat_turn.py, chat_context.py, phrase_cache.py). LLM_PROVIDER
+# picks what stands behind it:
+#   azure - Azure OpenAI (AZURE_OPENAI_KEY / AZURE_OPENAI_ENDPOINT)
+#   mock  - a local stand-in for load tests: no network, no quota, no credentials.
+#           Replies are deterministic (the same request gives the same reply and the
+#           same latency), and timing follows the configured distributions:
+#             LLM_MOCK_FIRST_TOKEN_MS   time to first token, e.g. "lognormal:400,0.6"
+#             LLM_MOCK_REPLY_TOKENS     reply length, e.g. "uniform:20,120" (capped by max_tokens)
+#             LLM_MOCK_TOKENS_PER_SECOND  generation speed once tokens start coming
+#             LLM_MOCK_CHUNK_TOKENS     tokens per streamed chunk
+#             LLM_MOCK_ERROR_RATE       fraction of calls answered with a 429
+#           Distributions: "fixed:<v>", "uniform:<lo>,<hi>", "normal:<mean>,<stddev>",
+#           "lognormal:<median>,<sigma>".
+#
+# Clients are built on first use (LazyClient): the openai SDK takes about half a second
+# to import, and a worker shouldn't pay for it before it serves (see startup.py).
+import asyncio
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+API_VERSION = "2023-05-15"
+MOCK_WORDS = (
+    "hola", "amigo", "muy", "bien", "gracias", "por", "favor", "que", "tal", "como",
+    "estas", "hoy", "vamos", "a", "hablar", "de", "la", "comida", "el", "viaje",
+    "me", "gusta", "mucho", "tambien", "y", "tu", "donde", "vives", "ahora", "bueno",
+)
+
+
+class AzureProvider:
+    def client(self, config):
+        from openai import AzureOpenAI
+        return AzureOpenAI(
+            api_key=config['AZURE_OPENAI_KEY'],
+            api_version=API_VERSION,
+            azure_endpoint=config['AZURE_OPENAI_ENDPOINT']
+        )
+
+    def async_client(self, config):
+        from openai import AsyncAzureOpenAI
+        return AsyncAzureOpenAI(
+            api_key=config['AZURE_OPENAI_KEY'],
+            api_version=API_VERSION,
+            azure_endpoint=config['AZURE_OPENAI_ENDPOINT']
+        )
+
+
+class MockProvider:
+    def client(self, config):
+        return MockClient(MockModel(config))
+
+    def async_client(self, config):
+        return AsyncMockClient(MockModel(config))
+
+
+PROVIDERS = {
+    "azure": AzureProvider,
+    "mock": MockProvider,
+}
+
+
+def _provider(config):
+    name = config['LLM_PROVIDER']
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown LLM_PROVIDER {name!r} (expected one of {', '.join(PROVIDERS)})")
+    return PROVIDERS[name]()
+
+
+class LazyClient:
+    """Stands in for a client until something uses it, then builds it (once)."""
+
+    def __init__(self, build):
+        self._build = build
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._build()
+        return self._client
+
+    def warm(self):
+        self.get()
+
+    def with_options(self, **options):
+        return LazyClient(lambda: self.get().with_options(**options))
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def create_client(config):
+    provider = _provider(config) # Unknown provider: fail now, not on the first request
+    return LazyClient(lambda: provider.client(config))
+
+
+def create_async_client(config):
+    provider = _provider(config)
+    return LazyClient(lambda: provider.async_client(config))
+
+
+# --- Mock ---
+def parse_distribution(spec):
+    """'lognormal:400,0.6' -> function(rng) returning a sample (never negative)."""
+    kind, _, args = spec.partition(":")
+    values = [float(value) for value in args.split(",") if value.strip()]
+    samplers = {
+        "fixed": lambda rng, v: v[0],
+        "uniform": lambda rng, v: rng.uniform(v[0], v[1]),
+        "normal": lambda rng, v: rng.gauss(v[0], v[1]),
+        "lognormal": lambda rng, v: rng.lognormvariate(math.log(v[0]), v[1]),
+    }
+    if kind not in samplers:
+        raise ValueError(f"Unknown distribution {spec!r}")
+    sampler = samplers[kind]
+    return lambda rng: max(0.0, sampler(rng, values))
+
+
+class MockPlan:
+    """Everything about one mock call, decided up front from the request."""
+
+    def __init__(self, text, first_token_delay, chunk_delays, chunks, fail, prompt_tokens):
+        self.text = text
+        self.first_token_delay = first_token_delay
+        self.chunk_delays = chunk_delays
+        self.chunks = chunks
+        self.fail = fail
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = len(text.split())
+
+
+class MockModel:
+    def __init__(self, config):
+        self.seed = config['LLM_MOCK_SEED']
+        self.first_token = parse_distribution(config['LLM_MOCK_FIRST_TOKEN_MS'])
+        self.reply_tokens = parse_distribution(config['LLM_MOCK_REPLY_TOKENS'])
+        self.tokens_per_second = config['LLM_MOCK_TOKENS_PER_SECOND']
+        self.chunk_tokens = config['LLM_MOCK_CHUNK_TOKENS']
+        self.error_rate = config['LLM_MOCK_ERROR_RATE']
+
+    def plan(self, kwargs):
+        messages = kwargs.get('messages', [])
+        # Same request, same seed -> same reply, same timing
+        digest = hashlib.sha256(json.dumps([self.seed, kwargs.get('model'), messages], sort_keys=True, default=str).encode()).digest()
+        rng = random.Random(digest)
+
+        tokens = max(1, int(self.reply_tokens(rng)))
+        if kwargs.get('max_tokens'):
+            tokens = min(tokens, kwargs['max_tokens'])
+        words = [rng.choice(MOCK_WORDS) for _ in range(tokens)]
+        words[0] = words[0].capitalize()
+        chunks = [
+            (" " if i else "") + " ".join(words[i:i + self.chunk_tokens])
+            for i in range(0, tokens, self.chunk_tokens)
+        ]
+        chunk_delay = self.chunk_tokens / self.tokens_per_second
+        prompt_tokens = sum(len(str(message.get('content') or "")) // 4 + 4 for message in messages) # Same estimate as chat_context.py
+        return MockPlan(
+            text="".join(chunks) + ".",
+            first_token_delay=self.first_token(rng) / 1000,
+            chunk_delays=[chunk_delay] * (len(chunks) - 1),
+            chunks=chunks[:-1] + [chunks[-1] + "."],
+            fail=rng.random() < self.error_rate,
+            prompt_tokens=prompt_tokens
+        )
+
+
+def _throttled():
+    import httpx
+    import openai
+    request = httpx.Request("POST", "http://mock/chat/completions")
+    response = httpx.Response(429, headers={"retry-after": "1"}, request=request)
+    return openai.RateLimitError("Mock rate limit (LLM_MOCK_ERROR_RATE)", response=response, body=None)
+
+
+def _completion(plan, model):
+    return SimpleNamespace(
+        model=model,
+        choices=[SimpleNamespace(index=0, finish_reason="stop", message=SimpleNamespace(role="assistant", content=plan.text))],
+        usage=SimpleNamespace(
+            prompt_tokens=plan.prompt_tokens,
+            completion_tokens=plan.completion_tokens,
+            total_tokens=plan.prompt_tokens + plan.completion_tokens
+        )
+    )
+
+
+def _chunk(content):
+    if content is None:
+        return SimpleNamespace(choices=[]) # Like Azure's first chunk: content-filter results only
+    return SimpleNamespace(choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=content))])
+
+
+class MockStream:
+    def __init__(self, plan):
+        self.plan = plan
+        self.closed = False
+
+    def __iter__(self):
+        yield _chunk(None)
+        for i, content in enumerate(self.plan.chunks):
+            if self.closed:
+                return
+            if i:
+                time.sleep(self.plan.chunk_delays[i - 1])
+            yield _chunk(content)
+
+    def close(self):
+        self.closed = True
+
+
+class AsyncMockStream(MockStream):
+    async def __aiter__(self):
+        yield _chunk(None)
+        for i, content in enumerate(self.plan.chunks):
+            if self.closed:
+                return
+            if i:
+                await asyncio.sleep(self.plan.chunk_delays[i - 1])
+            yield _chunk(content)
+
+    async def close(self):
+        self.closed = True
+
+
+class _Completions:
+    def __init__(self, create):
+        self.create = create
+
+
+class MockClient:
+    """Synchronous stand-in for AzureOpenAI."""
+
+    def __init__(self, model):
+        self.model = model
+        self.chat = SimpleNamespace(completions=_Completions(self._create))
+
+    def with_options(self, **options):
+        return self # Timeouts / retries don't apply
+
+    def _create(self, **kwargs):
+        plan = self.model.plan(kwargs)
+        time.sleep(plan.first_token_delay)
+        if plan.fail:
+            raise _throttled()
+        if kwargs.get('stream'):
+            return MockStream(plan)
+        time.sleep(sum(plan.chunk_delays))
+        return _completion(plan, kwargs.get('model'))
+
+
+class AsyncMockClient(MockClient):
+    """Asynchronous stand-in for AsyncAzureOpenAI."""
+
+    async def _create(self, **kwargs):
+        plan = self.model.plan(kwargs)
+        await asyncio.sleep(plan.first_token_delay)
+        if plan.fail:
+            raise _throttled()
+        if kwargs.get('stream'):
+            return AsyncMockStream(plan)
+        await asyncio.sleep(sum(plan.chunk_delays))
+        return _completion(plan, kwargs.get('model'))
@@ -0,0 +1,25 @@
+"""add (conversation_id, timestamp) index on message
+
+Revision ID: b71d05e9c3a2
+Revises: 8c4e2d6a1b35
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b71d05e9c3a2'
+down_revision = '8c4e2d6a1b35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.create_index('ix_message_conversation_id_timestamp', ['conversation_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_index('ix_message_conversation_id_timestamp')
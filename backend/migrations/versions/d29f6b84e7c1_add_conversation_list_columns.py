@@ -0,0 +1,51 @@
+"""add denormalized last_message_at, message_count, last_message_preview to conversation
+
+Revision ID: d29f6b84e7c1
+Revises: b71d05e9c3a2
+Create Date: 2026-10-18 10:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd29f6b84e7c1'
+down_revision = 'b71d05e9c3a2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('last_message_at', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('message_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('last_message_preview', sa.String(length=120), nullable=True))
+
+    # Backfill from the existing messages
+    op.execute("""
+        UPDATE conversation SET
+            message_count = (SELECT COUNT(*) FROM message WHERE message.conversation_id = conversation.id),
+            last_message_at = COALESCE(
+                (SELECT MAX(message.timestamp) FROM message WHERE message.conversation_id = conversation.id),
+                conversation.start_time
+            ),
+            last_message_preview = (
+                SELECT SUBSTR(message.text, 1, 120) FROM message
+                WHERE message.conversation_id = conversation.id
+                ORDER BY message.timestamp DESC, message.id DESC
+                LIMIT 1
+            )
+    """)
+
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.alter_column('last_message_at', existing_type=sa.DateTime(), nullable=False)
+        batch_op.create_index('ix_conversation_user_id_last_message_at', ['user_id', 'last_message_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.drop_index('ix_conversation_user_id_last_message_at')
+        batch_op.drop_column('last_message_preview')
+        batch_op.drop_column('message_count')
+        batch_op.drop_column('last_message_at')
@@ -0,0 +1,39 @@
+"""add archived_conversation table and conversation.archived_at
+
+Revision ID: f3b8e1d4c6a9
+Revises: e4a7c3f0b912
+Create Date: 2026-10-18 18:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b8e1d4c6a9'
+down_revision = 'e4a7c3f0b912'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('archived_conversation',
+    sa.Column('conversation_id', sa.Integer(), nullable=False),
+    sa.Column('archived_at', sa.DateTime(), nullable=False),
+    sa.Column('message_count', sa.Integer(), nullable=False),
+    sa.Column('raw_bytes', sa.Integer(), nullable=False),
+    sa.Column('payload', sa.LargeBinary(), nullable=False),
+    sa.ForeignKeyConstraint(['conversation_id'], ['conversation.id'], ),
+    sa.PrimaryKeyConstraint('conversation_id')
+    )
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('archived_at', sa.DateTime(), nullable=True))
+        batch_op.create_index('ix_conversation_last_message_at', ['last_message_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.drop_index('ix_conversation_last_message_at')
+        batch_op.drop_column('archived_at')
+
+    op.drop_table('archived_conversation')
@@ -12,6 +12,8 @@ class User(db.Model):
     fluency_level = db.Column(db.String(50), nullable=True) # Optional for now
     conversations = db.relationship('Conversation', backref='user', lazy=True)
     topic = db.Column(db.String(100), default="General")
+    # Bumped when a claim in the user's tokens changes; older tokens stop working (see auth_tokens.py)
+    token_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     # Add methods for setting and checking password later
     # Example: def set_password(self, password): ...
@@ -24,14 +26,45 @@ class User(db.Model):
 
 
 # Models for Scrum-38 (Conversation and Message)
+PREVIEW_LENGTH = 120 # Characters of the last message shown in the conversation list
+
 class Conversation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) # Link to User table
     start_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow) # Timestamp when conversation started
     topic = db.Column(db.String(100), nullable=True) # Optional: Store the topic
+    # Rolling summary of older messages that no longer fit in the prompt window (see chat_context.py)
+    summary = db.Column(db.Text, nullable=True)
+    summarized_until_id = db.Column(db.Integer, nullable=True) # id of the last Message folded into summary
+    # Denormalized for the conversation list, kept up to date by record_messages()
+    last_message_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    message_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_message_preview = db.Column(db.String(PREVIEW_LENGTH), nullable=True)
+    # Set while the messages live in ArchivedConversation instead of Message (see retention.py)
+    archived_at = db.Column(db.DateTime, nullable=True)
     # Define the relationship to Message (one Conversation has many Messages)
     messages = db.relationship('Message', backref='conversation', lazy=True, cascade="all, delete-orphan") # cascade ensures messages are deleted if conversation is deleted
 
+    # Listing a user's conversations, most recently active first
+    __table_args__ = (
+        db.Index('ix_conversation_user_id_last_message_at', 'user_id', 'last_message_at'),
+        db.Index('ix_conversation_last_message_at', 'last_message_at'), # Finding idle conversations to archive
+    )
+
+    def record_messages(self, *messages):
+        """Update the summary columns for new messages (oldest first), in the transaction that adds them."""
+        for message in messages:
+            if message.timestamp is None:
+                message.timestamp = datetime.utcnow()
+        last = messages[-1]
+        self.last_message_at = last.timestamp
+        self.last_message_preview = (last.text or "")[:PREVIEW_LENGTH]
+        if self.id is None:
+            self.message_count = (self.message_count or 0) + len(messages) # Not inserted yet
+        else:
+            # SQL-side increment so concurrent turns in one conversation don't lose counts
+            self.message_count = Conversation.message_count + len(messages)
+
     def __repr__(self):
         return f'<Conversation {self.id} started by User {self.user_id}>'
 
@@ -42,5 +75,22 @@ class Message(db.Model):
     text = db.Column(db.Text, nullable=False) # The actual message content
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow) # Timestamp when message was sent
 
+    # History is always read per conversation in time order (chat context + paginated history)
+    __table_args__ = (
+        db.Index('ix_message_conversation_id_timestamp', 'conversation_id', 'timestamp'),
+    )
+
+    def __repr__(self):
+        return f'<Message {self.id} from {self.sender} in Conversation {self.conversation_id}>'
+
+
+class ArchivedConversation(db.Model):
+    """The Message rows of an idle conversation, compressed into one row (see retention.py)."""
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), primary_key=True)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    message_count = db.Column(db.Integer, nullable=False)
+    raw_bytes = db.Column(db.Integer, nullable=False) # Size before compression
+    payload = db.Column(db.LargeBinary, nullable=False)
+
     def __repr__(self):
-        return f'<Message {self.id} from {self.sender} in Conversation {self.conversation_id}>'
\ No newline at end of file
+        return f'<ArchivedConversation {self.conversation_id}: {self.message_count} messages>'
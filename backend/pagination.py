@@ -0,0 +1,86 @@
+# Keyset (cursor) pagination for chat history and conversation lists.
+#
+# Rows are ordered by (timestamp, id). A cursor is an opaque string that encodes
+# the (timestamp, id) of a row, and a page is "the next N rows before/after
+# this cursor". Unlike OFFSET paging this stays a single index range scan
+# (e.g. on message (conversation_id, timestamp)) no matter how far back the client scrolls.
+import base64
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+from models import Conversation, Message
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+class CursorError(ValueError):
+    pass
+
+
+def encode_cursor(timestamp, row_id):
+    raw = f"{timestamp.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        timestamp, row_id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except Exception:
+        raise CursorError(f"Invalid cursor: {cursor}")
+
+
+def parse_page_size(value):
+    if value is None:
+        return DEFAULT_PAGE_SIZE
+    try:
+        size = int(value)
+    except ValueError:
+        raise CursorError(f"Invalid page size: {value}")
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def page_from_query(conversation_id, limit, before=None, after=None):
+    """Fetch one page from the database. Returns (messages oldest first, has_more)."""
+    query = Message.query.filter(Message.conversation_id == conversation_id)
+
+    if after:
+        ts, msg_id = after
+        query = query.filter(or_(Message.timestamp > ts, and_(Message.timestamp == ts, Message.id > msg_id)))
+        rows = query.order_by(Message.timestamp.asc(), Message.id.asc()).limit(limit + 1).all()
+        return rows[:limit], len(rows) > limit
+
+    if before:
+        ts, msg_id = before
+        query = query.filter(or_(Message.timestamp < ts, and_(Message.timestamp == ts, Message.id < msg_id)))
+
+    # Latest page first: read newest-first, then flip back to chronological order
+    rows = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit + 1).all()
+    return list(reversed(rows[:limit])), len(rows) > limit
+
+
+def page_from_list(messages, limit, before=None, after=None):
+    """Same as page_from_query, for an in-memory list of messages (oldest first)."""
+    if after:
+        newer = [msg for msg in messages if (msg.timestamp, msg.id) > after]
+        return newer[:limit], len(newer) > limit
+
+    if before:
+        messages = [msg for msg in messages if (msg.timestamp, msg.id) < before]
+    return messages[-limit:], len(messages) > limit
+
+
+def conversations_page(user_id, limit, before=None):
+    """A user's conversations, most recently active first. Returns (conversations, has_more)."""
+    query = Conversation.query.filter(Conversation.user_id == user_id)
+    if before:
+        ts, convo_id = before
+        query = query.filter(or_(
+            Conversation.last_message_at < ts,
+            and_(Conversation.last_message_at == ts, Conversation.id < convo_id)
+        ))
+    rows = query.order_by(Conversation.last_message_at.desc(), Conversation.id.desc()).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
@@ -0,0 +1,153 @@
+# bcrypt off the request threads.
+#
+# A bcrypt hash at the default cost is a few hundred milliseconds of pure CPU, and in
+# the web process that CPU (and the GIL around it) is taken from the chat, TTS and STT
+# requests. Hashing and checking run in a small pool of worker processes instead:
+#   - PASSWORD_HASH_WORKERS processes, created on first use in each server process
+#   - at most PASSWORD_HASH_MAX_PENDING jobs queued or running; past that, callers get
+#     HasherBusy right away (503) instead of piling up behind a login burst; so does a
+#     job the pool doesn't finish within PASSWORD_HASH_TIMEOUT
+#   - the cost factor is BCRYPT_LOG_ROUNDS (same key as Flask-Bcrypt). verify() hands
+#     back a new hash when a stored one was made with another cost, so existing
+#     accounts move to the new cost the next time they log in.
+# Workers are spawned, not forked (fork isn't available on Windows, and forking a server
+# process copies its pool, job and SDK threads' locks mid-use). A spawned worker imports
+# this module, and re-imports the server's __main__ module as multiprocessing always
+# does: the flask / gunicorn / uvicorn launcher, or app.py under `python app.py`, which
+# only builds the app behind its __main__ guard. Scripts that start the app themselves
+# need that guard too. If the pool can't be used, hashing runs on the request thread, so
+# sign-ins get slower instead of failing.
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+
+class HasherBusy(Exception):
+    pass
+
+
+def hash_cost(pw_hash):
+    """Cost factor of a '$2b$12$...' hash, or None if it isn't a bcrypt hash."""
+    parts = pw_hash.split('$')
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
+# --- Run in the worker processes ---
+def _hash(password, rounds, prefix):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds, prefix)).decode('utf-8')
+
+
+def _verify(pw_hash, password, rounds, prefix):
+    try:
+        ok = bcrypt.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+    except ValueError:
+        return False, None # Not a bcrypt hash (e.g. the default user's placeholder)
+    if ok and hash_cost(pw_hash) != rounds:
+        return True, _hash(password, rounds, prefix)
+    return ok, None
+
+
+class PasswordHasher:
+    def __init__(self):
+        self.config = {}
+        self._executor = None
+        self._executor_pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+        self.rehashed = 0
+        self.inline = 0 # Hashed on the request thread because the pool was unusable
+        self.timeouts = 0
+
+    def init_app(self, app):
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        app.config.setdefault('BCRYPT_HASH_PREFIX', '2b')
+        self.config = app.config
+        self._slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_MAX_PENDING'])
+        app.extensions['password_hasher'] = self
+
+    @property
+    def rounds(self):
+        return self.config['BCRYPT_LOG_ROUNDS']
+
+    def _pool(self):
+        # One pool per server process: a pool inherited through a fork (gunicorn
+        # --preload, the debug reloader) has no manager thread and can't be used.
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.config['PASSWORD_HASH_WORKERS'],
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HasherBusy("Too many sign-ins in progress, try again shortly")
+        try:
+            with self._lock:
+                self.submitted += 1
+            try:
+                future = self._pool().submit(func, *args)
+            except (OSError, ValueError, RuntimeError, BrokenProcessPool) as e:
+                return self._run_inline(e, func, *args)
+            try:
+                return future.result(timeout=self.config['PASSWORD_HASH_TIMEOUT'])
+            except BrokenProcessPool as e: # A worker died (or couldn't start)
+                return self._run_inline(e, func, *args)
+            except FutureTimeout:
+                future.cancel() # Still queued: don't hash for nobody
+                with self._lock:
+                    self.timeouts += 1
+                raise HasherBusy("Sign-in is taking too long, try again shortly")
+        finally:
+            self._slots.release()
+
+    def _run_inline(self, error, func, *args):
+        with self._lock:
+            if not self.inline:
+                print(f"❌ Password hashing pool unavailable, hashing on request threads: {error!r}")
+            self.inline += 1
+            if self._executor is not None and self._executor_pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None # Try a new pool next time
+        return func(*args)
+
+    def hash(self, password):
+        return self._run(_hash, password, self.rounds, self.config['BCRYPT_HASH_PREFIX'].encode('ascii'))
+
+    def verify(self, pw_hash, password):
+        """Check a password. Returns (matches, new hash to store or None)."""
+        ok, new_hash = self._run(_verify, pw_hash, password, self.rounds, self.config['BCRYPT_HASH_PREFIX'].encode('ascii'))
+        if new_hash:
+            with self._lock:
+                self.rehashed += 1
+        return ok, new_hash
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._executor_pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.config.get('PASSWORD_HASH_WORKERS'),
+                "rounds": self.config.get('BCRYPT_LOG_ROUNDS'),
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "rehashed": self.rehashed,
+                "inline": self.inline,
+                "timeouts": self.timeouts
+            }
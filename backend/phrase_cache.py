@@ -0,0 +1,183 @@
+# Translation / short-phrase lookups, answered from a cache when we can.
+#
+# "translate <phrase>" is asked over and over by learners of the same language, and
+# the answer doesn't depend on the conversation. So instead of a full chat turn (history
+# read + full completion), these messages get:
+#   - a normalized key: (phrase, target language, fluency level), where the phrase is
+#     Unicode-normalized, case-folded, with whitespace collapsed and the outer
+#     punctuation/quotes stripped ("Translate: ¿Dónde está el baño?" == "translate dónde está el baño")
+#   - an in-process LRU (PHRASE_CACHE_MAX_ENTRIES entries, PHRASE_CACHE_TTL seconds)
+#   - optionally, a SQLite file shared by every worker and kept across restarts
+#     (PHRASE_CACHE_DB), checked on an in-process miss
+#   - on a miss everywhere, one small deterministic model call with no history
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from prompts import render_translation_prompt
+
+TRANSLATE_REQUEST = re.compile(r'^\s*(?:please\s+)?translate\b[\s:,-]*(.+?)\s*$', re.IGNORECASE | re.DOTALL)
+OUTER_PUNCTUATION = " \t\n\"'“”‘’«»¿¡?!.,;:"
+
+
+def normalize_phrase(text):
+    text = unicodedata.normalize('NFC', text).casefold()
+    return " ".join(text.split()).strip(OUTER_PUNCTUATION)
+
+
+def translation_request(text, max_chars):
+    """The phrase in a 'translate <phrase>' message, or None if it isn't a short translation request."""
+    match = TRANSLATE_REQUEST.match(text or "")
+    if not match:
+        return None
+    phrase = match.group(1).strip()
+    if not normalize_phrase(phrase) or len(phrase) > max_chars:
+        return None
+    return phrase
+
+
+def phrase_key(phrase, target_language, fluency_level):
+    return (normalize_phrase(phrase), (target_language or "").casefold(), (fluency_level or "").casefold())
+
+
+class PersistentPhraseStore:
+    """SQLite tier: one small table, shared by every process on the machine."""
+
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS phrase_cache ("
+            " phrase TEXT NOT NULL, language TEXT NOT NULL, fluency TEXT NOT NULL,"
+            " answer TEXT NOT NULL, expires_at REAL NOT NULL,"
+            " PRIMARY KEY (phrase, language, fluency))"
+        )
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def get(self, key, now):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT answer FROM phrase_cache WHERE phrase = ? AND language = ? AND fluency = ? AND expires_at > ?",
+                (*key, now)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, answer, expires_at):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO phrase_cache VALUES (?, ?, ?, ?, ?)", (*key, answer, expires_at))
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._trim(time.time())
+
+    def _trim(self, now):
+        # Call with self._lock held. Expired rows first, then the ones closest to expiring.
+        self._conn.execute("DELETE FROM phrase_cache WHERE expires_at <= ?", (now,))
+        self._conn.execute(
+            "DELETE FROM phrase_cache WHERE rowid IN ("
+            " SELECT rowid FROM phrase_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM phrase_cache").fetchone()[0]
+
+
+class PhraseCache:
+    def __init__(self):
+        self.config = {}
+        self.max_entries = 0
+        self.ttl = 0
+        self.store = None
+        self._entries = OrderedDict() # key -> (answer, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.config = app.config
+        self.max_entries = app.config['PHRASE_CACHE_MAX_ENTRIES']
+        self.ttl = app.config['PHRASE_CACHE_TTL']
+        if app.config['PHRASE_CACHE_DB']:
+            self.store = PersistentPhraseStore(app.config['PHRASE_CACHE_DB'], app.config['PHRASE_CACHE_DB_MAX_ENTRIES'])
+        app.extensions['phrase_cache'] = self
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._entries[key]
+
+        answer = self.store.get(key, now) if self.store else None
+        with self._lock:
+            if answer is None:
+                self.misses += 1
+                return None
+            self.store_hits += 1
+        # Promote into this process (its own TTL starts now; the SQLite row keeps its own)
+        self._remember(key, answer, now + self.ttl)
+        return answer
+
+    def put(self, key, answer):
+        expires_at = time.time() + self.ttl
+        self._remember(key, answer, expires_at)
+        if self.store:
+            self.store.put(key, answer, expires_at)
+
+    def _remember(self, key, answer, expires_at):
+        with self._lock:
+            self._entries[key] = (answer, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def request_phrase(self, text):
+        """See translation_request(); uses PHRASE_MAX_CHARS."""
+        return translation_request(text, self.config['PHRASE_MAX_CHARS'])
+
+    def translate(self, client, deployment, phrase, target_language, fluency_level):
+        """English translation of phrase, cached per (phrase, language, fluency)."""
+        key = phrase_key(phrase, target_language, fluency_level)
+        answer = self.get(key)
+        if answer is not None:
+            return answer
+
+        response = client.chat.completions.create(
+            model=deployment,
+            messages=[
+                {"role": "system", "content": render_translation_prompt(target_language, fluency_level)},
+                {"role": "user", "content": phrase}
+            ],
+            temperature=0, # Same phrase, same answer: that's what makes it cacheable
+            max_tokens=self.config['PHRASE_MAX_TOKENS']
+        )
+        answer = response.choices[0].message.content.strip()
+        if answer:
+            self.put(key, answer)
+        return answer
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.store_hits + self.misses
+            stats = {
+                "hits": self.hits,
+                "storeHits": self.store_hits,
+                "misses": self.misses,
+                "hitRate": round((self.hits + self.store_hits) / lookups, 3) if lookups else None,
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries
+            }
+        if self.store:
+            stats["storeEntries"] = self.store.count()
+        return stats
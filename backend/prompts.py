@@ -0,0 +1,136 @@
+# Prompt templates for the chat tutor.
+#
+# The system prompt only depends on (target_language, fluency_level, topic), so:
+#   - the template for each fluency level is compiled once, at import time, and
+#   - rendered prompts are cached per (target_language, fluency_level, topic).
+#     The key is every input, so an entry never goes stale: a user changing settings just
+#     uses another entry (shared with other users), and unused ones age out of the LRU.
+# Rendering is deterministic, so the prompt bytes stay identical from turn to turn
+# (which is what provider-side prompt-prefix caching needs).
+import threading
+from collections import OrderedDict
+from string import Template
+
+FLUENCY_INSTRUCTIONS = {
+    "beginner": """
+            Use short, simple sentences and very common vocabulary.
+            Avoid idioms or slang.
+            Correct mistakes explicitly and gently, explaining the rule in English.
+            Keep responses under 3 sentences.
+            Encourage the user often with praise.
+            """,
+    "intermediate": """
+            Use more natural phrasing and intermediate-level vocabulary.
+            Include compound and complex sentences using connectors like 'because', 'although', etc.
+            Correct errors naturally by restating them correctly in context, without full grammar explanations.
+            Encourage longer replies and add small cultural references.
+            """,
+    "advanced": """
+            Use fluent, natural speech and idiomatic expressions.
+            Challenge the user with nuanced questions, abstract topics, and humor.
+            Correct errors subtly by prompting self-correction.
+            Avoid basic grammar explanations unless explicitly asked.
+            """,
+}
+DEFAULT_FLUENCY_INSTRUCTIONS = """
+            Speak clearly and adapt naturally to the user's responses.
+            """
+
+SYSTEM_PROMPT = """
+        You are Kairos, an immersive AI language tutor. Your primary goal is to help me learn $target_language by having a natural, engaging conversation, *not* by quizzing me.
+
+        My Profile:
+        - Language I'm Learning: $target_language
+        - My Fluency: $fluency_level
+        - Conversation Topic: $topic
+
+        Behavior Rules:
+        $fluency_instructions
+
+        Your Rules:
+        1. Immerse Me: Speak *only* in $target_language unless I explicitly ask for help in English.
+        2. Adapt to Me: Adjust your vocabulary and sentence complexity to my $fluency_level level.
+        3. Stay on Topic: Keep the conversation focused on our current topic: $topic.
+        4. Gentle Correction: When I make a grammatical or vocabulary mistake, correct it *naturally* as part of your response.
+           - Example (if I'm learning English and say "I eated pizza.")
+           - Your response should be: "Oh, you *ate* pizza? What kind was it?"
+        5. Be Encouraging: Be patient, friendly, and supportive.
+        6. If someone says translate followed by a phrase, translate that phrase to English.
+        """
+
+
+def compile_template(fluency_instructions):
+    # Bake the fluency block in now; only the per-user fields are left for render time.
+    # (Escape '$' in the block so Template doesn't treat it as a placeholder.)
+    body = Template(SYSTEM_PROMPT).safe_substitute(fluency_instructions=fluency_instructions.replace("$", "$$"))
+    return Template(body)
+
+
+# Registry: one compiled template per fluency level
+TEMPLATES = {level: compile_template(text) for level, text in FLUENCY_INSTRUCTIONS.items()}
+DEFAULT_TEMPLATE = compile_template(DEFAULT_FLUENCY_INSTRUCTIONS)
+
+
+def render_system_prompt(target_language, fluency_level, topic):
+    template = TEMPLATES.get((fluency_level or "").lower(), DEFAULT_TEMPLATE)
+    return template.substitute(
+        target_language=target_language,
+        fluency_level=fluency_level,
+        topic=topic
+    )
+
+
+# Used for 'translate <phrase>' lookups (see phrase_cache.py): no conversation, no
+# persona, just the translation, so answers can be shared between learners.
+TRANSLATION_PROMPT = Template("""
+        You translate $target_language into English for a language learner at the $fluency_level level.
+        Reply with the English translation of the user's message and nothing else.
+        If the learner is a beginner, add one short note on any word or grammar they may not know.
+        """)
+
+
+def render_translation_prompt(target_language, fluency_level):
+    return TRANSLATION_PROMPT.substitute(target_language=target_language, fluency_level=fluency_level)
+
+
+class PromptCache:
+    """LRU cache of rendered system prompts keyed by (target_language, fluency_level, topic)."""
+
+    def __init__(self):
+        self.max_entries = 0
+        self._prompts = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.max_entries = app.config['PROMPT_CACHE_MAX_ENTRIES']
+        app.extensions['prompt_cache'] = self
+
+    def system_prompt(self, target_language, fluency_level, topic):
+        key = (target_language, fluency_level, topic)
+        with self._lock:
+            prompt = self._prompts.get(key)
+            if prompt is not None:
+                self._prompts.move_to_end(key)
+                self.hits += 1
+                return prompt
+            self.misses += 1
+
+        prompt = render_system_prompt(target_language, fluency_level, topic)
+        with self._lock:
+            self._prompts[key] = prompt
+            while len(self._prompts) > self.max_entries:
+                self._prompts.popitem(last=False)
+        return prompt
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": round(self.hits / lookups, 3) if lookups else None,
+                "entries": len(self._prompts),
+                "maxEntries": self.max_entries
+            }
@@ -0,0 +1,75 @@
+# Per-client limits on the auth endpoints, checked before any bcrypt work is queued.
+#
+# Fixed windows of AUTH_RATE_LIMIT_WINDOW seconds, counted separately per client IP
+# and per email address, so neither one address hammering many accounts nor many
+# addresses hammering one account can keep the hashing pool busy.
+import threading
+import time
+
+
+class AuthRateLimiter:
+    def __init__(self):
+        self.window = 60
+        self.limits = {}
+        self.max_keys = 0
+        self._windows = {} # (kind, value) -> [window start, hits]
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def init_app(self, app):
+        self.window = app.config['AUTH_RATE_LIMIT_WINDOW']
+        self.limits = {
+            "ip": app.config['AUTH_RATE_LIMIT_PER_IP'],
+            "email": app.config['AUTH_RATE_LIMIT_PER_EMAIL'],
+        }
+        self.max_keys = app.config['AUTH_RATE_LIMIT_MAX_KEYS']
+        app.extensions['auth_rate_limiter'] = self
+
+    def hit(self, **keys):
+        """Count one attempt for each key (ip=..., email=...).
+
+        Returns None when the attempt is allowed, or the seconds until it would be.
+        """
+        now = time.monotonic()
+        retry_after = None
+        with self._lock:
+            if len(self._windows) > self.max_keys:
+                self._prune(now)
+            for kind, value in keys.items():
+                if not value:
+                    continue
+                key = (kind, value.lower())
+                window = self._windows.get(key)
+                if window is None or now - window[0] >= self.window:
+                    window = self._windows[key] = [now, 0]
+                window[1] += 1
+                if window[1] > self.limits[kind]:
+                    wait = self.window - (now - window[0])
+                    retry_after = max(retry_after or 0, wait)
+            if retry_after is not None:
+                self.limited += 1
+        return retry_after
+
+    def reset(self, **keys):
+        """Forget the attempts for these keys (e.g. the email, after a successful login)."""
+        with self._lock:
+            for kind, value in keys.items():
+                if value:
+                    self._windows.pop((kind, value.lower()), None)
+
+    def _prune(self, now):
+        # Call with self._lock held
+        for key in [key for key, (start, _) in self._windows.items() if now - start >= self.window]:
+            del self._windows[key]
+        # Still too many: drop the oldest windows (dicts keep insertion order)
+        while len(self._windows) > self.max_keys:
+            del self._windows[next(iter(self._windows))]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "trackedKeys": len(self._windows),
+                "limited": self.limited,
+                "window": self.window,
+                "limits": dict(self.limits)
+            }
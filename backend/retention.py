@@ -0,0 +1,341 @@
+# Retention: keep the Message table to conversations people still use.
+#
+# Archiving: a conversation idle for RETENTION_IDLE_DAYS (no message since) has its
+# Message rows compressed into one ArchivedConversation row (zlib'd JSON) and deleted
+# from Message; Conversation.archived_at marks it. The Conversation row itself stays, so
+# the conversation list is unchanged. Run it from cron:
+#   flask retention archive [--idle-days 90] [--limit 1000]
+#
+# Rehydrating: the first time a chat turn or /api/chat/history touches an archived
+# conversation, rehydrate() puts its rows back into Message (same ids, same timestamps)
+# before anything reads them. Callers never see the archive.
+#
+# Both sides are safe against each other and against chat turns running at the same
+# time: each one first claims the conversation with a conditional UPDATE of archived_at,
+# and archiving only deletes the rows it compressed. A turn that commits into a
+# conversation while it's being archived leaves new rows next to the archive; the next
+# rehydrate() merges them.
+#
+# Partitioning (PostgreSQL only): `flask retention partition` turns message into a table
+# range-partitioned by month on timestamp, then (run monthly) creates the partitions for
+# the next MESSAGE_PARTITION_MONTHS_AHEAD months and drops old ones that archiving has
+# emptied. Dropping a partition gives the space back at once, where deleting rows from
+# one big table leaves it to VACUUM.
+#   flask retention status      what's archived, and how well it compresses
+import json
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import DateTime, delete, func, insert, select, text, update
+from sqlalchemy.orm.attributes import set_committed_value
+
+from instrumentation import span
+
+
+def encode_messages(rows, columns):
+    """(compressed payload, uncompressed size) for Message rows given as tuples in columns order."""
+    raw = json.dumps({"columns": columns, "rows": [list(row) for row in rows]}, default=_json_default, ensure_ascii=False).encode('utf-8')
+    return zlib.compress(raw, current_app.config['RETENTION_COMPRESSION_LEVEL']), len(raw)
+
+
+def decode_messages(payload, table):
+    """The rows in an archive payload, as dicts of the columns the message table still has."""
+    data = json.loads(zlib.decompress(payload))
+    columns = table.c
+    timestamps = {name for name in data["columns"] if name in columns and isinstance(columns[name].type, DateTime)}
+    rows = []
+    for values in data["rows"]:
+        row = {}
+        for name, value in zip(data["columns"], values):
+            if name not in columns:
+                continue # Dropped since the archive was written
+            row[name] = datetime.fromisoformat(value) if name in timestamps and value is not None else value
+        rows.append(row)
+    return rows
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Can't archive {type(value).__name__}")
+
+
+class Retention:
+    def __init__(self):
+        self.db = None
+        self.idle_days = 0
+        self.batch_size = 0
+        self._lock = threading.Lock()
+        self.archived = 0
+        self.rehydrated = 0
+        self.rehydrate_seconds = 0.0
+
+    def init_app(self, app, db):
+        self.db = db
+        self.idle_days = app.config['RETENTION_IDLE_DAYS']
+        self.batch_size = app.config['RETENTION_BATCH_SIZE']
+        app.extensions['retention'] = self
+
+    def _tables(self, *names):
+        return [self.db.metadata.tables[name] for name in names]
+
+    # --- Archiving ---
+    def archive(self, conversation_id, cutoff):
+        """Move one conversation's messages into its archive row, if it's still idle since cutoff. Commits.
+
+        Returns (messages, uncompressed bytes, compressed bytes), or None if it wasn't archived.
+        """
+        conversations, messages, archives = self._tables('conversation', 'message', 'archived_conversation')
+        session = self.db.session
+        try:
+            claimed = session.execute(
+                update(conversations)
+                .where(conversations.c.id == conversation_id, conversations.c.archived_at.is_(None), conversations.c.last_message_at < cutoff)
+                .values(archived_at=datetime.utcnow())
+            ).rowcount
+            if not claimed:
+                session.rollback() # Touched since it was picked, or archived by someone else
+                return None
+            columns = [column.name for column in messages.columns]
+            rows = session.execute(
+                select(messages).where(messages.c.conversation_id == conversation_id).order_by(messages.c.id)
+            ).all()
+            payload, raw_bytes = encode_messages(rows, columns)
+            session.execute(insert(archives).values(
+                conversation_id=conversation_id, archived_at=datetime.utcnow(),
+                message_count=len(rows), raw_bytes=raw_bytes, payload=payload
+            ))
+            if rows:
+                # Only what was compressed: a turn committing meanwhile keeps its rows
+                session.execute(delete(messages).where(messages.c.conversation_id == conversation_id, messages.c.id <= rows[-1].id))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        with self._lock:
+            self.archived += 1
+        return len(rows), raw_bytes, len(payload)
+
+    def archive_idle(self, idle_days=None, limit=None):
+        """Archive conversations with no message for idle_days (default RETENTION_IDLE_DAYS). Returns totals."""
+        cutoff = datetime.utcnow() - timedelta(days=self.idle_days if idle_days is None else idle_days)
+        conversations, = self._tables('conversation')
+        session = self.db.session
+        totals = {"conversations": 0, "messages": 0, "rawBytes": 0, "compressedBytes": 0}
+        seen = set()
+        while limit is None or totals["conversations"] < limit:
+            batch = self.batch_size if limit is None else min(self.batch_size, limit - totals["conversations"])
+            candidates = [
+                conversation_id for conversation_id in session.execute(
+                    select(conversations.c.id)
+                    .where(conversations.c.archived_at.is_(None), conversations.c.last_message_at < cutoff)
+                    .order_by(conversations.c.last_message_at)
+                    .limit(batch)
+                ).scalars() if conversation_id not in seen
+            ]
+            session.rollback() # Don't hold a read transaction between conversations
+            if not candidates:
+                break
+            for conversation_id in candidates:
+                seen.add(conversation_id)
+                result = self.archive(conversation_id, cutoff)
+                if result is not None:
+                    totals["conversations"] += 1
+                    totals["messages"] += result[0]
+                    totals["rawBytes"] += result[1]
+                    totals["compressedBytes"] += result[2]
+        return totals
+
+    # --- Rehydrating ---
+    def rehydrate(self, conversation):
+        """Put an archived conversation's messages back into Message.
+
+        Runs in a transaction of its own: the caller's session, and whatever it has
+        staged (a chat turn's new conversation or message), is left as it was.
+        """
+        started = time.perf_counter()
+        conversations, messages, archives = self._tables('conversation', 'message', 'archived_conversation')
+        with span("rehydrate"), self.db.engine.begin() as connection:
+            claimed = connection.execute(
+                update(conversations)
+                .where(conversations.c.id == conversation.id, conversations.c.archived_at.isnot(None))
+                .values(archived_at=None)
+            ).rowcount
+            # Not claimed: someone else already did it
+            payload = connection.execute(
+                select(archives.c.payload).where(archives.c.conversation_id == conversation.id)
+            ).scalar() if claimed else None
+            if payload is not None:
+                rows = decode_messages(payload, messages)
+                if rows:
+                    connection.execute(insert(messages), rows)
+                connection.execute(delete(archives).where(archives.c.conversation_id == conversation.id))
+        set_committed_value(conversation, 'archived_at', None)
+        if claimed:
+            with self._lock:
+                self.rehydrated += 1
+                self.rehydrate_seconds += time.perf_counter() - started
+
+    def archive_status(self):
+        """Totals over the archive table and the live message table (reads both)."""
+        messages, archives = self._tables('message', 'archived_conversation')
+        session = self.db.session
+        conversations, archived, raw_bytes, compressed_bytes = session.execute(select(
+            func.count(), func.coalesce(func.sum(archives.c.message_count), 0),
+            func.coalesce(func.sum(archives.c.raw_bytes), 0), func.coalesce(func.sum(func.length(archives.c.payload)), 0)
+        )).one()
+        return {
+            "archivedConversations": conversations,
+            "archivedMessages": archived,
+            "rawBytes": raw_bytes,
+            "compressedBytes": compressed_bytes,
+            "liveMessages": session.execute(select(func.count()).select_from(messages)).scalar()
+        }
+
+    def stats(self):
+        with self._lock:
+            return {
+                "idleDays": self.idle_days,
+                "archived": self.archived,
+                "rehydrated": self.rehydrated,
+                "rehydrateSeconds": round(self.rehydrate_seconds, 3)
+            }
+
+
+# --- PostgreSQL partitioning ---
+def _month(day):
+    return day.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(month):
+    return (month + timedelta(days=32)).replace(day=1)
+
+
+def _partition_name(month):
+    return f"message_p{month:%Y%m}"
+
+
+def is_partitioned(connection):
+    return connection.execute(text(
+        "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid WHERE c.relname = 'message'"
+    )).first() is not None
+
+
+def _create_partitions(connection, first, last):
+    """Monthly partitions covering first..last (months, inclusive). Existing ones are kept."""
+    month = first
+    while month <= last:
+        connection.execute(text(
+            f'CREATE TABLE IF NOT EXISTS {_partition_name(month)} PARTITION OF message'
+            f" FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{_next_month(month):%Y-%m-%d}')"
+        ))
+        month = _next_month(month)
+
+
+def partition_messages(connection, months_ahead):
+    """Turn message into a table partitioned by month on timestamp (once). Returns the months created."""
+    sequence = connection.execute(text("SELECT pg_get_serial_sequence('message', 'id')")).scalar()
+    oldest = connection.execute(text('SELECT MIN("timestamp") FROM message')).scalar()
+    first = _month(oldest or datetime.utcnow())
+    last = _month(datetime.utcnow())
+    for _ in range(months_ahead):
+        last = _next_month(last)
+
+    connection.execute(text("ALTER TABLE message RENAME TO message_unpartitioned"))
+    connection.execute(text(
+        'CREATE TABLE message (LIKE message_unpartitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY RANGE ("timestamp")'
+    ))
+    connection.execute(text("CREATE TABLE message_default PARTITION OF message DEFAULT")) # Anything past the newest month
+    _create_partitions(connection, first, last)
+    connection.execute(text("INSERT INTO message SELECT * FROM message_unpartitioned"))
+    connection.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY message.id")) # Or it goes with the old table
+    connection.execute(text("DROP TABLE message_unpartitioned"))
+    # Same names as the migrations gave them; the primary key has to include the partition key
+    connection.execute(text('ALTER TABLE message ADD CONSTRAINT message_pkey PRIMARY KEY (id, "timestamp")'))
+    connection.execute(text(
+        "ALTER TABLE message ADD CONSTRAINT message_conversation_id_fkey FOREIGN KEY (conversation_id) REFERENCES conversation (id)"
+    ))
+    connection.execute(text('CREATE INDEX ix_message_conversation_id_timestamp ON message (conversation_id, "timestamp")'))
+    return first, last
+
+
+def maintain_partitions(connection, months_ahead, drop_before):
+    """Create the coming months' partitions; drop empty ones that end before drop_before. Returns the dropped names."""
+    this_month = _month(datetime.utcnow())
+    last = this_month
+    for _ in range(months_ahead):
+        last = _next_month(last)
+    _create_partitions(connection, this_month, last)
+
+    dropped = []
+    partitions = connection.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid"
+        " JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'message' ORDER BY c.relname"
+    )).scalars().all()
+    for name in partitions:
+        if not name.startswith("message_p"):
+            continue # message_default
+        ends = _next_month(datetime.strptime(name[len("message_p"):], "%Y%m"))
+        if ends > drop_before:
+            break
+        if connection.execute(text(f"SELECT 1 FROM {name} LIMIT 1")).first() is None:
+            connection.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
+    return dropped
+
+
+# --- `flask retention` commands ---
+retention_cli = AppGroup('retention', help="Archive idle conversations and manage the Message table.")
+
+
+@retention_cli.command('archive')
+@click.option('--idle-days', type=int, default=None, help="Archive conversations idle this long (default RETENTION_IDLE_DAYS).")
+@click.option('--limit', type=int, default=None, help="Archive at most this many conversations.")
+def archive_command(idle_days, limit):
+    """Compress idle conversations' messages into the archive table."""
+    retention = current_app.extensions['retention']
+    started = time.perf_counter()
+    totals = retention.archive_idle(idle_days, limit)
+    ratio = totals["rawBytes"] / totals["compressedBytes"] if totals["compressedBytes"] else 0
+    click.echo(
+        f"✅ Archived {totals['conversations']} conversations ({totals['messages']} messages,"
+        f" {totals['rawBytes']} -> {totals['compressedBytes']} bytes, {ratio:.1f}x) in {time.perf_counter() - started:.1f}s"
+    )
+
+
+@retention_cli.command('status')
+def status_command():
+    """How many conversations and messages are archived."""
+    retention = current_app.extensions['retention']
+    status = retention.archive_status()
+    click.echo(f"Archived conversations: {status['archivedConversations']}")
+    click.echo(f"Archived messages:      {status['archivedMessages']} ({status['rawBytes']} bytes, {status['compressedBytes']} compressed)")
+    click.echo(f"Messages in Message:    {status['liveMessages']}")
+    if retention.db.engine.dialect.name == 'postgresql':
+        with retention.db.engine.connect() as connection:
+            click.echo(f"Message partitioned:    {'yes' if is_partitioned(connection) else 'no'}")
+
+
+@retention_cli.command('partition')
+@click.option('--months-ahead', type=int, default=None, help="Partitions to keep ready (default MESSAGE_PARTITION_MONTHS_AHEAD).")
+def partition_command(months_ahead):
+    """PostgreSQL: partition message by month (first run), then add upcoming / drop emptied partitions."""
+    engine = current_app.extensions['retention'].db.engine
+    if engine.dialect.name != 'postgresql':
+        raise click.ClickException("Partitioning needs PostgreSQL")
+    if months_ahead is None:
+        months_ahead = current_app.config['MESSAGE_PARTITION_MONTHS_AHEAD']
+    with engine.begin() as connection:
+        if not is_partitioned(connection):
+            # Rewrites the table under an exclusive lock: run it in a quiet moment
+            first, last = partition_messages(connection, months_ahead)
+            click.echo(f"✅ Partitioned message by month, {first:%Y-%m} to {last:%Y-%m}")
+        # A month that ended before the idle cutoff keeps only rows of conversations still in use; once archiving empties it, it goes
+        drop_before = datetime.utcnow() - timedelta(days=current_app.config['RETENTION_IDLE_DAYS'])
+        dropped = maintain_partitions(connection, months_ahead, drop_before)
+    click.echo(f"✅ Partitions ready {months_ahead} months ahead; dropped {len(dropped)} empty: {', '.join(dropped) or '-'}")
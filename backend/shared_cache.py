@@ -0,0 +1,483 @@
+# Caches that stay coherent across server processes.
+#
+# Every other cache in the backend lives in one worker. With several workers each one
+# warms its own copy, and a write handled by one worker (new messages, new settings)
+# leaves the others serving what they had. This module adds two things on top:
+#
+#   - a shared tier (L2) behind the in-process one (L1): SharedCache.cache(name, channel)
+#     gives a TieredCache that looks in the worker's own LRU first, then in the shared
+#     store, then loads from the database and fills both.
+#   - invalidation messages: committing a change to a tracked model (see track(); app.py
+#     tracks User and Conversation) publishes "<channel>:<id>" to every worker. Tiered
+#     caches on that channel drop the entry everywhere; other listeners (the history
+#     cache, token revocations) subscribe() to the channels they care about.
+#
+# SHARED_CACHE_BACKEND picks the store:
+#   sqlite - one WAL-mode SQLite file (SHARED_CACHE_PATH, read through mmap), for every
+#            worker on one machine. The default.
+#   redis  - a Redis server (SHARED_CACHE_URL, needs the `redis` package), for workers on
+#            several machines. Messages go through a Redis stream.
+#   none   - no shared tier and no messages: each worker on its own, as before.
+# Workers read new messages with sync(), at the start of every request; one indexed read
+# (SHARED_CACHE_SYNC_INTERVAL spaces them out). A worker that falls further behind than
+# the store keeps messages (SHARED_CACHE_EVENT_RETENTION) drops everything it caches.
+# If the store fails, lookups are misses and caches are dropped: answers come from the
+# database, never from a copy we can no longer check.
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from sqlalchemy import event
+
+
+class SQLiteBackend:
+    """Shared tier in one SQLite file, for the workers on this machine."""
+
+    def __init__(self, config):
+        self.max_entries = config['SHARED_CACHE_MAX_ENTRIES']
+        self.retention = config['SHARED_CACHE_EVENT_RETENTION']
+        self._conn = sqlite3.connect(config['SHARED_CACHE_PATH'], timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL") # A cache: losing the last writes in a power cut is fine
+        self._conn.execute(f"PRAGMA mmap_size={config['SHARED_CACHE_MMAP_BYTES']}")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entries ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_events ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, key TEXT NOT NULL,"
+            " origin TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache_meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def get(self, key, now):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM cache_entries WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, value, expires_at, channel, channel_key, cursor):
+        """Store value, unless (channel, channel_key) was invalidated after cursor. True if stored."""
+        with self._lock:
+            # One statement, so an invalidation can't slip in between the check and the write
+            stored = self._conn.execute(
+                "INSERT OR REPLACE INTO cache_entries (key, value, expires_at)"
+                " SELECT ?, ?, ? WHERE NOT EXISTS ("
+                "  SELECT 1 FROM cache_events WHERE id > ? AND channel = ? AND key = ?)",
+                (key, value, expires_at, cursor, channel, channel_key)
+            ).rowcount
+            self._wrote()
+        return stored > 0
+
+    def delete(self, keys):
+        with self._lock:
+            self._conn.executemany("DELETE FROM cache_entries WHERE key = ?", [(key,) for key in keys])
+
+    def publish(self, messages, origin):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO cache_events (channel, key, origin, created_at) VALUES (?, ?, ?, ?)",
+                [(channel, key, origin, now) for channel, key in messages]
+            )
+            self._wrote()
+
+    def cursor(self):
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM cache_events").fetchone()[0]
+
+    def read(self, cursor):
+        """(messages after cursor as (channel, key, origin), new cursor, True if some were already trimmed)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, channel, key, origin FROM cache_events WHERE id > ? ORDER BY id", (cursor,)
+            ).fetchall()
+            trimmed = self._conn.execute("SELECT value FROM cache_meta WHERE name = 'trimmed_through'").fetchone()
+        missed = trimmed is not None and trimmed[0] > cursor
+        return [row[1:] for row in rows], (rows[-1][0] if rows else cursor), missed
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+
+    def _wrote(self):
+        # Call with self._lock held
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self._trim(time.time())
+
+    def _trim(self, now):
+        # Call with self._lock held. Expired entries, then the ones closest to expiring; old messages.
+        self._conn.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (now,))
+        self._conn.execute(
+            "DELETE FROM cache_entries WHERE rowid IN ("
+            " SELECT rowid FROM cache_entries ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+        last = self._conn.execute(
+            "SELECT MAX(id) FROM cache_events WHERE created_at <= ?", (now - self.retention,)
+        ).fetchone()[0]
+        if last is not None:
+            self._conn.execute("DELETE FROM cache_events WHERE id <= ?", (last,))
+            self._conn.execute(
+                "INSERT INTO cache_meta (name, value) VALUES ('trimmed_through', ?)"
+                " ON CONFLICT (name) DO UPDATE SET value = MAX(value, excluded.value)",
+                (last,)
+            )
+
+
+# Store value unless the key's channel message shows up in the stream after the cursor
+REDIS_PUT_SCRIPT = """
+local events = redis.call('XRANGE', KEYS[2], '(' .. ARGV[3], '+')
+for _, entry in ipairs(events) do
+    local fields = entry[2]
+    if fields[2] == ARGV[4] and fields[4] == ARGV[5] then
+        return 0
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 1
+"""
+
+
+def _stream_id(value):
+    ms, _, seq = value.partition("-")
+    return int(ms), int(seq or 0)
+
+
+class RedisBackend:
+    """Shared tier on a Redis server, for workers on several machines."""
+
+    def __init__(self, config):
+        import redis # Optional dependency, only needed for this backend
+        self.max_events = config['SHARED_CACHE_MAX_EVENTS']
+        self.stream = "kairos:cache:events"
+        self._redis = redis.Redis.from_url(config['SHARED_CACHE_URL'], decode_responses=True)
+        self._put = self._redis.register_script(REDIS_PUT_SCRIPT)
+
+    def get(self, key, now):
+        return self._redis.get(key)
+
+    def put(self, key, value, expires_at, channel, channel_key, cursor):
+        ttl_ms = max(1, int((expires_at - time.time()) * 1000))
+        return bool(self._put(keys=[key, self.stream], args=[value, ttl_ms, cursor, channel, channel_key]))
+
+    def delete(self, keys):
+        self._redis.delete(*keys)
+
+    def publish(self, messages, origin):
+        pipe = self._redis.pipeline(transaction=False)
+        for channel, key in messages:
+            pipe.xadd(self.stream, {"channel": channel, "key": key, "origin": origin}, maxlen=self.max_events, approximate=True)
+        pipe.execute()
+
+    def cursor(self):
+        last = self._redis.xrevrange(self.stream, count=1)
+        return last[0][0] if last else "0-0"
+
+    def read(self, cursor):
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.xrange(self.stream, min=f"({cursor}")
+        pipe.xinfo_stream(self.stream)
+        try:
+            entries, info = pipe.execute()
+        except Exception:
+            if self._redis.exists(self.stream):
+                raise
+            return [], cursor, False # Nothing published yet
+        # Messages trimmed off the front that we never read (MAXLEN)
+        missed = _stream_id(info.get("max-deleted-entry-id") or "0-0") > _stream_id(cursor)
+        messages = [(fields["channel"], fields["key"], fields["origin"]) for _, fields in entries]
+        return messages, (entries[-1][0] if entries else cursor), missed
+
+    def count(self):
+        return None # Shared with everything else in the Redis database
+
+
+BACKENDS = {
+    "sqlite": SQLiteBackend,
+    "redis": RedisBackend,
+}
+
+
+class TieredCache:
+    """JSON-serializable values: in this worker first, then in the shared store.
+
+    Entries are keyed like the channel they're invalidated on (a User id for channel
+    "user"), so a commit touching that row drops them in every worker.
+    """
+
+    def __init__(self, shared, name, channel):
+        self.shared = shared
+        self.name = name
+        self.channel = channel
+        self.max_entries = 0
+        self.ttl = 0
+        self._entries = OrderedDict() # key -> (value, expires_at), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def get_or_load(self, key, load):
+        """Cached value for key, or load() (stored in both tiers). load() returning None isn't cached."""
+        key = str(key)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._entries[key]
+
+        cursor = self.shared.cursor() # Before reading the store/database: later invalidations win
+        raw = self.shared.get(self._shared_key(key), now)
+        if raw is not None:
+            value = json.loads(raw)
+            with self._lock:
+                self.shared_hits += 1
+            self._remember(key, value, now + self.ttl)
+            return value
+
+        with self._lock:
+            self.misses += 1
+        value = load()
+        if value is not None:
+            self._remember(key, value, now + self.ttl)
+            self.shared.put(self._shared_key(key), json.dumps(value), now + self.ttl, self.channel, key, cursor)
+        return value
+
+    def configure(self, config):
+        self.max_entries = config['SHARED_CACHE_L1_MAX_ENTRIES']
+        self.ttl = config['SHARED_CACHE_TTL']
+
+    def forget(self, key=None):
+        """Drop key (or everything) from this worker's tier."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(str(key), None)
+
+    def _shared_key(self, key):
+        return f"{self.shared.prefix}:{self.name}:{key}"
+
+    def _remember(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                "hits": self.hits + self.shared_hits,
+                "localHits": self.hits,
+                "sharedHits": self.shared_hits,
+                "misses": self.misses,
+                "hitRate": round((self.hits + self.shared_hits) / lookups, 3) if lookups else None,
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries
+            }
+
+
+class SharedCache:
+    def __init__(self):
+        self.config = {}
+        self.backend_name = "none"
+        self.prefix = ""
+        self.sync_interval = 0
+        self._backend = None
+        self._pid = None
+        self._origin = None
+        self._cursor = None
+        self._last_sync = 0.0
+        self._caches = []
+        self._listeners = {} # channel -> [callback(key)], key None means "everything"
+        self._tracked = {} # model class -> (channel, key function)
+        self._lock = threading.RLock() # sync() holds it while _store() may open the store
+        self._failing = False
+        self.published = 0
+        self.received = 0
+        self.resets = 0
+        self.errors = 0
+
+    def init_app(self, app, db):
+        self.config = app.config
+        self.backend_name = app.config['SHARED_CACHE_BACKEND']
+        if self.backend_name != "none" and self.backend_name not in BACKENDS:
+            raise ValueError(f"Unknown SHARED_CACHE_BACKEND {self.backend_name!r} (expected one of none, {', '.join(BACKENDS)})")
+        # Workers of another app (another database) may share the store: keep their keys apart
+        self.prefix = hashlib.sha1(app.config['SQLALCHEMY_DATABASE_URI'].encode()).hexdigest()[:8]
+        self.sync_interval = app.config['SHARED_CACHE_SYNC_INTERVAL']
+        for cache in self._caches:
+            cache.configure(app.config)
+        if not event.contains(db.session, "after_commit", self._committed): # Once, however many apps
+            event.listen(db.session, "after_flush", self._collect)
+            event.listen(db.session, "after_commit", self._committed)
+            event.listen(db.session, "after_rollback", self._rolled_back)
+        app.before_request(self.sync)
+        app.extensions['shared_cache'] = self
+
+    @property
+    def enabled(self):
+        return self.backend_name != "none"
+
+    # --- Caches and listeners ---
+    def cache(self, name, channel):
+        """A TieredCache whose entries are dropped by messages on channel."""
+        cache = TieredCache(self, name, channel)
+        if self.config:
+            cache.configure(self.config)
+        self._caches.append(cache)
+        return cache
+
+    def subscribe(self, channel):
+        """Decorator: call func(key) for messages on channel published by other workers.
+
+        func(None) means messages may have been missed: drop everything.
+        """
+        def register(func):
+            self._listeners.setdefault(channel, []).append(func)
+            return func
+        return register
+
+    def track(self, model, channel, key=lambda obj: obj.id):
+        """Publish (channel, key(obj)) whenever a commit inserts, changes or deletes a model row."""
+        self._tracked[model] = (channel, key)
+
+    # --- Store access, failures count as misses ---
+    def _store(self):
+        # Connections don't survive a fork (gunicorn --preload): each process opens its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._backend = BACKENDS[self.backend_name](self.config)
+                    self._origin = uuid.uuid4().hex
+                    self._cursor = self._backend.cursor() # Start from now: nothing cached yet
+                    self._pid = os.getpid()
+        return self._backend
+
+    def _guarded(self, action, fallback):
+        if not self.enabled:
+            return fallback
+        try:
+            result = action(self._store())
+        except Exception as e:
+            self.errors += 1
+            if not self._failing:
+                print(f"❌ Shared cache ({self.backend_name}) failed, using the database: {e}")
+                self._failing = True
+            return fallback
+        self._failing = False
+        return result
+
+    def cursor(self):
+        return self._guarded(lambda store: store.cursor(), None)
+
+    def get(self, key, now):
+        return self._guarded(lambda store: store.get(key, now), None)
+
+    def put(self, key, value, expires_at, channel, channel_key, cursor):
+        if cursor is None:
+            return False # Couldn't read the cursor: can't tell if the value is already stale
+        return self._guarded(lambda store: store.put(key, value, expires_at, channel, channel_key, cursor), False)
+
+    # --- Messages ---
+    def invalidate(self, messages):
+        """Drop (channel, key) entries in every worker: tell the others, then clear the shared and local tiers."""
+        messages = sorted({(channel, str(key)) for channel, key in messages})
+        if not messages:
+            return
+        # Publish before deleting: a worker filling the store meanwhile either sees the
+        # message (and doesn't store) or stored before the delete
+        published = self._guarded(lambda store: store.publish(messages, self._origin), False)
+        if published is not False:
+            self.published += len(messages)
+        shared_keys = []
+        for cache in self._caches:
+            for channel, key in messages:
+                if channel == cache.channel:
+                    cache.forget(key)
+                    shared_keys.append(cache._shared_key(key))
+        if shared_keys:
+            self._guarded(lambda store: store.delete(shared_keys), None)
+
+    def sync(self):
+        """Apply messages from other workers. Called before every request."""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if now - self._last_sync < self.sync_interval:
+            return
+        self._last_sync = now
+        with self._lock:
+            result = self._guarded(lambda store: store.read(self._cursor), None)
+            if result is None:
+                self._reset() # Can't tell what changed
+                return
+            messages, self._cursor, missed = result
+        if missed:
+            self._reset()
+            return
+        for channel, key, origin in messages:
+            if origin == self._origin:
+                continue # Our own, applied when published
+            self.received += 1
+            for cache in self._caches:
+                if cache.channel == channel:
+                    cache.forget(key)
+            for callback in self._listeners.get(channel, ()):
+                callback(key)
+
+    def _reset(self):
+        self.resets += 1
+        for cache in self._caches:
+            cache.forget()
+        for callbacks in self._listeners.values():
+            for callback in callbacks:
+                callback(None)
+
+    # --- Session events ---
+    def _collect(self, session, flush_context):
+        # After a flush the session still lists what it just wrote
+        pending = session.info.setdefault('shared_cache', set())
+        for obj in (*session.new, *session.dirty, *session.deleted):
+            tracked = self._tracked.get(type(obj))
+            if tracked is not None:
+                channel, key = tracked
+                value = key(obj)
+                if value is not None:
+                    pending.add((channel, value))
+
+    def _committed(self, session):
+        pending = session.info.pop('shared_cache', None)
+        if pending:
+            self.invalidate(pending)
+
+    def _rolled_back(self, session):
+        session.info.pop('shared_cache', None)
+
+    def stats(self):
+        return {
+            "backend": self.backend_name,
+            "published": self.published,
+            "received": self.received,
+            "resets": self.resets,
+            "errors": self.errors,
+            "sharedEntries": self._guarded(lambda store: store.count(), None),
+            "caches": {cache.name: cache.stats() for cache in self._caches}
+        }
@@ -0,0 +1,118 @@
+# One call at a time per key: concurrent identical requests share the first one's result.
+#
+# Used for speech synthesis (see app.py): when several clients ask /api/tts for the same
+# text and voice at once (a shared greeting, one reply played on two devices, a request
+# racing the background pre-synthesis job) only the first one calls Azure. The rest wait
+# for it and get the same bytes, or the same exception. Nothing is kept once the call
+# finishes; the audio is in tts_cache by then, so later requests are plain cache hits.
+#
+# Waiters give up after <NAME>_FLIGHT_TIMEOUT seconds (TimeoutError), whatever happens to
+# the call they joined. Waiting doesn't hold a thread in async mode: run_async() awaits
+# the leader's future on the event loop (see asgi.py). Keys are per process; across
+# workers the shared tts_cache directory still catches every request that arrives after
+# the first synthesis finished.
+import asyncio
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self.timeout = None
+        self._flights = {} # key -> Future of the call in flight
+        self._waiting = {} # key -> callers waiting on it
+        self._lock = threading.Lock()
+        self.leaders = 0 # Calls actually made
+        self.waiters = 0 # Calls that shared one
+        self.max_waiters = 0 # Most callers ever waiting on one call
+        self.timeouts = 0 # Waiters that gave up
+
+    def init_app(self, app):
+        self.timeout = app.config[f'{self.name.upper()}_FLIGHT_TIMEOUT']
+        app.extensions[f'{self.name}_flights'] = self
+
+    def run(self, key, func, *args):
+        """func(*args), unless a call for key is already in flight: then wait for its result."""
+        future, leader = self._join(key)
+        if not leader:
+            try:
+                return future.result(timeout=self.timeout)
+            except FutureTimeout:
+                raise self._timed_out(key, future)
+        return self._lead(key, future, func, args)
+
+    async def run_async(self, key, run_blocking, func, *args):
+        """Same as run(), with func on run_blocking's thread pool and waiters on the event loop."""
+        future, leader = self._join(key)
+        if leader:
+            # The thread finishes the call (and wakes the waiters) even if this request goes away
+            task = asyncio.ensure_future(self._lead_async(key, future, run_blocking, func, args))
+            task.add_done_callback(lambda task: task.cancelled() or task.exception()) # Raised to the waiters below
+        try:
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), None if leader else self.timeout)
+        except asyncio.TimeoutError:
+            raise self._timed_out(key, future)
+
+    async def _lead_async(self, key, future, run_blocking, func, args):
+        try:
+            return await run_blocking(self._lead, key, future, func, args)
+        except BaseException as e:
+            # If _lead never ran (e.g. the pool is shut down), nobody else will end this flight
+            self._land(key, future, exception=e)
+            raise
+
+    def _timed_out(self, key, future):
+        with self._lock:
+            self.timeouts += 1
+            if self._flights.get(key) is future:
+                self._waiting[key] -= 1
+        return TimeoutError(f"Gave up after {self.timeout}s waiting for an identical {self.name} call in flight")
+
+    def _join(self, key):
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                self.waiters += 1
+                self._waiting[key] += 1
+                self.max_waiters = max(self.max_waiters, self._waiting[key])
+                return future, False
+            future = self._flights[key] = Future()
+            self._waiting[key] = 0
+            self.leaders += 1
+            return future, True
+
+    def _lead(self, key, future, func, args):
+        try:
+            result = func(*args)
+        except BaseException as e:
+            self._land(key, future, exception=e)
+            raise
+        self._land(key, future, result=result)
+        return result
+
+    def _land(self, key, future, result=None, exception=None):
+        # End the flight, then wake the waiters: a request arriving from now on starts (or
+        # hits the cache) afresh. Only the first call for a flight does anything.
+        with self._lock:
+            if self._flights.get(key) is not future:
+                return
+            del self._flights[key]
+            del self._waiting[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def stats(self):
+        with self._lock:
+            calls = self.leaders + self.waiters
+            return {
+                "inFlight": len(self._flights),
+                "waiting": sum(self._waiting.values()),
+                "leaders": self.leaders,
+                "waiters": self.waiters,
+                "dedupRatio": round(self.waiters / calls, 3) if calls else None,
+                "maxWaiters": self.max_waiters,
+                "timeouts": self.timeouts
+            }
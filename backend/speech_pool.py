@@ -0,0 +1,179 @@
+# Pool of warm Azure Speech clients, so /api/tts and /api/stt don't pay the
+# SpeechConfig + connection + auth setup on every request.
+#
+# Synthesizers: a few per voice, each with its connection already open. They are
+#   checked out by one request at a time and returned afterwards. A synthesizer is
+#   recycled (closed and replaced) when a synthesis fails, when it gets old, or
+#   after a number of uses.
+# Recognizers: the Speech SDK binds a SpeechRecognizer to its audio input when it is
+#   created, so a recognizer can't be reused for another upload. What we keep warm
+#   instead is one SpeechConfig per recognition language.
+#
+# The Speech SDK is imported on first use, not at import (see startup.py).
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class SpeechPoolTimeout(Exception):
+    pass
+
+
+class PooledSynthesizer:
+    def __init__(self, voice, synthesizer, connection):
+        self.voice = voice
+        self.synthesizer = synthesizer
+        self.connection = connection
+        self.created_at = time.monotonic()
+        self.uses = 0
+        self.healthy = True
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+
+
+class SpeechPool:
+    def __init__(self):
+        self.config = {}
+        self._idle = defaultdict(list) # voice -> idle PooledSynthesizers
+        self._open = defaultdict(int) # voice -> synthesizers created and not yet closed
+        self._recognition_configs = {} # language -> SpeechConfig
+        self._cond = threading.Condition()
+        self.created = 0
+        self.recycled = 0
+        self.checkouts = 0
+        self.waits = 0
+
+    def init_app(self, app):
+        self.config = app.config
+        app.extensions['speech_pool'] = self
+
+    # --- Synthesizers ---
+    def _speech_config(self):
+        import azure.cognitiveservices.speech as speechsdk
+        return speechsdk.SpeechConfig(
+            subscription=self.config['AZURE_SPEECH_KEY'],
+            region=self.config['AZURE_SPEECH_REGION']
+        )
+
+    def _create_synthesizer(self, voice):
+        import azure.cognitiveservices.speech as speechsdk
+        speech_config = self._speech_config()
+        speech_config.speech_synthesis_voice_name = voice
+        speech_config.set_speech_synthesis_output_format(
+            speechsdk.SpeechSynthesisOutputFormat[self.config['AZURE_SPEECH_OUTPUT_FORMAT']]
+        )
+        # 'None' for audio_config gives us the audio data in memory
+        synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
+        # Open the websocket now instead of on the first synthesis
+        connection = speechsdk.Connection.from_speech_synthesizer(synthesizer)
+        connection.open(True)
+        return PooledSynthesizer(voice, synthesizer, connection)
+
+    def _is_stale(self, pooled):
+        age = time.monotonic() - pooled.created_at
+        return (
+            not pooled.healthy
+            or age > self.config['SPEECH_POOL_MAX_AGE_SECONDS']
+            or pooled.uses >= self.config['SPEECH_POOL_MAX_USES']
+        )
+
+    def _checkout(self, voice):
+        deadline = time.monotonic() + self.config['SPEECH_POOL_CHECKOUT_TIMEOUT']
+        with self._cond:
+            self.checkouts += 1
+            while True:
+                idle = self._idle[voice]
+                while idle:
+                    pooled = idle.pop()
+                    if not self._is_stale(pooled):
+                        return pooled
+                    self._discard(pooled)
+
+                if self._open[voice] < self.config['SPEECH_POOL_SIZE_PER_VOICE']:
+                    self._open[voice] += 1
+                    break # Create a new one, outside the lock
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise SpeechPoolTimeout(f"No free synthesizer for {voice}")
+                self.waits += 1
+                self._cond.wait(remaining)
+
+        try:
+            pooled = self._create_synthesizer(voice)
+        except Exception:
+            with self._cond:
+                self._open[voice] -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.created += 1
+        return pooled
+
+    def _checkin(self, pooled):
+        with self._cond:
+            pooled.uses += 1
+            if self._is_stale(pooled):
+                self._discard(pooled)
+            else:
+                self._idle[pooled.voice].append(pooled)
+            self._cond.notify()
+
+    def _discard(self, pooled):
+        # Call with self._cond held
+        self._open[pooled.voice] -= 1
+        self.recycled += 1
+        pooled.close()
+
+    @contextmanager
+    def synthesizer(self, voice):
+        """Check out a warm synthesizer for voice. Set .healthy = False on it to have it recycled."""
+        pooled = self._checkout(voice)
+        try:
+            yield pooled
+        except Exception:
+            pooled.healthy = False
+            raise
+        finally:
+            self._checkin(pooled)
+
+    # --- Recognition ---
+    def recognition_config(self, language):
+        """Shared SpeechConfig for a recognition language (only read when creating recognizers)."""
+        with self._cond:
+            speech_config = self._recognition_configs.get(language)
+            if speech_config is None:
+                speech_config = self._speech_config()
+                speech_config.speech_recognition_language = language
+                self._recognition_configs[language] = speech_config
+            return speech_config
+
+    # --- Startup ---
+    def prewarm(self, voices, languages):
+        """Open one synthesizer per voice and build the recognition configs."""
+        for language in languages:
+            self.recognition_config(language)
+        for voice in voices:
+            try:
+                with self.synthesizer(voice):
+                    pass
+            except Exception as e:
+                print(f"❌ Could not pre-warm speech synthesizer for {voice}: {e}")
+        print(f"✅ Speech pool warmed: {len(voices)} voices, {len(languages)} recognition languages")
+
+    def stats(self):
+        with self._cond:
+            return {
+                "open": sum(self._open.values()),
+                "idle": sum(len(idle) for idle in self._idle.values()),
+                "created": self.created,
+                "recycled": self.recycled,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "recognitionLanguages": len(self._recognition_configs)
+            }
@@ -0,0 +1,121 @@
+# What a worker does before it serves, and how long that takes.
+#
+# Importing the app and create_app() are kept cheap, because every worker and every
+# `flask db` command pays for them:
+#   - the heavy SDKs (openai, the Azure Speech SDK, Alembic) are imported where they're used
+#   - LLM clients are built on first use (see llm_providers.LazyClient)
+#   - nothing reads the database at import
+# Before a worker's first request, prepare() runs the registered first-request tasks (the
+# schema check and the default user, see app.py) once. Then it starts the warm-up tasks
+# (building the LLM client, opening speech connections) in a background thread. Server
+# entry points that know they will serve (asgi.py, `python app.py`) call prepare() right away.
+#
+# Timings, in seconds since app.py started importing, are printed and exported at
+# /metrics as kairos_startup_seconds{phase}:
+#   created  create_app() returned
+#   ready    first-request tasks done; the worker is serving
+#   warm     warm-up tasks done
+import glob
+import os
+import re
+import threading
+import time
+
+from sqlalchemy import text
+
+REVISION = re.compile(r"^(down_revision|revision)\s*=\s*(.+)$", re.MULTILINE)
+
+
+def migration_heads(directory):
+    """Revisions in a migrations/versions directory that no other revision builds on.
+
+    Read straight from the files, without importing Alembic.
+    """
+    revisions, parents = set(), set()
+    for path in glob.glob(os.path.join(directory, "versions", "*.py")):
+        with open(path) as f:
+            fields = dict(REVISION.findall(f.read()))
+        if 'revision' not in fields:
+            continue
+        revisions.add(fields['revision'].strip("'\""))
+        parents.update(re.findall(r"['\"]([0-9A-Za-z_]+)['\"]", fields.get('down_revision', '')))
+    return revisions - parents
+
+
+def database_revision(session):
+    """The revision the database was migrated to, or None if it never was."""
+    try:
+        return session.execute(text("SELECT version_num FROM alembic_version")).scalar()
+    except Exception:
+        session.rollback() # No alembic_version table: created some other way, or not at all
+        return None
+
+
+class Startup:
+    def __init__(self):
+        self.import_started = time.perf_counter()
+        self.timings = {}
+        self.migrations_dir = None
+        self._heads = None
+        self._schema_checked = {} # database URL -> (current?, revision)
+        self._first_request = []
+        self._warm_ups = []
+        self._prepared = False
+        self._lock = threading.Lock()
+
+    def init_app(self, app, import_started=None):
+        if import_started is not None:
+            self.import_started = import_started
+        self.migrations_dir = app.config['MIGRATIONS_DIR']
+        app.before_request(lambda: self.prepare(app))
+        app.extensions['startup'] = self
+
+    def mark(self, phase):
+        self.timings[phase] = time.perf_counter() - self.import_started
+        return self.timings[phase]
+
+    def on_first_request(self, func):
+        """Run func(app) once, inside an app context, before the worker serves."""
+        self._first_request.append(func)
+        return func
+
+    def warm_up(self, func):
+        """Run func(app) once, in the background, after the first-request tasks."""
+        self._warm_ups.append(func)
+        return func
+
+    def schema_status(self, db):
+        """(True if the database is at the migrations head, its revision). Checked once per database."""
+        url = str(db.engine.url)
+        if url not in self._schema_checked:
+            if self._heads is None:
+                self._heads = migration_heads(self.migrations_dir)
+            revision = database_revision(db.session)
+            self._schema_checked[url] = (revision in self._heads, revision)
+        return self._schema_checked[url]
+
+    def prepare(self, app):
+        if self._prepared:
+            return
+        with self._lock:
+            if self._prepared:
+                return
+            with app.app_context():
+                for func in self._first_request:
+                    func(app)
+            self._prepared = True
+        print(f"✅ Ready to serve {self.mark('ready') * 1000:.0f} ms after import")
+        if self._warm_ups:
+            threading.Thread(target=self._run_warm_ups, args=(app,), name="kairos-warm-up", daemon=True).start()
+
+    def _run_warm_ups(self, app):
+        for func in self._warm_ups:
+            try:
+                with app.app_context():
+                    func(app)
+            except Exception as e:
+                print(f"❌ Warm-up {func.__name__} failed: {e}") # It happens on first use instead
+        print(f"✅ Warm {self.mark('warm') * 1000:.0f} ms after import")
+
+    def stats(self):
+        return {phase: round(seconds, 3) for phase, seconds in self.timings.items()}
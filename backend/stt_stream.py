@@ -0,0 +1,181 @@
+# In-memory, streaming speech-to-text.
+#
+# Uploaded WAV bytes are parsed as they are read and pushed straight into an Azure
+# PushAudioInputStream (no temp files), and recognition runs in continuous mode so
+# long utterances are transcribed completely and partial hypotheses can be sent
+# back while the user is still being transcribed.
+import io
+import queue
+import struct
+import threading
+from array import array
+
+from flask import Request
+
+CHUNK_SIZE = 32 * 1024 # Bytes read from the upload per push
+
+
+class AudioFormatError(ValueError):
+    pass
+
+
+class InMemoryUploadRequest(Request):
+    """Keep uploaded files in memory instead of spooling big ones to a temp file.
+
+    Upload size is bounded by MAX_CONTENT_LENGTH.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
+
+class WavReader:
+    """Reads a PCM WAV stream chunk by chunk: header first, then raw PCM frames."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.sample_rate = None
+        self.channels = None
+        self.bits_per_sample = None
+        self._pending = b""
+        self._data_left = None
+
+    def _read_exact(self, size):
+        data = self.stream.read(size)
+        if len(data) < size:
+            raise AudioFormatError("Audio must be a PCM WAV file (unexpected end of header)")
+        return data
+
+    def read_header(self):
+        riff, _, wave = struct.unpack('<4sI4s', self._read_exact(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise AudioFormatError("Audio must be a PCM WAV file")
+
+        # Walk the RIFF chunks until the 'data' chunk; 'fmt ' has to come before it
+        while True:
+            chunk_id, chunk_size = struct.unpack('<4sI', self._read_exact(8))
+            if chunk_id == b'fmt ':
+                fmt = self._read_exact(chunk_size + (chunk_size % 2))
+                audio_format, self.channels, self.sample_rate, _, _, self.bits_per_sample = struct.unpack('<HHIIHH', fmt[:16])
+                if audio_format != 1 or self.bits_per_sample != 16 or self.channels not in (1, 2):
+                    raise AudioFormatError("Audio must be 16-bit mono or stereo PCM WAV")
+            elif chunk_id == b'data':
+                if self.sample_rate is None:
+                    raise AudioFormatError("WAV file has no 'fmt ' chunk")
+                self._data_left = chunk_size
+                return
+            else:
+                self._read_exact(chunk_size + (chunk_size % 2)) # Skip LIST/fact/etc.
+
+    def frames(self):
+        """Yield mono 16-bit PCM chunks (stereo is downmixed)."""
+        frame_size = 2 * self.channels
+        while self._data_left is None or self._data_left > 0:
+            size = CHUNK_SIZE if self._data_left is None else min(CHUNK_SIZE, self._data_left)
+            data = self.stream.read(size)
+            if not data:
+                break
+            if self._data_left is not None:
+                self._data_left -= len(data)
+
+            # Only push whole frames; keep any split frame for the next chunk
+            data = self._pending + data
+            usable = len(data) - (len(data) % frame_size)
+            self._pending = data[usable:]
+            if usable:
+                yield self._to_mono(data[:usable])
+
+    def _to_mono(self, pcm):
+        if self.channels == 1:
+            return pcm
+        samples = array('h', pcm)
+        mono = array('h', ((samples[i] + samples[i + 1]) // 2 for i in range(0, len(samples), 2)))
+        return mono.tobytes()
+
+
+class RecognitionSession:
+    """One continuous recognition over a push stream.
+
+    Callbacks from the Speech SDK run on its own threads; they only put events
+    on a queue, which the request thread reads with events().
+    Event tuples: ("partial", text), ("final", text), ("error", details), ("done", None)
+    """
+
+    def __init__(self, speech_config, sample_rate):
+        import azure.cognitiveservices.speech as speechsdk # On first use (see startup.py)
+        stream_format = speechsdk.audio.AudioStreamFormat(samples_per_second=sample_rate, bits_per_sample=16, channels=1)
+        self.push_stream = speechsdk.audio.PushAudioInputStream(stream_format=stream_format)
+        audio_config = speechsdk.audio.AudioConfig(stream=self.push_stream)
+        self.recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config, audio_config=audio_config)
+        self.queue = queue.Queue()
+        self.finals = []
+        self._finished = False
+        self._ended = False # "done" queued (both canceled and session_stopped fire at the end)
+        self._lock = threading.Lock()
+
+        self.recognizer.recognizing.connect(lambda evt: self.queue.put(("partial", evt.result.text)))
+        self.recognizer.recognized.connect(self._on_recognized)
+        self.recognizer.canceled.connect(self._on_canceled)
+        self.recognizer.session_stopped.connect(lambda evt: self._end())
+
+    def _on_recognized(self, evt):
+        import azure.cognitiveservices.speech as speechsdk
+        if evt.result.reason == speechsdk.ResultReason.RecognizedSpeech and evt.result.text:
+            self.queue.put(("final", evt.result.text))
+
+    def _on_canceled(self, evt):
+        # EndOfStream is the normal end of a push stream, anything else is a real error
+        import azure.cognitiveservices.speech as speechsdk
+        if evt.cancellation_details.reason == speechsdk.CancellationReason.Error:
+            self.queue.put(("error", evt.cancellation_details.error_details))
+        self._end()
+
+    def _end(self):
+        with self._lock:
+            if self._ended:
+                return
+            self._ended = True
+        self.queue.put(("done", None))
+
+    def start(self):
+        self.recognizer.start_continuous_recognition_async().get()
+
+    def push(self, pcm):
+        self.push_stream.write(pcm)
+
+    def finish_audio(self):
+        self.push_stream.close()
+
+    def pending_events(self):
+        """Events that are ready right now, without blocking."""
+        while True:
+            try:
+                yield self._track(self.queue.get_nowait())
+            except queue.Empty:
+                return
+
+    def remaining_events(self, timeout):
+        """Block for events until the session ends (or timeout seconds pass with no event)."""
+        while not self._finished:
+            try:
+                yield self._track(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                yield ("error", "Timed out waiting for speech recognition")
+                return
+
+    def _track(self, event):
+        kind, text = event
+        if kind == "final":
+            self.finals.append(text)
+        elif kind == "done":
+            self._finished = True
+        return event
+
+    @property
+    def text(self):
+        return " ".join(self.finals)
+
+    def close(self):
+        try:
+            self.recognizer.stop_continuous_recognition_async().get()
+        except Exception:
+            pass
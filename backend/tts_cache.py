@@ -0,0 +1,134 @@
+# Content-addressed cache for synthesized speech, stored as files on local disk.
+#
+# The key is a hash of (text, voice, output format), so the same sentence in the
+# same voice is only ever synthesized once. Files are named <key>.<ext> and served
+# straight from disk (with ETag and Range support) by /api/tts/audio/<key>.
+# When the directory grows past TTS_CACHE_MAX_BYTES the least recently played
+# files are deleted (file mtime is bumped on every hit). Every worker on the machine
+# shares the directory: files one worker wrote are hits for the others too.
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+def audio_key(text, voice, output_format):
+    raw = f"{voice}\n{output_format}\n{text}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class AudioCache:
+    def __init__(self):
+        self.directory = None
+        self.max_bytes = 0
+        self.extension = "mp3"
+        self._files = OrderedDict() # key -> size in bytes, least recently used first
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def init_app(self, app):
+        self.directory = app.config['TTS_CACHE_DIR']
+        self.max_bytes = app.config['TTS_CACHE_MAX_BYTES']
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_index()
+        app.extensions['tts_cache'] = self
+
+    def _load_index(self):
+        # Rebuild the LRU order from whatever is already on disk (oldest mtime first)
+        entries = []
+        for name in os.listdir(self.directory):
+            key, ext = os.path.splitext(name)
+            if ext != f".{self.extension}":
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            entries.append((stat.st_mtime, key, stat.st_size))
+
+        with self._lock:
+            self._files.clear()
+            self._size = 0
+            for _, key, size in sorted(entries):
+                self._files[key] = size
+                self._size += size
+            self._evict()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.{self.extension}")
+
+    def get(self, key):
+        """Path of the cached audio for key, or None on a miss."""
+        path = self.path(key)
+        with self._lock:
+            if not os.path.exists(path):
+                # Another worker may have evicted it, keep our index honest
+                self._forget(key)
+                self.misses += 1
+                return None
+            if key not in self._files:
+                # Another worker synthesized it: the directory is shared, adopt the file
+                try:
+                    self._files[key] = os.path.getsize(path)
+                except OSError:
+                    self.misses += 1
+                    return None
+                self._size += self._files[key]
+            self._files.move_to_end(key)
+            self.hits += 1
+        try:
+            now = time.time()
+            os.utime(path, (now, now)) # Mark as recently used, survives restarts
+        except OSError:
+            pass
+        return path
+
+    def put(self, key, audio_data):
+        """Store audio for key and return its path."""
+        path = self.path(key)
+        if len(audio_data) > self.max_bytes:
+            return None
+
+        # Write to a temp file and rename, so readers never see a half-written file
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(audio_data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            self._forget(key)
+            self._files[key] = len(audio_data)
+            self._size += len(audio_data)
+            self._evict()
+        return path
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions,
+                "files": len(self._files),
+                "bytes": self._size,
+                "maxBytes": self.max_bytes
+            }
+
+    # --- internal helpers, call with self._lock held ---
+    def _forget(self, key):
+        size = self._files.pop(key, None)
+        if size is not None:
+            self._size -= size
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._files:
+            key, size = self._files.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass # Already gone